@@ -0,0 +1,299 @@
+''' Modan2 benchmarks
+
+usage: python MdBenchmark.py [benchmark_name ...]
+runs every benchmark when no name is given
+'''
+import sys
+import os
+import time
+import tempfile
+import hashlib
+import numpy
+import re
+
+from MdModel import *
+from MdStatistics import MdProcrustes
+
+BENCHMARK = {}
+
+
+def benchmark(func):
+    BENCHMARK[func.__name__.replace("bench_", "")] = func
+    return func
+
+
+def best_of(func, repeat=5):
+    best = None
+    for i in range(repeat):
+        begin = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - begin
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def make_landmark_array_list(object_count, landmark_count, dimension, seed=0):
+    rng = numpy.random.default_rng(seed)
+    return [ rng.normal(size=(landmark_count, dimension)) * 10.0 for i in range(object_count) ]
+
+
+def make_landmark_str(landmark_array):
+    return LINE_SEPARATOR.join([LANDMARK_SEPARATOR.join([str(x) for x in lm]) for lm in landmark_array.tolist()])
+
+
+def unpack_landmark_str(landmark_str):
+    # MdObject.unpack_landmark before the binary column
+    landmark_list = []
+    for lm in landmark_str.split(LINE_SEPARATOR):
+        if lm != "":
+            landmark_list.append([float(x) for x in lm.split(LANDMARK_SEPARATOR)])
+    return landmark_list
+
+
+def report(title, elapsed, baseline=None):
+    if baseline is None:
+        print("  {:<40} {:10.2f} ms".format(title, elapsed * 1000))
+    else:
+        print("  {:<40} {:10.2f} ms  x{:.1f}".format(title, elapsed * 1000, baseline / elapsed))
+
+
+@benchmark
+def bench_landmark_unpack():
+    for object_count, landmark_count, dimension in [(500, 72, 3), (100, 2000, 3), (1000, 20, 2)]:
+        array_list = make_landmark_array_list(object_count, landmark_count, dimension)
+        str_list = [ make_landmark_str(arr) for arr in array_list ]
+        blob_list = [ pack_landmark_blob(arr) for arr in array_list ]
+        print("landmark unpack: {} objects x {} landmarks x {}D".format(object_count, landmark_count, dimension))
+        print("  text {:.1f} KB, blob {:.1f} KB".format(sum([len(x) for x in str_list]) / 1024, sum([len(x) for x in blob_list]) / 1024))
+
+        text_time = best_of(lambda: [ unpack_landmark_str(x) for x in str_list ])
+        report("landmark_str split/float", text_time)
+        report("landmark_blob frombuffer", best_of(lambda: [ unpack_landmark_blob(x) for x in blob_list ]), text_time)
+        report("landmark_blob frombuffer + tolist", best_of(lambda: [ unpack_landmark_blob(x).tolist() for x in blob_list ]), text_time)
+
+
+def procrustes_per_object(array_list, tolerance=10 ** -10):
+    # MdDatasetOps.procrustes_superimposition before the batched engine: one SVD per object per iteration
+    shape_list = []
+    for landmark_array in array_list:
+        shape = landmark_array - landmark_array.mean(axis=0)
+        shape_list.append(shape / numpy.sqrt((shape ** 2).sum()))
+    average_shape = None
+    while True:
+        previous_average_shape = average_shape
+        average_shape = sum(shape_list) / len(shape_list)
+        if previous_average_shape is not None and numpy.linalg.norm(previous_average_shape - average_shape) < tolerance:
+            break
+        for i, shape in enumerate(shape_list):
+            v, s, w = numpy.linalg.svd(numpy.dot(numpy.transpose(average_shape), shape))
+            if numpy.linalg.det(v) * numpy.linalg.det(w) < 0.0:
+                v[-1, :] = -v[-1, :]
+            shape_list[i] = numpy.transpose(numpy.dot(numpy.dot(v, w), numpy.transpose(shape)))
+    return shape_list
+
+
+@benchmark
+def bench_procrustes():
+    rng = numpy.random.default_rng(0)
+    for object_count, landmark_count in [(500, 72), (2000, 72), (200, 1000)]:
+        mean_shape = rng.normal(size=(landmark_count, 3))
+        array_list = []
+        for i in range(object_count):
+            rotation, r = numpy.linalg.qr(rng.normal(size=(3, 3)))
+            array_list.append((mean_shape + rng.normal(scale=0.05, size=mean_shape.shape)) @ rotation * rng.uniform(1, 10))
+        print("procrustes: {} objects x {} landmarks x 3D".format(object_count, landmark_count))
+        loop_time = best_of(lambda: procrustes_per_object(array_list), repeat=1)
+        report("per-object SVD loop", loop_time)
+        procrustes = MdProcrustes()
+        procrustes.SetData(array_list)
+        report("MdProcrustes batched SVD", best_of(procrustes.Analyze, repeat=3), loop_time)
+        print("  iterations: {}".format(procrustes.iteration_count))
+
+
+def make_memory_database():
+    gDatabase.init(':memory:', pragmas={'foreign_keys': 1})
+    gDatabase.create_tables([MdDataset, MdObject, MdImage, MdAnalysisCache])
+
+
+def load_dataset_tree_per_record(parent=None):
+    # ModanMainWindow.load_dataset before load_dataset_tree: count queries and a filter query per dataset
+    tree = []
+    for rec in MdDataset.filter(parent=parent):
+        object_count = rec.object_list.count()
+        children = []
+        if rec.children.count() > 0:
+            children = load_dataset_tree_per_record(rec)
+        tree.append(( rec.id, object_count, children ))
+    return tree
+
+
+def load_dataset_tree_bulk():
+    root_dataset_list, child_dataset_list_by_id = load_dataset_tree()
+    def build(dataset_list):
+        return [ ( rec.id, rec.object_count, build(child_dataset_list_by_id.get(rec.id, [])) ) for rec in dataset_list ]
+    return build(root_dataset_list)
+
+
+@benchmark
+def bench_dataset_tree():
+    rng = numpy.random.default_rng(0)
+    for root_count, child_count, grandchild_count in [(100, 5, 2), (300, 5, 3), (500, 4, 4)]:
+        make_memory_database()
+        with gDatabase.atomic():
+            dataset_id_list = []
+            for i in range(root_count):
+                root = MdDataset.create(dataset_name="root {}".format(i))
+                dataset_id_list.append(root.id)
+                for j in range(child_count):
+                    child = MdDataset.create(dataset_name="child {}-{}".format(i, j), parent=root)
+                    dataset_id_list.append(child.id)
+                    for k in range(grandchild_count):
+                        dataset_id_list.append(MdDataset.create(dataset_name="grandchild {}-{}-{}".format(i, j, k), parent=child).id)
+            object_row_list = [ {'object_name': "object {}".format(i), 'dataset': int(dataset_id)} for i, dataset_id in enumerate(rng.choice(dataset_id_list, size=len(dataset_id_list) * 10)) ]
+            for begin in range(0, len(object_row_list), 500):
+                MdObject.insert_many(object_row_list[begin:begin+500]).execute()
+        print("dataset tree: {} datasets, {} objects".format(len(dataset_id_list), len(object_row_list)))
+        assert load_dataset_tree_per_record() == load_dataset_tree_bulk()
+        query_time = best_of(load_dataset_tree_per_record, repeat=3)
+        report("queries per dataset", query_time)
+        report("load_dataset_tree (one query)", best_of(load_dataset_tree_bulk, repeat=3), query_time)
+
+
+''' the database settings before DATABASE_PRAGMAS and the composite indexes '''
+LEGACY_PRAGMAS = {'foreign_keys': 1, 'journal_mode': 'delete', 'synchronous': 'full'}
+LEGACY_INDEX_LIST = ['mddataset_parent_id_dataset_name', 'mdobject_dataset_id_object_name', 'mdobject_dataset_id_landmark_count',
+                     'mdobject_dataset_id_centroid_size', 'mdimage_md5hash']
+
+
+def open_database(path, pragmas):
+    gDatabase.close()
+    gDatabase.init(path, pragmas=pragmas)
+    gDatabase.connect()
+
+
+def import_objects(dataset, landmark_str_list):
+    # one save (and one commit) per object, as the import dialog does
+    for i, landmark_str in enumerate(landmark_str_list):
+        mdobject = MdObject(object_name="object {}".format(i), dataset=dataset, landmark_str=landmark_str)
+        mdobject.save()
+        MdImage.create(object=mdobject, md5hash=hashlib.md5(landmark_str.encode('utf-8')).hexdigest())
+
+
+@benchmark
+def bench_database():
+    landmark_str_list = [ make_landmark_str(x) for x in make_landmark_array_list(200, 30, 2) ]
+    # hashes of new files: the duplicate check on import misses, which means a full scan without the index
+    md5hash_list = [ hashlib.md5("new image {}".format(i).encode('utf-8')).hexdigest() for i in range(1000) ]
+    with tempfile.TemporaryDirectory() as directory:
+        for title, pragmas, legacy in [("legacy (rollback journal, synchronous=FULL)", LEGACY_PRAGMAS, True), ("DATABASE_PRAGMAS (WAL, synchronous=NORMAL)", DATABASE_PRAGMAS, False)]:
+            path = os.path.join(directory, "legacy.db" if legacy else "tuned.db")
+            open_database(path, pragmas)
+            gDatabase.create_tables([MdDataset, MdObject, MdImage, MdAnalysisCache])
+            if legacy:
+                for index_name in LEGACY_INDEX_LIST:
+                    gDatabase.execute_sql('DROP INDEX IF EXISTS "{}"'.format(index_name))
+            with gDatabase.atomic():
+                dataset_list = []
+                for i in range(300):
+                    root = MdDataset.create(dataset_name="root {}".format(i))
+                    dataset_list.append(root)
+                    for j in range(10):
+                        dataset_list.append(MdDataset.create(dataset_name="child {}-{}".format(i, j), parent=root))
+                for dataset in dataset_list:
+                    MdObject.insert_many([ {'object_name': "object {}".format(k), 'dataset': dataset.id} for k in range(20) ]).execute()
+                object_id_list = [ x[0] for x in MdObject.select(MdObject.id).tuples() ]
+                for begin in range(0, len(object_id_list), 500):
+                    MdImage.insert_many([ {'object': object_id, 'md5hash': hashlib.md5(str(object_id).encode('utf-8')).hexdigest()} for object_id in object_id_list[begin:begin+500] ]).execute()
+
+            print("database: {}".format(title))
+            begin = time.perf_counter()
+            import_objects(dataset_list[0], landmark_str_list)
+            elapsed = time.perf_counter() - begin
+            report("import {} objects".format(len(landmark_str_list)), elapsed)
+            print("  {:<40} {:10.0f} objects/s".format("import throughput", len(landmark_str_list) / elapsed))
+            report("open and first query", best_of(lambda: open_database(path, pragmas) or MdDataset.select().count()))
+            report("tree load ({} datasets)".format(len(dataset_list)), best_of(load_dataset_tree, repeat=3))
+            report("first page sorted by name", best_of(lambda: list(MdObject.select(MdObject.id, MdObject.object_name).where(MdObject.dataset == dataset_list[0].id).order_by(MdObject.object_name).limit(256)), repeat=3))
+            report("1000 image lookups by md5hash", best_of(lambda: [ MdImage.get_or_none(MdImage.md5hash == x) for x in md5hash_list ], repeat=3))
+            gDatabase.close()
+
+
+def save_object_list(dataset, object_data_list):
+    # ImportDatasetDialog.import_file before insert_object_list: one save() and one commit per object
+    for object_data in object_data_list:
+        mdobject = MdObject()
+        mdobject.dataset = dataset
+        for field_name, value in object_data.items():
+            setattr(mdobject, field_name, value)
+        mdobject.save()
+
+
+@benchmark
+def bench_import():
+    from ModanDialogs import ImportDatasetDialog, TPS, NTS, Morphologika
+    directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Morphometrics dataset")
+    file_list = [ (TPS, "digitized_aligned.tps", 1), (TPS, "digitized_aligned.tps", 10), (TPS, "Phacops_flat_20230619.tps", 1),
+                  (NTS, "Outline.nts", 1), (Morphologika, "Thylacine2020_NeuroGM.txt", 1), (Morphologika, "Thylacine2020_NeuroGM.txt", 10) ]
+    with tempfile.TemporaryDirectory() as database_directory:
+        open_database(os.path.join(database_directory, "import.db"), DATABASE_PRAGMAS)
+        gDatabase.create_tables([MdDataset, MdObject, MdImage, MdAnalysisCache])
+        for reader, filename, repeat in file_list:
+            import_data = reader(os.path.join(directory, filename), filename)
+            parse_time = best_of(lambda: reader(os.path.join(directory, filename), filename), repeat=3)
+            object_data_list = ImportDatasetDialog.make_object_data_list(import_data) * repeat
+            print("import: {} x {} ({} objects)".format(filename, repeat, len(object_data_list)))
+            report("parse", parse_time * repeat)
+            dataset = MdDataset.create(dataset_name=filename, dimension=import_data.dimension)
+            save_time = best_of(lambda: save_object_list(dataset, object_data_list), repeat=1)
+            report("save() per object", save_time)
+            report("MdObject.insert_object_list", best_of(lambda: MdObject.insert_object_list(dataset, object_data_list), repeat=3), save_time)
+        gDatabase.close()
+
+
+def read_tps_regex(filename):
+    # TPS.read before the streaming reader: readlines(), uncompiled regexes and a float list per line
+    with open(filename, 'r') as f:
+        tps_lines = f.readlines()
+    objects = {}
+    data = []
+    object_count = 0
+    for line in tps_lines:
+        line = line.strip()
+        if line == '' or line.startswith("#") or line.startswith('"') or line.startswith("'"):
+            continue
+        headerline = re.search('^\\s*LM\\s*=\\s*(\\d+)\\s*(.*)', line, re.IGNORECASE)
+        if headerline is not None:
+            if len(data) > 0:
+                objects[str(object_count)] = data
+                data = []
+            object_count += 1
+        elif re.search('^\\s*(\\w+)\\s*=(.+)', line) is None:
+            point = [ float(x) for x in re.split('\\s+', line) ]
+            if len(point) > 1:
+                data.append(point)
+    if len(data) > 0:
+        objects[str(object_count)] = data
+    return objects
+
+
+@benchmark
+def bench_tps_reader():
+    from ModanDialogs import TPS
+    directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Morphometrics dataset")
+    for filename in [ "digitized_aligned.tps", "Phacops_flat_20230619.tps" ]:
+        path = os.path.join(directory, filename)
+        tps = TPS(path, filename)
+        print("tps reader: {} ({} objects x {} landmarks)".format(filename, tps.nobjects, tps.nlandmarks))
+        regex_time = best_of(lambda: read_tps_regex(path))
+        report("regex per line", regex_time)
+        report("streaming TPS", best_of(lambda: TPS(path, filename)), regex_time)
+
+
+if __name__ == "__main__":
+    name_list = sys.argv[1:] if len(sys.argv) > 1 else list(BENCHMARK.keys())
+    for name in name_list:
+        if name not in BENCHMARK:
+            print("unknown benchmark:", name, "choose from", ", ".join(BENCHMARK.keys()))
+            continue
+        BENCHMARK[name]()
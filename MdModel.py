@@ -9,6 +9,13 @@ from pathlib import Path
 import time
 import math
 import numpy
+import struct
+import copy
+from collections import OrderedDict
+import uuid
+import shutil
+from MdStatistics import MdProcrustes, MdResistantFit, MdIncrementalPrincipalComponent
+from playhouse.migrate import SqliteMigrator, migrate
 
 LANDMARK_SEPARATOR = "\t"
 LINE_SEPARATOR = "\n"
@@ -16,7 +23,92 @@ PROPERTY_SEPARATOR = ","
 EDGE_SEPARATOR = "-"
 WIREFRAME_SEPARATOR = ","
 
-gDatabase = SqliteDatabase('Modan2.db',pragmas={'foreign_keys': 1})
+''' write-ahead log with synchronous=NORMAL: commits no longer wait for a full fsync and readers do not block the writer.
+    cache_size is in KiB when negative '''
+DATABASE_PRAGMAS = {
+    'foreign_keys': 1,
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': -64 * 1024,
+    'mmap_size': 256 * 1024 * 1024,
+}
+gDatabase = SqliteDatabase('Modan2.db',pragmas=DATABASE_PRAGMAS)
+
+''' landmark blob: landmark count, dimension, then count x dimension little-endian float64 '''
+LANDMARK_BLOB_HEADER = struct.Struct('<II')
+
+
+def pack_landmark_blob(landmark_array):
+    landmark_array = numpy.ascontiguousarray(landmark_array, dtype='<f8')
+    if landmark_array.ndim != 2:
+        return None
+    count, dim = landmark_array.shape
+    return LANDMARK_BLOB_HEADER.pack(count, dim) + landmark_array.tobytes()
+
+
+def unpack_landmark_blob(landmark_blob):
+    count, dim = LANDMARK_BLOB_HEADER.unpack_from(landmark_blob)
+    landmark_array = numpy.frombuffer(landmark_blob, dtype='<f8', count=count*dim, offset=LANDMARK_BLOB_HEADER.size)
+    return landmark_array.reshape(count, dim)
+
+
+def pack_array_blob(array):
+    ''' any numpy array in .npy format '''
+    buffer = io.BytesIO()
+    numpy.save(buffer, numpy.ascontiguousarray(array), allow_pickle=False)
+    return buffer.getvalue()
+
+
+def unpack_array_blob(array_blob):
+    return numpy.load(io.BytesIO(array_blob), allow_pickle=False)
+
+
+def get_landmark_blob_centroid_size(landmark_blob):
+    if landmark_blob is None:
+        return None
+    landmark_array = unpack_landmark_blob(landmark_blob)
+    if len(landmark_array) == 0:
+        return -1
+    elif len(landmark_array) == 1:
+        return 1
+    centered = landmark_array - landmark_array.mean(axis=0)
+    return math.sqrt(numpy.einsum('ij,ij->', centered, centered))
+
+
+''' SQL function, so that object lists can be sorted and filtered by a property inside the query '''
+@gDatabase.func('md_property')
+def sql_property(property_str, index):
+    if property_str is None or property_str == '':
+        return ''
+    property_list = property_str.split(PROPERTY_SEPARATOR)
+    if index < len(property_list):
+        return property_list[index]
+    return ''
+
+
+def get_landmark_column_data(landmark_str, landmark_array=None):
+    ''' landmark_blob, landmark_count and centroid_size derived from a landmark_str, or from
+        landmark_array when the caller already has the coordinates as numbers '''
+    if landmark_array is None:
+        landmark_array = parse_landmark_str(landmark_str)
+    if landmark_array is None:
+        # ragged rows
+        return { 'landmark_blob': None, 'landmark_count': len(landmark_str.strip().split(LINE_SEPARATOR)), 'centroid_size': None }
+    elif len(landmark_array) == 0:
+        return { 'landmark_blob': None, 'landmark_count': 0, 'centroid_size': None }
+    landmark_blob = pack_landmark_blob(landmark_array)
+    return { 'landmark_blob': landmark_blob, 'landmark_count': len(landmark_array), 'centroid_size': get_landmark_blob_centroid_size(landmark_blob) }
+
+
+def parse_landmark_str(landmark_str):
+    if landmark_str is None or landmark_str == '':
+        return numpy.zeros((0, 2))
+    row_list = [lm.split(LANDMARK_SEPARATOR) for lm in landmark_str.split(LINE_SEPARATOR) if lm != ""]
+    try:
+        return numpy.array(row_list, dtype=numpy.float64)
+    except ValueError:
+        # ragged or non-numeric rows
+        return None
 
 
 class MdDataset(Model):
@@ -37,6 +129,14 @@ class MdDataset(Model):
 
     class Meta:
         database = gDatabase
+        # child datasets in name order without touching the table
+        indexes = (
+            (('parent', 'dataset_name'), False),
+        )
+
+    def delete_instance(self, *args, **kwargs):
+        MdAnalysisCache.invalidate(self.id, discard_analysis=True)
+        return super().delete_instance(*args, **kwargs)
 
     def pack_propertyname_str(self, propertyname_list=None):
         if propertyname_list is None:
@@ -164,6 +264,9 @@ class MdObject(Model):
     object_desc = CharField(null=True)
     pixels_per_mm = DoubleField(null=True)
     landmark_str = CharField(null=True)
+    landmark_blob = BlobField(null=True)
+    landmark_count = IntegerField(null=True)
+    centroid_size = DoubleField(null=True)
     dataset = ForeignKeyField(MdDataset, backref='object_list', on_delete="CASCADE")
     created_at = DateTimeField(default=datetime.datetime.now)
     modified_at = DateTimeField(default=datetime.datetime.now)
@@ -177,6 +280,10 @@ class MdObject(Model):
         return self.object_name
     
     def count_landmarks(self):
+        if self.landmark_count is not None and 'landmark_str' not in self._dirty:
+            return self.landmark_count
+        if self.has_valid_landmark_blob():
+            return LANDMARK_BLOB_HEADER.unpack_from(self.landmark_blob)[0]
         if self.landmark_str is None or self.landmark_str == '':
             return 0
         return len(self.landmark_str.strip().split(LINE_SEPARATOR))
@@ -184,16 +291,108 @@ class MdObject(Model):
 
     class Meta:
         database = gDatabase
+        # the object table lists and sorts objects within a dataset
+        indexes = (
+            (('dataset', 'object_name'), False),
+            (('dataset', 'landmark_count'), False),
+            (('dataset', 'centroid_size'), False),
+        )
+
+    def save(self, *args, **kwargs):
+        # landmark_str is the master copy; keep the derived columns in step with it
+        if 'landmark_str' in self._dirty or self.landmark_count is None:
+            self.update_landmark_columns()
+        if self.id is None or 'landmark_str' in self._dirty or 'dataset' in self._dirty:
+            MdAnalysisCache.invalidate(self.dataset_id)
+        return super().save(*args, **kwargs)
+
+    def delete_instance(self, *args, **kwargs):
+        MdAnalysisCache.invalidate(self.dataset_id)
+        return super().delete_instance(*args, **kwargs)
+
+    def has_valid_landmark_blob(self):
+        # a blob is stale while an edited landmark_str is waiting to be saved
+        return self.landmark_blob is not None and 'landmark_str' not in self._dirty
+
+    def update_landmark_columns(self):
+        for field_name, value in get_landmark_column_data(self.landmark_str).items():
+            setattr(self, field_name, value)
+
+    @classmethod
+    def insert_object_list(cls, dataset, object_data_list, total=None, chunk_size=500, callback=None, progress_interval=0.1):
+        ''' insert many objects in one transaction with chunked multi-row INSERTs instead of a save() per object.
+            object_data_list is an iterable of dicts with object_name, object_desc, pixels_per_mm, landmark_str and property_str,
+            and optionally landmark_array; the landmark columns are derived here, from landmark_array when it is given. callback(done, total) is called at most every progress_interval seconds
+            and once at the end; returning False stops reading object_data_list and leaves the rows written so far
+            to the caller's transaction. returns the number of inserted objects '''
+        if total is None and hasattr(object_data_list, '__len__'):
+            total = len(object_data_list)
+        dataset_id = dataset.id if isinstance(dataset, MdDataset) else dataset
+        done = 0
+        last_progress_time = time.perf_counter()
+        row_list = []
+        with gDatabase.atomic():
+            for object_data in object_data_list:
+                now = datetime.datetime.now()
+                row = { 'object_name': object_data.get('object_name'), 'object_desc': object_data.get('object_desc'),
+                        'pixels_per_mm': object_data.get('pixels_per_mm'), 'landmark_str': object_data.get('landmark_str'),
+                        'property_str': object_data.get('property_str'), 'dataset': dataset_id, 'created_at': now, 'modified_at': now }
+                row.update(get_landmark_column_data(row['landmark_str'], object_data.get('landmark_array')))
+                row_list.append(row)
+                if len(row_list) >= chunk_size:
+                    cls.insert_many(row_list).execute()
+                    done += len(row_list)
+                    row_list = []
+                    if callback is not None and time.perf_counter() - last_progress_time >= progress_interval:
+                        last_progress_time = time.perf_counter()
+                        if callback(done, total) == False:
+                            break
+            if len(row_list) > 0:
+                cls.insert_many(row_list).execute()
+                done += len(row_list)
+        MdAnalysisCache.invalidate(dataset_id)
+        if callback is not None:
+            callback(done, total)
+        return done
+
+    def make_landmark_blob(self):
+        if self.landmark_str is None or self.landmark_str == '':
+            return None
+        landmark_array = parse_landmark_str(self.landmark_str)
+        if landmark_array is None:
+            return None
+        return pack_landmark_blob(landmark_array)
+
+    def get_landmark_array(self):
+        if self.has_valid_landmark_blob():
+            return unpack_landmark_blob(self.landmark_blob)
+        if self.landmark_str is None or self.landmark_str == '':
+            return numpy.zeros((0, 2))
+        landmark_array = parse_landmark_str(self.landmark_str)
+        if landmark_array is None:
+            return None
+        ''' lazy migration: store the blob for rows saved before landmark_blob existed '''
+        self.landmark_blob = pack_landmark_blob(landmark_array)
+        self.landmark_count = len(landmark_array)
+        self.centroid_size = get_landmark_blob_centroid_size(self.landmark_blob)
+        if self.id is not None and 'landmark_str' not in self._dirty:
+            MdObject.update(landmark_blob=self.landmark_blob, landmark_count=self.landmark_count, centroid_size=self.centroid_size).where(MdObject.id == self.id).execute()
+            self._dirty.difference_update(['landmark_blob', 'landmark_count', 'centroid_size'])
+        return landmark_array
 
     def pack_landmark(self):
         # error check
-        self.landmark_str = LINE_SEPARATOR.join([LANDMARK_SEPARATOR.join([str(x) for x in lm[:lm.dim]]) for lm in self.landmark_list])
+        self.landmark_str = LINE_SEPARATOR.join([LANDMARK_SEPARATOR.join([str(x) for x in lm]) for lm in self.landmark_list])
 
     def unpack_landmark(self):
         self.landmark_list = []
         #print "[", self.landmark_str,"]"
         if self.landmark_str is None or self.landmark_str == '':
             return self.landmark_list
+        landmark_array = self.get_landmark_array()
+        if landmark_array is not None:
+            self.landmark_list = landmark_array.tolist()
+            return self.landmark_list
         lm_list = self.landmark_str.split(LINE_SEPARATOR)
         for lm in lm_list:
             if lm != "":
@@ -212,11 +411,111 @@ class MdObject(Model):
         self.property_list = [x for x in self.property_str.split(PROPERTY_SEPARATOR)]
         return self.property_list
 
+IMAGE_CHUNK_SIZE = 1024 * 1024
+''' images are stored once per content, as <storage>/objects/<md5hash[:2]>/<md5hash[2:]>, and MdImage rows refer to them by md5hash '''
+IMAGE_STORE_DIRECTORY = "objects"
+
+
+def get_image_blob_path(base_path, md5hash):
+    return os.path.join(base_path, IMAGE_STORE_DIRECTORY, md5hash[:2], md5hash[2:])
+
+
+''' downsampled copies of each stored image, beside the blob store: <storage>/pyramid/<md5hash[:2]>/<md5hash[2:]>/level_<n>.jpg
+    is the image reduced by 2**n, down to IMAGE_PYRAMID_MIN_SIZE, and thumbnail.jpg fits in IMAGE_THUMBNAIL_SIZE '''
+IMAGE_PYRAMID_DIRECTORY = "pyramid"
+IMAGE_PYRAMID_MIN_SIZE = 256
+IMAGE_THUMBNAIL_SIZE = 128
+
+
+def get_image_pyramid_directory(base_path, md5hash):
+    return os.path.join(base_path, IMAGE_PYRAMID_DIRECTORY, md5hash[:2], md5hash[2:])
+
+
+def get_image_thumbnail_path(base_path, md5hash):
+    return os.path.join(get_image_pyramid_directory(base_path, md5hash), "thumbnail.jpg")
+
+
+def get_image_pyramid(base_path, md5hash):
+    ''' [(reduction factor, path), ...] of the stored levels, the full image first '''
+    level_list = [ (1, get_image_blob_path(base_path, md5hash)) ]
+    directory = get_image_pyramid_directory(base_path, md5hash)
+    if not os.path.isdir(directory):
+        return level_list
+    for filename in os.listdir(directory):
+        if filename.startswith("level_"):
+            level = int(filename[len("level_"):].split('.')[0])
+            level_list.append((2 ** level, os.path.join(directory, filename)))
+    return sorted(level_list)
+
+
+def make_image_pyramid(base_path, md5hash, image_path=None):
+    ''' writes the downsampled levels and the thumbnail of a stored image once; returns False if it cannot be decoded '''
+    directory = get_image_pyramid_directory(base_path, md5hash)
+    if os.path.isdir(directory):
+        return True
+    if image_path is None:
+        image_path = get_image_blob_path(base_path, md5hash)
+    # built in a temporary directory, so that a half-written pyramid is never used
+    temp_directory = directory + "-" + uuid.uuid4().hex
+    try:
+        with Image.open(image_path) as img:
+            full_size = img.size
+            if max(full_size) // 2 >= IMAGE_PYRAMID_MIN_SIZE:
+                # a JPEG is decoded straight at half size, which is the first level
+                img.draft('RGB', (full_size[0] // 2, full_size[1] // 2))
+            img = img.convert('RGB')
+        os.makedirs(temp_directory)
+        level = 0
+        if img.size != full_size:
+            level = 1
+            img.save(os.path.join(temp_directory, "level_{}.jpg".format(level)), quality=90)
+        while max(img.size) // 2 >= IMAGE_PYRAMID_MIN_SIZE:
+            img = img.reduce(2)
+            level += 1
+            img.save(os.path.join(temp_directory, "level_{}.jpg".format(level)), quality=90)
+        img.thumbnail((IMAGE_THUMBNAIL_SIZE, IMAGE_THUMBNAIL_SIZE))
+        img.save(os.path.join(temp_directory, "thumbnail.jpg"), quality=85)
+        os.replace(temp_directory, directory)
+    except Exception as e:
+        # not an image, or another thread stored the same pyramid first
+        if os.path.isdir(temp_directory):
+            shutil.rmtree(temp_directory)
+        return os.path.isdir(directory)
+    return True
+
+
+def get_missing_image_pyramid_hash_list(base_path):
+    return [ md5hash for md5hash in get_stored_image_hash_list(base_path) if not os.path.isdir(get_image_pyramid_directory(base_path, md5hash)) ]
+
+
+def make_missing_image_pyramids(base_path, callback=None):
+    ''' pyramids of the stored images that have none yet: stored before pyramids existed, or just ingested.
+        callback(done, total, md5hash) is called after every image; returning False stops '''
+    md5hash_list = get_missing_image_pyramid_hash_list(base_path)
+    done = 0
+    for md5hash in md5hash_list:
+        make_image_pyramid(base_path, md5hash)
+        done += 1
+        if callback is not None and callback(done, len(md5hash_list), md5hash) == False:
+            break
+    return done
+
+
+def store_image_blob(file_path, blob_path):
+    ''' moves file_path to blob_path, or drops it when the same content is already stored '''
+    if os.path.exists(blob_path):
+        os.remove(file_path)
+        return
+    if not os.path.exists(os.path.dirname(blob_path)):
+        os.makedirs(os.path.dirname(blob_path))
+    os.replace(file_path, blob_path)
+
+
 class MdImage(Model):
     original_path = CharField(null=True)
     original_filename = CharField(null=True)
     name = CharField(null=True)
-    md5hash = CharField(null=True)
+    md5hash = CharField(null=True, index=True)
     size = IntegerField(null=True)
     exifdatetime = DateTimeField(null=True)
     file_created = DateTimeField(null=True)
@@ -226,12 +525,48 @@ class MdImage(Model):
     object = ForeignKeyField(MdObject, backref='image', on_delete="CASCADE")
 
     def get_file_path(self, base_path):
-        return os.path.join( base_path, str(self.object.dataset.id), str(self.object.id) + "." + self.original_path.split('.')[-1])
+        ''' the stored blob for md5hash, or the per-object file of an image stored before the blob store '''
+        if self.md5hash:
+            blob_path = get_image_blob_path(base_path, self.md5hash)
+            if os.path.exists(blob_path):
+                return blob_path
+            legacy_path = self.get_legacy_file_path(base_path)
+            if os.path.exists(legacy_path):
+                return legacy_path
+            return blob_path
+        return self.get_legacy_file_path(base_path)
+
+    def get_legacy_file_path(self, base_path):
+        return os.path.join( base_path, str(self.object.dataset_id), str(self.object.id) + "." + self.original_path.split('.')[-1])
 
     class Meta:
         database = gDatabase
 
-    def load_file_info(self, fullpath):
+    def ingest_file(self, fullpath, base_path):
+        ''' reads the file info and copies the file into the blob store in the same pass.
+            an image that is already stored is not stored again '''
+        store_directory = os.path.join(base_path, IMAGE_STORE_DIRECTORY)
+        if not os.path.exists(store_directory):
+            os.makedirs(store_directory)
+        # the blob path is known only once the file has been hashed
+        incoming_path = os.path.join(store_directory, "incoming-" + uuid.uuid4().hex)
+        file_info = self.load_file_info(fullpath, copy_path=incoming_path)
+        store_image_blob(incoming_path, get_image_blob_path(base_path, self.md5hash))
+        # the pyramid needs the whole image decoded; it is made later by ImagePyramidThread
+        return file_info
+
+    def store_legacy_file(self, base_path):
+        ''' moves a file stored as <dataset_id>/<object_id>.<ext> into the blob store '''
+        legacy_path = self.get_legacy_file_path(base_path)
+        if not os.path.exists(legacy_path):
+            return False
+        if not self.md5hash:
+            self.md5hash = self.get_md5hash_info(legacy_path)
+            self.save()
+        store_image_blob(legacy_path, get_image_blob_path(base_path, self.md5hash))
+        return True
+
+    def load_file_info(self, fullpath, copy_path=None):
 
         file_info = {}
 
@@ -250,11 +585,11 @@ class MdImage(Model):
 
         file_info['size'] = stat_result.st_size
 
-        ''' md5 hash value '''
-        file_info['md5hash'], image_data = self.get_md5hash_info(fullpath)
+        ''' md5 hash value, copied to copy_path while hashing '''
+        file_info['md5hash'] = self.get_md5hash_info(fullpath, copy_path)
 
-        ''' exif info '''
-        exif_info = self.get_exif_info(fullpath, image_data)
+        ''' exif info, from the file header only '''
+        exif_info = self.get_exif_info(fullpath)
         file_info['exifdatetime'] = exif_info['datetime']
         file_info['latitude'] = exif_info['latitude']
         file_info['longitude'] = exif_info['longitude']
@@ -267,27 +602,42 @@ class MdImage(Model):
         self.exifdatetime = file_info['exifdatetime']
         self.file_created = file_info['ctime']
         self.file_modified = file_info['mtime']
+        return file_info
 
-    def get_md5hash_info(self,filepath):
-        afile = open(filepath, 'rb')
+    def get_md5hash_info(self, filepath, copy_path=None, chunk_size=IMAGE_CHUNK_SIZE):
+        ''' reads the file in fixed-size chunks, so memory use does not grow with the image size.
+            each chunk is also written to copy_path when it is given '''
         hasher = hashlib.md5()
-        image_data = afile.read()
-        hasher.update(image_data)
-        afile.close()
-        md5hash = hasher.hexdigest()
-        return md5hash, image_data
+        temp_path = copy_path + '.part' if copy_path is not None else None
+        with open(filepath, 'rb') as afile:
+            copy_file = open(temp_path, 'wb') if temp_path is not None else None
+            try:
+                for chunk in iter(lambda: afile.read(chunk_size), b''):
+                    hasher.update(chunk)
+                    if copy_file is not None:
+                        copy_file.write(chunk)
+            except Exception:
+                if copy_file is not None:
+                    copy_file.close()
+                    os.remove(temp_path)
+                raise
+        if copy_file is not None:
+            copy_file.close()
+            # an interrupted copy never replaces the stored image
+            os.replace(temp_path, copy_path)
+        return hasher.hexdigest()
 
     def get_exif_info(self, fullpath, image_data=None):
         image_info = {'date':'','time':'','latitude':'','longitude':'','map_datum':''}
         img = None
-        if image_data:
-            #img = Image.open()
-            img = Image.open(io.BytesIO(image_data))
-        else:
-            img = Image.open(fullpath)
         ret = {}
         #print(filename)
         try:
+            # Image.open only parses the header; pixel data is never decoded here
+            if image_data:
+                img = Image.open(io.BytesIO(image_data))
+            else:
+                img = Image.open(fullpath)
             info = img._getexif()
             for tag, value in info.items():
                 decoded=TAGS.get(tag, tag)
@@ -337,6 +687,9 @@ class MdImage(Model):
         except Exception as e:
             pass
             #print(e)
+        finally:
+            if img is not None:
+                img.close()
 
         if image_info['date'] == '':
             str1 = time.ctime(os.path.getmtime(fullpath))
@@ -389,6 +742,193 @@ class Md3DModel(Model):
         md5hash = hasher.hexdigest()
         return md5hash, image_data
 
+''' total size of the cached analysis arrays; least recently used entries are evicted beyond it '''
+ANALYSIS_CACHE_SIZE_LIMIT = 256 * 1024 * 1024
+
+class MdAnalysisCache(Model):
+    ''' superimposition and PCA results, keyed by a hash of the landmark data and the analysis parameters '''
+    dataset = ForeignKeyField(MdDataset, backref='analysis_cache_list', on_delete="CASCADE")
+    cache_key = CharField(unique=True)
+    method = CharField(null=True)
+    object_id_str = CharField(null=True)
+    aligned_blob = BlobField(null=True)
+    eigen_value_blob = BlobField(null=True)
+    rotation_matrix_blob = BlobField(null=True)
+    score_blob = BlobField(null=True)
+    blob_size = IntegerField(default=0)
+    created_at = DateTimeField(default=datetime.datetime.now)
+    accessed_at = DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        database = gDatabase
+
+    @staticmethod
+    def make_cache_key(method, object_key_list):
+        ''' object_key_list: (object id, landmark_str) of the included objects '''
+        hasher = hashlib.sha1()
+        hasher.update(method.encode('utf-8'))
+        for object_id, landmark_str in object_key_list:
+            hasher.update(LINE_SEPARATOR.encode('utf-8'))
+            hasher.update(str(object_id).encode('utf-8'))
+            hasher.update(LINE_SEPARATOR.encode('utf-8'))
+            hasher.update(( landmark_str or '' ).encode('utf-8'))
+        return hasher.hexdigest()
+
+    @classmethod
+    def invalidate(cls, dataset_id, discard_analysis=False):
+        ''' drops the stored results of a dataset whose objects have changed. the MdIncrementalAnalysis kept in memory
+            follows such changes by itself, so it is dropped only with discard_analysis, when the dataset is deleted '''
+        if dataset_id is None:
+            return
+        cls.delete().where(cls.dataset == dataset_id).execute()
+        if discard_analysis:
+            MdIncrementalAnalysis.discard_analysis(dataset_id)
+
+    @classmethod
+    def lookup(cls, cache_key):
+        entry = cls.get_or_none(cls.cache_key == cache_key)
+        if entry is not None:
+            entry.accessed_at = datetime.datetime.now()
+            cls.update(accessed_at=entry.accessed_at).where(cls.id == entry.id).execute()
+        return entry
+
+    @classmethod
+    def store(cls, dataset_id, cache_key, method, object_id_list, aligned, eigen_values, rotation_matrix, scores, size_limit=ANALYSIS_CACHE_SIZE_LIMIT):
+        blob_list = [ pack_array_blob(x) for x in [aligned, eigen_values, rotation_matrix, scores] ]
+        with gDatabase.atomic():
+            cls.delete().where(cls.cache_key == cache_key).execute()
+            entry = cls.create(dataset=dataset_id, cache_key=cache_key, method=method,
+                               object_id_str=PROPERTY_SEPARATOR.join([str(x) for x in object_id_list]),
+                               aligned_blob=blob_list[0], eigen_value_blob=blob_list[1],
+                               rotation_matrix_blob=blob_list[2], score_blob=blob_list[3],
+                               blob_size=sum([len(x) for x in blob_list]))
+            cls.evict(size_limit)
+        return entry
+
+    @classmethod
+    def evict(cls, size_limit=ANALYSIS_CACHE_SIZE_LIMIT):
+        total_size = 0
+        evict_id_list = []
+        query = cls.select(cls.id, cls.blob_size).order_by(cls.accessed_at.desc(), cls.id.desc())
+        for i, ( entry_id, blob_size ) in enumerate(query.tuples()):
+            total_size += blob_size
+            # the newest entry is kept even when it is larger than the limit
+            if i > 0 and total_size > size_limit:
+                evict_id_list.append(entry_id)
+        if len(evict_id_list) > 0:
+            cls.delete().where(cls.id.in_(evict_id_list)).execute()
+
+    def get_object_id_list(self):
+        if self.object_id_str is None or self.object_id_str == '':
+            return []
+        return [ int(x) for x in self.object_id_str.split(PROPERTY_SEPARATOR) ]
+
+def migrate_database():
+    ''' add columns introduced after an existing Modan2.db was created '''
+    migrator = SqliteMigrator(gDatabase)
+    operation_list = []
+    object_column_list = [ column.name for column in gDatabase.get_columns(MdObject._meta.table_name) ]
+    if 'landmark_blob' not in object_column_list:
+        operation_list.append(migrator.add_column(MdObject._meta.table_name, 'landmark_blob', BlobField(null=True)))
+    if 'landmark_count' not in object_column_list:
+        # filled in by backfill_landmark_columns
+        operation_list.append(migrator.add_column(MdObject._meta.table_name, 'landmark_count', IntegerField(null=True)))
+        operation_list.append(migrator.add_column(MdObject._meta.table_name, 'centroid_size', DoubleField(null=True)))
+    if len(operation_list) > 0:
+        migrate(*operation_list)
+    gDatabase.create_tables([MdAnalysisCache])
+    # indexes added to the models since the database was created
+    for model in [MdDataset, MdObject, MdImage]:
+        if model.table_exists():
+            model._schema.create_indexes(safe=True)
+
+def needs_landmark_backfill():
+    return MdObject.select().where(MdObject.landmark_count.is_null()).exists()
+
+def backfill_landmark_columns(batch_size=500, callback=None):
+    ''' fill landmark_blob, landmark_count and centroid_size of rows saved before those columns existed.
+        callback(done, total) is called after every batch; returning False stops '''
+    total = MdObject.select().where(MdObject.landmark_count.is_null()).count()
+    done = 0
+    last_id = 0
+    while True:
+        object_list = list(MdObject.select(MdObject.id, MdObject.landmark_str).where(MdObject.landmark_count.is_null() & ( MdObject.id > last_id )).order_by(MdObject.id).limit(batch_size))
+        if len(object_list) == 0:
+            break
+        with gDatabase.atomic():
+            for obj in object_list:
+                obj.update_landmark_columns()
+                MdObject.update(landmark_blob=obj.landmark_blob, landmark_count=obj.landmark_count, centroid_size=obj.centroid_size).where(MdObject.id == obj.id).execute()
+        last_id = object_list[-1].id
+        done += len(object_list)
+        if callback is not None and callback(done, total) == False:
+            break
+    return done
+
+def get_image_reference_count(md5hash_list):
+    ''' number of MdImage rows referring to each blob '''
+    reference_count = { md5hash: 0 for md5hash in md5hash_list }
+    md5hash_list = list(reference_count.keys())
+    for i in range(0, len(md5hash_list), 500):
+        query = MdImage.select(MdImage.md5hash, fn.COUNT(MdImage.id).alias('count')).where(MdImage.md5hash.in_(md5hash_list[i:i+500])).group_by(MdImage.md5hash)
+        for md5hash, count in query.tuples():
+            reference_count[md5hash] = count
+    return reference_count
+
+
+def get_stored_image_hash_list(base_path):
+    store_directory = os.path.join(base_path, IMAGE_STORE_DIRECTORY)
+    md5hash_list = []
+    if not os.path.isdir(store_directory):
+        return md5hash_list
+    for prefix in os.listdir(store_directory):
+        prefix_directory = os.path.join(store_directory, prefix)
+        if len(prefix) != 2 or not os.path.isdir(prefix_directory):
+            continue
+        md5hash_list.extend([ prefix + filename for filename in os.listdir(prefix_directory) if not filename.endswith('.part') ])
+    return md5hash_list
+
+
+def collect_image_garbage(base_path, md5hash_list=None):
+    ''' deletes stored blobs whose reference count has dropped to zero; every stored blob is checked when md5hash_list is None.
+        returns the number of deleted blobs '''
+    if md5hash_list is None:
+        md5hash_list = get_stored_image_hash_list(base_path)
+    removed_count = 0
+    for md5hash, count in get_image_reference_count([ x for x in md5hash_list if x ]).items():
+        blob_path = get_image_blob_path(base_path, md5hash)
+        if count > 0 or not os.path.exists(blob_path):
+            continue
+        os.remove(blob_path)
+        removed_count += 1
+        if len(os.listdir(os.path.dirname(blob_path))) == 0:
+            os.rmdir(os.path.dirname(blob_path))
+        pyramid_directory = get_image_pyramid_directory(base_path, md5hash)
+        if os.path.isdir(pyramid_directory):
+            shutil.rmtree(pyramid_directory)
+    return removed_count
+
+
+def needs_image_storage_migration(base_path):
+    ''' images stored as <dataset_id>/<object_id>.<ext> by older versions '''
+    if not os.path.isdir(base_path):
+        return False
+    return any([ name.isdigit() and os.path.isdir(os.path.join(base_path, name)) for name in os.listdir(base_path) ])
+
+
+def migrate_image_storage(base_path):
+    ''' moves every image stored by older versions into the blob store, so that copies can share it '''
+    moved_count = 0
+    for image in MdImage.select(MdImage, MdObject).join(MdObject):
+        if image.original_path and image.store_legacy_file(base_path):
+            moved_count += 1
+    for name in os.listdir(base_path):
+        directory = os.path.join(base_path, name)
+        if name.isdigit() and os.path.isdir(directory) and len(os.listdir(directory)) == 0:
+            os.rmdir(directory)
+    return moved_count
+
+
 class MdObjectOps:
     def __init__(self,mdobject):
         self.id = mdobject.id
@@ -398,11 +938,14 @@ class MdObjectOps:
         #self.scale = mdobject.scale
         self.landmark_str = mdobject.landmark_str
         self.property_str = mdobject.property_str
+        landmark_array = None
         if self.landmark_str is not None and self.landmark_str != "":
-            mdobject.unpack_landmark()
-        self.landmark_list = []
-        for lm in mdobject.landmark_list:
-            self.landmark_list.append(lm)
+            landmark_array = mdobject.get_landmark_array()
+        if landmark_array is not None:
+            self.landmark_list = landmark_array
+        else:
+            # ragged rows need the per-line parser
+            self.landmark_list = mdobject.unpack_landmark()
         self.property_list = []
         if self.property_str is not None and self.property_str != "":
             mdobject.unpack_property()
@@ -411,79 +954,54 @@ class MdObjectOps:
 
         self.centroid_size = -1
 
-    def get_centroid_coord(self):
-        c = [0, 0, 0]
-
-        #if len(self.landmark_list) == 0 and self.landmark_str != "":
-        #    self.unpack_landmark()
+    ''' landmarks are kept in an (n, 3) float64 array. landmark_list is a view on it:
+        rows can be indexed, unpacked and assigned like the old [x, y, z] lists '''
+    @property
+    def landmark_list(self):
+        return self.landmark_array
 
-        if len(self.landmark_list) == 0:
-            return c
-        
-        sum_of_x = 0
-        sum_of_y = 0
-        sum_of_z = 0
-        lm_dim = 2
-        for lm in ( self.landmark_list ):
-            sum_of_x += lm[0]
-            sum_of_y += lm[1]
-            if len(lm) == 3:
-                lm_dim = 3
-                sum_of_z += lm[2]
-        lm_count = len(self.landmark_list)
-        c[0] = sum_of_x / lm_count
-        c[1] = sum_of_y / lm_count
-        if lm_dim == 3:
-            c[2] = sum_of_z / lm_count
-        return c
+    @landmark_list.setter
+    def landmark_list(self, landmark_list):
+        self.landmark_array = self.make_landmark_array(landmark_list)
 
-    def get_centroid_size(self, refresh=False):
+    @staticmethod
+    def make_landmark_array(landmark_list):
+        if len(landmark_list) == 0:
+            return numpy.zeros((0, 3))
+        try:
+            landmark_array = numpy.array(landmark_list, dtype=numpy.float64)
+        except ValueError:
+            landmark_array = None
+        if landmark_array is None or landmark_array.ndim != 2:
+            # rows of different length
+            landmark_array = numpy.zeros((len(landmark_list), 3))
+            for i, lm in enumerate(landmark_list):
+                landmark_array[i, :len(lm[:3])] = lm[:3]
+            return landmark_array
+        if landmark_array.shape[1] < 3:
+            landmark_array = numpy.hstack([landmark_array, numpy.zeros((landmark_array.shape[0], 3 - landmark_array.shape[1]))])
+        return landmark_array[:, :3]
 
-        #if len(self.landmark_list) == 0 and self.landmark_str != "":
-        #    self.unpack_landmark()
+    def get_centroid_coord(self):
+        if len(self.landmark_array) == 0:
+            return [0, 0, 0]
+        return self.landmark_array.mean(axis=0).tolist()
 
-        if len(self.landmark_list) == 0:
+    def get_centroid_size(self, refresh=False):
+        if len(self.landmark_array) == 0:
             return -1
-        elif len(self.landmark_list)== 1:
+        elif len(self.landmark_array) == 1:
             return 1
         if ( self.centroid_size > 0 ) and ( refresh == False ):
             return self.centroid_size
 
-        centroid = self.get_centroid_coord()
-        # print "centroid:", centroid.xcoord, centroid.ycoord, centroid.zcoord
-        sum_of_x_squared = 0
-        sum_of_y_squared = 0
-        sum_of_z_squared = 0
-        sum_of_x = 0
-        sum_of_y = 0
-        sum_of_z = 0
-        lm_count = len(self.landmark_list)
-        for lm in self.landmark_list:
-            sum_of_x_squared += ( lm[0] - centroid[0]) ** 2
-            sum_of_y_squared += ( lm[1] - centroid[1]) ** 2
-            if len(lm) == 3:
-                sum_of_z_squared += ( lm[2] - centroid[2]) ** 2
-            sum_of_x += lm[0] - centroid[0]
-            sum_of_y += lm[1] - centroid[1]
-            if len(lm) == 3:
-                sum_of_z += lm[2] - centroid[2]
-        centroid_size = sum_of_x_squared + sum_of_y_squared + sum_of_z_squared
-        #centroid_size = sum_of_x_squared + sum_of_y_squared + sum_of_z_squared \
-        #              - sum_of_x * sum_of_x / lm_count \
-        #              - sum_of_y * sum_of_y / lm_count \
-        #              - sum_of_z * sum_of_z / lm_count
-        #print centroid_size
-        centroid_size = math.sqrt(centroid_size)
+        centered = self.landmark_array - self.landmark_array.mean(axis=0)
+        centroid_size = math.sqrt(numpy.einsum('ij,ij->', centered, centered))
         self.centroid_size = centroid_size
-        #centroid_size = float( int(  * 100 ) ) / 100
         return centroid_size
 
     def move(self, x, y, z=0):
-        for lm in self.landmark_list:
-            lm[0] = lm[0] + x
-            lm[1] = lm[1] + y
-            if len(lm) == 3:
-                lm[2] = lm[2] + z
+        self.landmark_array += numpy.array([x, y, z], dtype=numpy.float64)
 
     def move_to_center(self):
         centroid = self.get_centroid_coord()
@@ -491,13 +1009,7 @@ class MdObjectOps:
         self.move(-1 * centroid[0], -1 * centroid[1], -1 * centroid[2])
 
     def rescale(self, factor):
-        #print("rescale:", factor, self.landmark_list[:5])
-        new_landmark_list = []
-        for lm in self.landmark_list:
-            lm = [x * factor for x in lm]
-            new_landmark_list.append(lm)
-        self.landmark_list = new_landmark_list
-        #print("rescale:", factor, self.objname, self.landmark_list[:5])
+        self.landmark_array = self.landmark_array * factor
 
     def rescale_to_unitsize(self):
         centroid_size = self.get_centroid_size(True)
@@ -508,41 +1020,23 @@ class MdObjectOps:
         self.rotate_3d(theta, 'Z')
         return
 
-    def rotate_3d(self, theta, axis):
+    def get_rotation_matrix(self, theta, axis):
         cos_theta = math.cos(theta)
         sin_theta = math.sin(theta)
-        r_mx = [[1, 0, 0], [0, 1, 0], [0, 0, 1]]
         if ( axis == 'Z' ):
-            r_mx[0][0] = cos_theta
-            r_mx[0][1] = sin_theta
-            r_mx[1][0] = -1 * sin_theta
-            r_mx[1][1] = cos_theta
+            return numpy.array([[cos_theta, sin_theta, 0], [-1 * sin_theta, cos_theta, 0], [0, 0, 1]])
         elif ( axis == 'Y' ):
-            r_mx[0][0] = cos_theta
-            r_mx[0][2] = sin_theta
-            r_mx[2][0] = -1 * sin_theta
-            r_mx[2][2] = cos_theta
+            return numpy.array([[cos_theta, 0, sin_theta], [0, 1, 0], [-1 * sin_theta, 0, cos_theta]])
         elif ( axis == 'X' ):
-            r_mx[1][1] = cos_theta
-            r_mx[1][2] = sin_theta
-            r_mx[2][1] = -1 * sin_theta
-            r_mx[2][2] = cos_theta
-        # print "rotation matrix", r_mx
+            return numpy.array([[1, 0, 0], [0, cos_theta, sin_theta], [0, -1 * sin_theta, cos_theta]])
+        return numpy.identity(3)
 
-        for i, lm in enumerate(self.landmark_list):
-            coords = [0,0,0]
-            for j in range(len(lm)):
-                coords[j] = lm[j]
-            x_rotated = coords[0] * r_mx[0][0] + coords[1] * r_mx[1][0] + coords[2] * r_mx[2][0]
-            y_rotated = coords[0] * r_mx[0][1] + coords[1] * r_mx[1][1] + coords[2] * r_mx[2][1]
-            z_rotated = coords[0] * r_mx[0][2] + coords[1] * r_mx[1][2] + coords[2] * r_mx[2][2]
-            self.landmark_list[i] = [ x_rotated, y_rotated, z_rotated ]
+    def rotate_3d(self, theta, axis):
+        # landmarks are row vectors: rotated = landmarks x r_mx
+        self.landmark_array = self.landmark_array @ self.get_rotation_matrix(theta, axis)
 
     def trim_decimal(self, dec=4):
-        factor = math.pow(10, dec)
-
-        for lm in self.landmark_list:
-            lm = [float(round(x * factor)) / factor for x in lm]
+        self.landmark_array = numpy.round(self.landmark_array, dec)
 
     def print_landmarks(self, text=''):
         print("[", text, "] [", str(self.get_centroid_size()), "]")
@@ -640,21 +1134,44 @@ class MdObjectOps:
                 theta = theta * -1
             self.rotate_3d(-1 * theta, 'X')
 
+class MdSuperimpositionResult:
+    ''' returned by the MdDatasetOps superimposition methods; false when the superimposition failed '''
+    def __init__(self, method, success=True):
+        self.method = method
+        self.success = success
+        self.converged = True
+        self.iteration_count = 0
+        self.residual_list = []
+        self.iteration_time_list = []
+        self.elapsed_time = 0
+
+    def __bool__(self):
+        return self.success
+
+    def __str__(self):
+        return "{} superimposition: {} iterations, {:.3f} sec".format(self.method, self.iteration_count, self.elapsed_time)
+
 class MdDatasetOps:
     def __init__(self,dataset):
         self.id = dataset.id
+        self.object_list = []
+        self.selected_object_id_list = []
+        # one transaction for any landmark blobs migrated while unpacking
+        with gDatabase.atomic():
+            for mo in dataset.object_list.order_by(MdObject.id):
+                #self.object_list.append(mo.copy())
+                self.object_list.append(MdObjectOps(mo))
+        self.set_dataset_info(dataset)
+        #print self
+
+    def set_dataset_info(self, dataset):
         self.dataset_name = dataset.dataset_name
         self.dataset_desc = dataset.dataset_desc
         self.dimension = dataset.dimension
         self.wireframe = dataset.wireframe
         self.baseline = dataset.baseline
         self.polygons = dataset.polygons
-        self.object_list = []
-        self.selected_object_id_list = []
         self.edge_list = []
-        for mo in dataset.object_list:
-            #self.object_list.append(mo.copy())
-            self.object_list.append(MdObjectOps(mo))
         if dataset.wireframe != '':
             dataset.unpack_wireframe()
         if dataset.edge_list is not None and len(dataset.edge_list) > 0:
@@ -666,7 +1183,7 @@ class MdDatasetOps:
             dataset.unpack_baseline()
         
         self.baseline_point_list = dataset.baseline_point_list
-        #print self
+
     def set_reference_shape(self, shape):
         self.reference_shape = shape
 
@@ -676,42 +1193,8 @@ class MdDatasetOps:
             return
 
         mo = self.object_list[object_index]
-        nlandmarks = len(mo.landmark_list)
-        target_shape = numpy.zeros((nlandmarks, 3))
-        reference_shape = numpy.zeros((nlandmarks, 3))
-
-        i = 0
-        for lm in ( mo.landmark_list ):
-            for j in range(len(lm)):
-                target_shape[i,j] = lm[j]
-            i += 1
-
-        i = 0
-        for lm in self.reference_shape.landmark_list:
-            for j in range(len(lm)):
-                reference_shape[i,j] = lm[j]
-            i += 1
-
-        rotation_matrix = self.rotation_matrix(reference_shape, target_shape)
-        #print rotation_matrix
-        #target_transposed = numpy.transpose( target_shape )
-        #print target_transposed
-        #print rotation_matrix.shape
-        #print target_transposed.shape
-        rotated_shape = numpy.transpose(numpy.dot(rotation_matrix, numpy.transpose(target_shape)))
-
-        #print rotated_shape
-
-        i = 0
-        new_landmark_list = []
-        for i in range( len(mo.landmark_list) ):
-            lm = [0,0,0]
-            for j in range(3):
-                lm[j] = rotated_shape[i,j]
-            new_landmark_list.append(lm)
-            #lm = [ rotated_shape[i, 0], rotated_shape[i, 1], rotated_shape[i, 2] ]
-            #i += 1
-        mo.landmark_list = new_landmark_list
+        rotation_matrix = self.rotation_matrix(self.reference_shape.landmark_array, mo.landmark_array)
+        mo.landmark_array = numpy.transpose(numpy.dot(rotation_matrix, numpy.transpose(mo.landmark_array)))
 
     def rotation_matrix(self, ref, target):
         #assert( ref[0] == 3 )
@@ -728,30 +1211,9 @@ class MdDatasetOps:
 
     def get_average_shape(self):
 
-        object_count = len(self.object_list)
-
         average_shape = MdObjectOps(MdObject())
-        average_shape.landmark_list = []
-
-        sum_x = []
-        sum_y = []
-        sum_z = []
-
-        for mo in self.object_list:
-            i = 0
-            for lm in mo.landmark_list:
-                if len(sum_x) <= i:
-                    sum_x.append(0)
-                    sum_y.append(0)
-                    sum_z.append(0)
-                sum_x[i] += lm[0]
-                sum_y[i] += lm[1]
-                if len( lm ) == 3:
-                    sum_z[i] += lm[2]
-                i += 1
-        for i in range(len(sum_x)):
-            lm = [ float(sum_x[i]) / object_count, float(sum_y[i]) / object_count, float(sum_z[i]) / object_count ]
-            average_shape.landmark_list.append(lm)
+        if len(self.object_list) > 0:
+            average_shape.landmark_list = numpy.mean([ mo.landmark_array for mo in self.object_list ], axis=0)
         if self.id:
             average_shape.dataset_id = self.id
         return average_shape
@@ -773,79 +1235,131 @@ class MdDatasetOps:
             return False
         return True
 
-    def procrustes_superimposition(self):
+    def procrustes_superimposition(self, tolerance=10 ** -10, max_iter=1000, callback=None):
         #print("begin_procrustes")
+        result = MdSuperimpositionResult("Procrustes")
         if not self.check_object_list():
             print("check_object_list failed")
-            return False
-
-        for mo in self.object_list:
-            #mo.set_landmarks()
-            mo.move_to_center()
-            mo.rescale_to_unitsize()
-        #print("move_to_center and rescale_to_unitsize done")
-        #print("object",self.object_list[0].landmark_list[:5])
-
-        average_shape = None
-        previous_average_shape = None
-        i = 0
-        while ( True ):
-            i += 1
-            #print("progressing...", i)
-            previous_average_shape = average_shape
-            average_shape = self.get_average_shape()
-
-            #average_shape.print_landmarks("average_shape")
-
-            if ( self.is_same_shape(previous_average_shape, average_shape) and previous_average_shape != None ):
-                break
-            self.set_reference_shape(average_shape)
-            for j in range(len(self.object_list)):
-                self.rotate_gls_to_reference_shape(j)
-                #self.objects[0].print_landmarks('aa')
-                #self.objects[1].print_landmarks('bb')
-                #average_shape.print_landmarks('cc')
+            result.success = False
+            return result
+        if len(self.object_list) == 0:
+            return result
+
+        procrustes = MdProcrustes(tolerance, max_iter, callback)
+        procrustes.SetData([ mo.landmark_array for mo in self.object_list ])
+        procrustes.Analyze()
+        for mo, aligned_shape in zip(self.object_list, procrustes.aligned_data):
+            mo.landmark_array = aligned_shape
+            mo.centroid_size = -1
+
+        result.iteration_count = procrustes.iteration_count
+        result.converged = procrustes.converged
+        result.residual_list = procrustes.residual_list
+        result.iteration_time_list = procrustes.iteration_time_list
+        result.elapsed_time = procrustes.elapsed_time
         #print("end procrustes")
-        return True
+        return result
 
     def is_same_shape(self, shape1, shape2):
         if ( shape1 == None or shape2 == None ):
             return False
-        sum_coord = 0
-        for i in range(len(shape1.landmark_list)):
-            sum_coord += ( shape1.landmark_list[i][0] - shape2.landmark_list[i][0]) ** 2
-            sum_coord += ( shape1.landmark_list[i][1] - shape2.landmark_list[i][1]) ** 2
-            sum_coord += ( shape1.landmark_list[i][2] - shape2.landmark_list[i][2]) ** 2
-        #shape1.print_landmarks("shape1")
-        #shape2.print_landmarks("shape2")
-        sum_coord = math.sqrt(sum_coord)
-        #print "diff: ", sum
-        if sum_coord < 10 ** -10:
+        if numpy.linalg.norm(shape1.landmark_array - shape2.landmark_array) < 10 ** -10:
             return True
         return False
 
-    def resistant_fit_superimposition(self):
+    def resistant_fit_superimposition(self, tolerance=10 ** -10, max_iter=100, callback=None):
+        result = MdSuperimpositionResult("Resistant fit")
         if len(self.object_list) == 0:
             print( "No objects to transform!")
-            raise 
-
-        for mo in self.object_list:
-            mo.move_to_center()
-        average_shape = None
-        previous_average_shape = None
-
-        i = 0
-        while True:
-            i += 1
-            #print "iteration: ", i
-            previous_average_shape = average_shape
-            average_shape = self.get_average_shape()
-            average_shape.rescale_to_unitsize()
-            if self.is_same_shape(previous_average_shape, average_shape) and previous_average_shape is not None:
-                break
-            self.set_reference_shape(average_shape)
-            for j in range(len(self.object_list)):
-                self.rotate_resistant_fit_to_reference_shape(j)
+            result.success = False
+            return result
+        if not self.check_object_list():
+            print("check_object_list failed")
+            result.success = False
+            return result
+
+        resistant_fit = MdResistantFit(tolerance, max_iter, callback)
+        resistant_fit.SetData(self.get_landmark_data())
+        resistant_fit.Analyze()
+        self.set_landmark_data(resistant_fit.aligned_data)
+
+        result.iteration_count = resistant_fit.iteration_count
+        result.converged = resistant_fit.converged
+        result.residual_list = resistant_fit.residual_list
+        result.iteration_time_list = resistant_fit.iteration_time_list
+        result.elapsed_time = resistant_fit.elapsed_time
+        return result
+
+    def bookstein_registration(self, baseline_point_list=None, sliding=False):
+        ''' register every object on the dataset baseline (1-based landmark indices) in one pass.
+            the first two points go to (0.5, 0, 0) and (-0.5, 0, 0), the third point onto the +y side of the xy plane.
+            with sliding=True objects are scaled by centroid size instead of baseline length '''
+        begin_time = time.perf_counter()
+        result = MdSuperimpositionResult("Sliding baseline" if sliding else "Bookstein")
+        if baseline_point_list is None:
+            baseline_point_list = self.baseline_point_list
+        if not self.check_object_list() or len(self.object_list) == 0:
+            result.success = False
+            return result
+        landmark_data = numpy.array([ mo.landmark_array for mo in self.object_list ])
+        nObject, nLandmark = landmark_data.shape[:2]
+        if len(baseline_point_list) < 2 or min(baseline_point_list[:3]) < 1 or max(baseline_point_list[:3]) > nLandmark:
+            print("invalid baseline", baseline_point_list)
+            result.success = False
+            return result
+        point1 = landmark_data[:, baseline_point_list[0] - 1]
+        point2 = landmark_data[:, baseline_point_list[1] - 1]
+
+        center = ( point1 + point2 ) / 2
+        if sliding:
+            size = numpy.sqrt(numpy.sum(( landmark_data - landmark_data.mean(axis=1, keepdims=True) ) ** 2, axis=(1, 2)))
+        else:
+            size = numpy.linalg.norm(point1 - point2, axis=1)
+        size[size == 0] = 1
+
+        ''' rotation: columns are the new x, y, z axes '''
+        axis_x = point1 - point2
+        if len(baseline_point_list) == 2:
+            # rotate around z only
+            axis_x[:, 2] = 0
+        axis_x = self.normalize_vector(axis_x, [1, 0, 0])
+        if len(baseline_point_list) >= 3:
+            point3 = landmark_data[:, baseline_point_list[2] - 1] - center
+            axis_y = point3 - numpy.sum(point3 * axis_x, axis=1, keepdims=True) * axis_x
+        else:
+            axis_y = numpy.stack([-1 * axis_x[:, 1], axis_x[:, 0], numpy.zeros(nObject)], axis=1)
+        axis_y = self.normalize_vector(axis_y, [0, 1, 0])
+        axis_z = numpy.cross(axis_x, axis_y)
+        rotation_matrix = numpy.stack([axis_x, axis_y, axis_z], axis=2)
+
+        registered = ( landmark_data - center[:, numpy.newaxis, :] ) @ rotation_matrix / size[:, numpy.newaxis, numpy.newaxis]
+        for mo, landmark_array in zip(self.object_list, registered):
+            mo.landmark_array = landmark_array
+            mo.centroid_size = -1
+
+        result.elapsed_time = time.perf_counter() - begin_time
+        return result
+
+    def sliding_baseline_registration(self, baseline_point_list=None):
+        return self.bookstein_registration(baseline_point_list, sliding=True)
+
+    def normalize_vector(self, vector, default):
+        norm = numpy.linalg.norm(vector, axis=1)
+        vector = vector / numpy.where(norm > 0, norm, 1)[:, numpy.newaxis]
+        vector[norm == 0] = default
+        return vector
+
+    def get_landmark_data(self):
+        ''' landmarks of all objects as an (n_objects, n_landmarks, dimension) array '''
+        landmark_data = numpy.array([ mo.landmark_array for mo in self.object_list ])
+        if self.dimension == 2:
+            return landmark_data[:, :, :2]
+        return landmark_data
+
+    def set_landmark_data(self, landmark_data):
+        for mo, landmark_array in zip(self.object_list, landmark_data):
+            mo.landmark_list = landmark_array
+            mo.centroid_size = -1
 
     def rotate_vector_2d(self, theta, vec):
         return self.rotate_vector_3d(theta, vec, 'Z')
@@ -883,234 +1397,204 @@ class MdDatasetOps:
         if num_obj == 0 or num_obj - 1 < object_index:
             return
 
-        target_shape = self.object_list[object_index]
-        nlandmarks = len(target_shape.landmark_list)
-        #target_shape = numpy.zeros((nlandmarks,3))
-        reference_shape = self.reference_shape
-
-        #rotation_matrix = self.rotation_matrix( reference_shape, target_shape )
-
-        #rotated_shape = numpy.transpose( numpy.dot( rotation_matrix, numpy.transpose( target_shape ) ) )
-
-        # obtain scale factor using repeated median
-        landmark_count = len(reference_shape.landmark_list)
-        inner_tau_array = []
-        outer_tau_array = []
-        median_index = -1
-        for i in range(landmark_count - 1):
-            for j in range(i + 1, landmark_count):
-                target_distance = math.sqrt(
-                    ( target_shape.landmark_list[i][0] - target_shape.landmark_list[j][0] ) ** 2 + \
-                    ( target_shape.landmark_list[i][1] - target_shape.landmark_list[j][1] ) ** 2 + \
-                    ( target_shape.landmark_list[i][2] - target_shape.landmark_list[j][2] ) ** 2)
-                reference_distance = math.sqrt(
-                    ( reference_shape.landmark_list[i][0] - reference_shape.landmark_list[j][0] ) ** 2 + \
-                    ( reference_shape.landmark_list[i][1] - reference_shape.landmark_list[j][1] ) ** 2 + \
-                    ( reference_shape.landmark_list[i][2] - reference_shape.landmark_list[j][2] ) ** 2)
-                tau = reference_distance / target_distance
-                inner_tau_array.append(tau)
-                median_index = self.get_median_index(inner_tau_array)
-            #       print median_index
-            #print "tau: ", inner_tau_array
-            outer_tau_array.append(inner_tau_array[median_index])
-            inner_tau_array = []
-        median_index = self.get_median_index(outer_tau_array)
-        #print "tau: ", outer_tau_array
-        tau_final = outer_tau_array[median_index]
-
-        # rescale to scale factor
-        #print "index:", object_index
-        #print "scale factor:", tau_final
-        #target_shape.print_landmarks("before rescale")
-        target_shape.rescale(tau_final)
-        #target_shape.print_landmarks("after rescale")
-        #exit
-
-        # obtain rotation angle using repeated median
-        inner_theta_array = []
-        outer_theta_array = []
-        inner_vector_array = []
-        outer_vector_array = []
-        for i in range(landmark_count - 1):
-            for j in range(i + 1, landmark_count):
-                # get vector
-                target_vector = numpy.array([target_shape.landmark_list[i][0] - target_shape.landmark_list[j][0],
-                                             target_shape.landmark_list[i][1] - target_shape.landmark_list[j][1],
-                                             target_shape.landmark_list[i][2] - target_shape.landmark_list[j][2]])
-                reference_vector = numpy.array([reference_shape.landmark_list[i][0] - reference_shape.landmark_list[j][0],
-                                             reference_shape.landmark_list[i][1] - reference_shape.landmark_list[j][1],
-                                             reference_shape.landmark_list[i][2] - reference_shape.landmark_list[j][2]])
-                #       cos_val = ( target_vector[0] * reference_vector[0] + \
-                #                   target_vector[1] * reference_vector[1] + \
-                #                   target_vector[2] * reference_vector[2] ) \
-                #                  / \
-                #                  ( math.sqrt( target_vector[0] ** 2 + target_vector[1]**2 + target_vector[2]**2 ) * \
-                #                    math.sqrt( reference_vector[0] ** 2 + reference_vector[1]**2 + reference_vector[2]**2 ) )
-                #        if( cos_val > 1.0 ):
-                #          print "cos_val 1: ", cos_val
-                #          print target_vector
-                #          print reference_vector
-                #          print math.acos( cos_val )
-                #          cos_val = 1.0
-                cos_val = numpy.vdot(target_vector, reference_vector) / numpy.linalg.norm(
-                    target_vector) * numpy.linalg.norm(reference_vector)
-                #        if( cos_val > 1.0 ):
-                #          print "cos_val 2: ", cos_val
-                #          cos_val = 1.0
-                #        try:
-                #          if( cos_val == 1.0 ):
-                #            theta = 0.0
-                #          else:
-                theta = math.acos(cos_val)
-                #        except ValueError:
-                #          print "acos value error"
-                #          theta = 0.0
-                inner_theta_array.append(theta)
-                inner_vector_array.append(numpy.array([target_vector, reference_vector]))
-                #print inner_vector_array[-1]
-            median_index = self.get_median_index(inner_theta_array)
-            #      print inner_vector_array[median_index]
-            outer_theta_array.append(inner_theta_array[median_index])
-            outer_vector_array.append(inner_vector_array[median_index])
-            inner_theta_array = []
-            inner_vector_array = []
-        median_index = self.get_median_index(outer_theta_array)
-        # theta_final = outer_theta_array[median_index]
-        vector_final = outer_vector_array[median_index]
-        #    print vector_final
-
-        target_shape = numpy.zeros((1, 3))
-        reference_shape = numpy.zeros((1, 3))
-        #print vector_final
-        target_shape[0] = vector_final[0]
-        reference_shape[0] = vector_final[1]
-
-        rotation_matrix = self.get_vector_rotation_matrix(vector_final[1], vector_final[0])
-
-        #rotation_matrix = self.rotation_matrix( reference_shape, target_shape )
-        #print reference_shape
-        #print target_shape
-        #rotated_shape = numpy.transpose( numpy.dot( rotation_matrix, numpy.transpose( target_shape ) ) )
-        #print rotated_shape
-        #exit
-        target_shape = numpy.zeros((nlandmarks, 3))
-        i = 0
-        for lm in ( self.object_list[object_index].landmark_list ):
-            target_shape[i] = lm
-            i += 1
-
-        reference_shape = numpy.zeros((nlandmarks, 3))
-        i = 0
-        for lm in ( self.reference_shape.landmark_list ):
-            reference_shape[i] = lm
-            i += 1
-
-        rotated_shape = numpy.transpose(numpy.dot(rotation_matrix, numpy.transpose(target_shape)))
-
-        #print "reference: ", reference_shape[0]
-        #print "target: ", target_shape[0], numpy.linalg.norm(target_shape[0])
-        #print "rotation: ", rotation_matrix
-        #print "rotated: ", rotated_shape[0], numpy.linalg.norm(rotated_shape[0])
-        #print "determinant: ", numpy.linalg.det( rotation_matrix )
-
-        i = 0
-        for lm in ( self.object_list[object_index].landmark_list ):
-            lm = [ rotated_shape[i, 0], rotated_shape[i, 1], rotated_shape[i, 2] ]
-            i += 1
-        if ( object_index == 0 ):
-            pass
-            #self.reference_shape.print_landmarks("ref:")
-            #self.objects[object_index].print_landmarks(str(object_index))
-            #print "reference: ", reference_shape[0]
-            #print "target: ", target_shape[0], numpy.linalg.norm(target_shape[0])
-            #print "rotation: ", rotation_matrix
-            #print "rotated: ", rotated_shape[0], numpy.linalg.norm(rotated_shape[0])
-            #print "determinant: ", numpy.linalg.det( rotation_matrix )
-
-    def get_vector_rotation_matrix(self, ref, target):
-        ( x, y, z ) = ( 0, 1, 2 )
-        #print ref
-        #print target
-        #print "0 ref", ref
-        #print "0 target", target
-
-        ref_1 = ref
-        ref_1[z] = 0
-        cos_val = ref[x] / math.sqrt(ref[x] ** 2 + ref[z] ** 2)
-        theta1 = math.acos(cos_val)
-        if ( ref[z] < 0 ):
-            theta1 = theta1 * -1
-        ref = self.rotate_vector_3d(-1 * theta1, ref, 'Y')
-        target = self.rotate_vector_3d(-1 * theta1, target, 'Y')
-
-        #print "1 ref", ref
-        #print "1 target", target
-
-        cos_val = ref[x] / math.sqrt(ref[x] ** 2 + ref[y] ** 2)
-        theta2 = math.acos(cos_val)
-        if ( ref[y] < 0 ):
-            theta2 = theta2 * -1
-        ref = self.rotate_vector_2d(-1 * theta2, ref)
-        target = self.rotate_vector_2d(-1 * theta2, target)
-
-        #print "2 ref", ref
-        #print "2 target", target
-
-        cos_val = target[x] / math.sqrt(( target[x] ** 2 + target[z] ** 2 ))
-        theta1 = math.acos(cos_val)
-        if ( target[z] < 0 ):
-            theta1 = theta1 * -1
-        target = self.rotate_vector_3d(-1 * theta1, target, 'Y')
-
-        #print "3 ref", ref
-        #print "3 target", target
-
-        cos_val = target[x] / math.sqrt(( target[x] ** 2 + target[y] ** 2 ))
-        theta2 = math.acos(cos_val)
-        if ( target[y] < 0 ):
-            theta2 = theta2 * -1
-        target = self.rotate_vector_2d(-1 * theta2, target)
-
-        #print "4 ref", ref
-        #print "4 target", target
-
-        r_mx1 = numpy.array([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]])
-        r_mx2 = numpy.array([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]])
-        #print "shape:", r_mx1.shape
-        #print "r_mx1", r_mx1
-        #print "theta1", theta1
-        #print "cos theta1", math.cos( theta1 )
-        #print "sin theta1", math.sin( theta1 )
-        #print "r_mx2", r_mx2
-        #print "theta2", theta2
-        r_mx1[0][0] = math.cos(theta1)
-        r_mx1[0][2] = math.sin(theta1)
-        r_mx1[2][0] = math.sin(theta1) * -1
-        r_mx1[2][2] = math.cos(theta1)
-
-        #print "r_mx1", r_mx1
-        #print "theta1", theta1
-        #print "r_mx2", r_mx2
-        #print "theta2", theta2
-
-        r_mx2[0][0] = math.cos(theta2)
-        r_mx2[0][1] = math.sin(theta2)
-        r_mx2[1][0] = math.sin(theta2) * -1
-        r_mx2[1][1] = math.cos(theta2)
-
-        #print "r_mx1", r_mx1
-        #print "theta1", theta1
-        #print "r_mx2", r_mx2
-        #print "theta2", theta2
-
-        rotation_matrix = numpy.dot(r_mx1, r_mx2)
-        return rotation_matrix
-
-
-    def get_median_index(self, arr):
-        arr.sort()
-        len_arr = len(arr)
-        if ( len_arr == 0 ):
-            return -1
-        half_len = int(math.floor(len_arr / 2.0))
-        return half_len
+        mo = self.object_list[object_index]
+        dimension = 2 if self.dimension == 2 else 3
+        fitted = MdResistantFit().RotateToReference(mo.landmark_array[numpy.newaxis, :, :dimension], self.reference_shape.landmark_array[:, :dimension])
+        mo.landmark_list = fitted[0]
+        mo.centroid_size = -1
+
+
+def load_dataset_tree():
+    ''' every dataset with its object count from a single query.
+        returns the top level datasets and a {parent id: [child datasets]} dict; each dataset gets an object_count attribute '''
+    root_dataset_list = []
+    child_dataset_list_by_id = {}
+    query = MdDataset.select(MdDataset, fn.COUNT(MdObject.id).alias('object_count')).join(MdObject, JOIN.LEFT_OUTER).group_by(MdDataset.id).order_by(MdDataset.id)
+    for dataset in query:
+        if dataset.parent_id is None:
+            root_dataset_list.append(dataset)
+        else:
+            child_dataset_list_by_id.setdefault(dataset.parent_id, []).append(dataset)
+    return root_dataset_list, child_dataset_list_by_id
+
+class MdIncrementalAnalysis:
+    ''' Procrustes superimposition and PCA of a dataset, kept up to date while objects are added, removed or re-digitized.
+        a changed object is fitted to the current mean shape and folded into the PCA with a rank-one update;
+        the full superimposition runs again, starting from the aligned shapes, only when the mean shape has drifted '''
+    analysis_by_dataset = OrderedDict()
+    max_analysis_count = 4
+
+    @classmethod
+    def get_analysis(cls, dataset, n_components=None):
+        ''' the analysis of a dataset; only the max_analysis_count most recently used are kept in memory.
+            n_components limits the principal components, see MdIncrementalPrincipalComponent '''
+        analysis = cls.analysis_by_dataset.get(dataset.id)
+        if analysis is not None and analysis.n_components == n_components:
+            cls.analysis_by_dataset.move_to_end(dataset.id)
+            return analysis
+        analysis = cls(dataset, n_components=n_components)
+        cls.analysis_by_dataset[dataset.id] = analysis
+        while len(cls.analysis_by_dataset) > cls.max_analysis_count:
+            old_dataset_id, old_analysis = cls.analysis_by_dataset.popitem(last=False)
+            # the next analysis of that dataset starts from the stored results
+            old_analysis.save_cache()
+        return analysis
+
+    @classmethod
+    def discard_analysis(cls, dataset_id):
+        cls.analysis_by_dataset.pop(dataset_id, None)
+
+    def __init__(self, dataset, drift_tolerance=10 ** -3, n_components=None):
+        self.dataset_id = dataset.id
+        self.drift_tolerance = drift_tolerance
+        self.n_components = n_components
+        self.method = "Procrustes"
+        self.ds_ops = None
+        self.pca = None
+        self.mean_shape = None
+        self.object_key_by_id = {}
+
+    def get_object_key_by_id(self):
+        object_key_by_id = {}
+        query = MdObject.select(MdObject.id, MdObject.object_name, MdObject.landmark_str, MdObject.property_str).where(MdObject.dataset == self.dataset_id).order_by(MdObject.id)
+        for object_id, object_name, landmark_str, property_str in query.tuples():
+            object_key_by_id[object_id] = ( landmark_str, object_name, property_str )
+        return object_key_by_id
+
+    def get_dataset_ops(self):
+        ''' a copy the caller may rescale or rotate for display '''
+        return copy.deepcopy(self.ds_ops)
+
+    def get_data_matrix(self):
+        landmark_data = self.ds_ops.get_landmark_data()
+        return landmark_data.reshape(landmark_data.shape[0], -1)
+
+    def refresh(self, callback=None):
+        ''' bring the analysis up to date with the database. returns an MdSuperimpositionResult '''
+        dataset = MdDataset.get_by_id(self.dataset_id)
+        dataset.unpack_propertyname_str()
+        object_key_by_id = self.get_object_key_by_id()
+        if self.ds_ops is None or self.ds_ops.dimension != dataset.dimension:
+            result = self.load_cache(dataset, object_key_by_id)
+            if result:
+                return result
+            return self.rebuild(dataset, object_key_by_id, callback)
+
+        removed_id_list = [ object_id for object_id in self.object_key_by_id if object_id not in object_key_by_id ]
+        changed_id_list = [ object_id for object_id, key in object_key_by_id.items() if self.object_key_by_id.get(object_id) != key ]
+        if len(removed_id_list) + len(changed_id_list) > len(object_key_by_id) / 2 or len(object_key_by_id) - len(removed_id_list) < 2:
+            # mostly new data; a full analysis is cheaper than the updates
+            return self.rebuild(dataset, object_key_by_id, callback)
+
+        begin_time = time.perf_counter()
+        result = MdSuperimpositionResult("Incremental Procrustes")
+        self.ds_ops.set_dataset_info(dataset)
+        index_by_id = { mo.id: i for i, mo in enumerate(self.ds_ops.object_list) }
+        for object_id in sorted(removed_id_list, key=lambda x: index_by_id[x], reverse=True):
+            index = index_by_id[object_id]
+            self.pca.RemoveObservation(index)
+            del self.ds_ops.object_list[index]
+            del self.object_key_by_id[object_id]
+        index_by_id = { mo.id: i for i, mo in enumerate(self.ds_ops.object_list) }
+
+        dimension = self.mean_shape.shape[1]
+        for object_id in changed_id_list:
+            mo = MdObjectOps(MdObject.get_by_id(object_id))
+            index = index_by_id.get(object_id)
+            if index is not None and self.object_key_by_id[object_id][0] == object_key_by_id[object_id][0]:
+                # name or properties only
+                mo.landmark_array = self.ds_ops.object_list[index].landmark_array
+                self.ds_ops.object_list[index] = mo
+                continue
+            if len(mo.landmark_array) != len(self.mean_shape):
+                return self.rebuild(dataset, object_key_by_id, callback)
+            self.fit_to_mean_shape(mo, dimension)
+            row = mo.landmark_array[:, :dimension].reshape(-1)
+            if index is None:
+                self.ds_ops.object_list.append(mo)
+                self.pca.AddObservation(row)
+            else:
+                self.ds_ops.object_list[index] = mo
+                self.pca.UpdateObservation(index, row)
+        self.object_key_by_id = object_key_by_id
+
+        mean_shape = self.pca.mean.reshape(self.mean_shape.shape)
+        if numpy.linalg.norm(mean_shape - self.mean_shape) > self.drift_tolerance:
+            # the consensus has moved: superimpose again, starting from the current alignment
+            result = self.superimpose(callback)
+        result.elapsed_time = time.perf_counter() - begin_time
+        return result
+
+    def rebuild(self, dataset, object_key_by_id, callback=None):
+        begin_time = time.perf_counter()
+        self.ds_ops = MdDatasetOps(dataset)
+        self.object_key_by_id = object_key_by_id
+        result = self.superimpose(callback)
+        if result and self.ds_ops is not None:
+            self.save_cache()
+        result.elapsed_time = time.perf_counter() - begin_time
+        return result
+
+    def get_cache_key(self, object_key_by_id=None):
+        if object_key_by_id is None:
+            object_key_by_id = self.object_key_by_id
+        method = self.method
+        if self.n_components is not None:
+            method += " " + str(self.n_components)
+        return MdAnalysisCache.make_cache_key(method, [ ( object_id, key[0] ) for object_id, key in object_key_by_id.items() ])
+
+    def load_cache(self, dataset, object_key_by_id):
+        begin_time = time.perf_counter()
+        result = MdSuperimpositionResult("Cached " + self.method, False)
+        cache_key = self.get_cache_key(object_key_by_id)
+        entry = MdAnalysisCache.lookup(cache_key)
+        if entry is None:
+            return result
+        ds_ops = MdDatasetOps(dataset)
+        if [ mo.id for mo in ds_ops.object_list ] != entry.get_object_id_list():
+            return result
+        aligned = unpack_array_blob(entry.aligned_blob)
+        eigen_values = unpack_array_blob(entry.eigen_value_blob)
+        rotation_matrix = unpack_array_blob(entry.rotation_matrix_blob)
+        scores = unpack_array_blob(entry.score_blob)
+        ds_ops.set_landmark_data(aligned)
+
+        self.ds_ops = ds_ops
+        self.object_key_by_id = object_key_by_id
+        self.pca = MdIncrementalPrincipalComponent(n_components=self.n_components)
+        self.pca.SetData(aligned.reshape(aligned.shape[0], -1))
+        singular_values = numpy.sqrt(eigen_values * aligned.shape[0])
+        self.pca.SetDecomposition(scores / numpy.where(singular_values > 0, singular_values, 1), singular_values, rotation_matrix)
+        self.mean_shape = self.pca.mean.reshape(aligned.shape[1], -1)
+        result.success = True
+        result.elapsed_time = time.perf_counter() - begin_time
+        return result
+
+    def save_cache(self):
+        ''' store the current results unless they are in the cache already '''
+        if self.ds_ops is None or self.pca is None:
+            return
+        cache_key = self.get_cache_key()
+        if MdAnalysisCache.select().where(MdAnalysisCache.cache_key == cache_key).exists():
+            return
+        MdAnalysisCache.store(self.dataset_id, cache_key, self.method, [ mo.id for mo in self.ds_ops.object_list ],
+                              self.ds_ops.get_landmark_data(), self.pca.raw_eigen_values, self.pca.rotation_matrix, self.pca.rotated_matrix)
+
+    def superimpose(self, callback=None):
+        result = self.ds_ops.procrustes_superimposition(callback=callback)
+        if not result or len(self.ds_ops.object_list) == 0:
+            # start from scratch next time
+            self.ds_ops = None
+            self.pca = None
+            return result
+        self.pca = MdIncrementalPrincipalComponent(n_components=self.n_components)
+        self.pca.SetData(self.get_data_matrix())
+        self.pca.Analyze()
+        self.mean_shape = self.pca.mean.reshape(len(self.ds_ops.object_list[0].landmark_array), -1)
+        return result
+
+    def fit_to_mean_shape(self, mo, dimension):
+        procrustes = MdProcrustes()
+        shape = procrustes.Normalize(mo.landmark_array[numpy.newaxis, :, :dimension])
+        mo.landmark_list = procrustes.RotateToReference(shape, self.mean_shape)[0]
+        mo.centroid_size = -1
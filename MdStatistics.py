@@ -1,89 +1,345 @@
 import numpy
+import time
+
+class MdProcrustes:
+    ''' generalized Procrustes analysis on an (n_objects, n_landmarks, dim) array
+        callback(iteration, residual) is called after every iteration; returning False stops the fit '''
+    def __init__(self, tolerance=10 ** -10, max_iteration=1000, callback=None):
+        self.tolerance = tolerance
+        self.max_iteration = max_iteration
+        self.callback = callback
+        self.nObservation = 0
+        self.nLandmark = 0
+        self.dimension = 0
+
+    def SetData(self, data):
+        self.data = numpy.array(data, dtype=numpy.float64)
+        self.nObservation, self.nLandmark, self.dimension = self.data.shape
+
+    def Analyze(self):
+        '''analyze'''
+        begin_time = time.perf_counter()
+        aligned = self.Normalize(self.data)
+
+        self.converged = False
+        self.iteration_count = 0
+        self.residual_list = []
+        self.iteration_time_list = []
+        mean_shape = None
+        previous_mean_shape = None
+        while self.iteration_count < self.max_iteration:
+            iteration_begin_time = time.perf_counter()
+            self.iteration_count += 1
+            previous_mean_shape = mean_shape
+            mean_shape = self.GetMeanShape(aligned)
+            residual = None
+            if previous_mean_shape is not None:
+                # change of the mean shape since the previous iteration
+                residual = float(numpy.linalg.norm(previous_mean_shape - mean_shape))
+                self.residual_list.append(residual)
+                if residual < self.tolerance:
+                    self.converged = True
+                    self.iteration_time_list.append(time.perf_counter() - iteration_begin_time)
+                    break
+            aligned = self.RotateToReference(aligned, mean_shape)
+            self.iteration_time_list.append(time.perf_counter() - iteration_begin_time)
+            if self.callback is not None and self.callback(self.iteration_count, residual) == False:
+                break
+
+        self.aligned_data = aligned
+        self.mean_shape = mean_shape
+        self.elapsed_time = time.perf_counter() - begin_time
+        return
+
+    def Normalize(self, data):
+        ''' move every object to the origin and scale it to unit centroid size '''
+        centered = data - data.mean(axis=1, keepdims=True)
+        centroid_size = numpy.sqrt(numpy.einsum('nij,nij->n', centered, centered))
+        centroid_size[centroid_size == 0] = 1
+        self.centroid_size = centroid_size
+        return centered / centroid_size[:, numpy.newaxis, numpy.newaxis]
+
+    def GetMeanShape(self, data):
+        return data.mean(axis=0)
+
+    def RotateToReference(self, data, reference):
+        ''' rotate every object onto the reference shape with one batched SVD '''
+        correlation_matrix = numpy.transpose(reference) @ data
+        v, s, w = numpy.linalg.svd(correlation_matrix)
+        is_reflection = ( numpy.linalg.det(v) * numpy.linalg.det(w) ) < 0.0
+        v[is_reflection, -1, :] = -v[is_reflection, -1, :]
+        rotation_matrix = v @ w
+        # rotated = ( rotation x target^T )^T for each object
+        return data @ numpy.transpose(rotation_matrix, (0, 2, 1))
+
+class MdResistantFit(MdProcrustes):
+    ''' resistant-fit theta-rho analysis (RFTRA, Rohlf and Slice 1990)
+        scale, rotation and translation of each object are repeated medians over landmark pairs '''
+    def __init__(self, tolerance=10 ** -10, max_iteration=100, callback=None):
+        super().__init__(tolerance, max_iteration, callback)
+        # number of landmark pairs handled at once, to keep the pairwise arrays small
+        self.chunk_size = 2 ** 21
+
+    def Normalize(self, data):
+        self.reference_shape = None
+        centered = data - data.mean(axis=1, keepdims=True)
+        self.centroid_size = numpy.sqrt(numpy.einsum('nij,nij->n', centered, centered))
+        return centered
+
+    def GetMeanShape(self, data):
+        mean_shape = data.mean(axis=0)
+        mean_shape = mean_shape - mean_shape.mean(axis=0)
+        centroid_size = numpy.sqrt(numpy.sum(mean_shape ** 2))
+        if centroid_size > 0:
+            mean_shape = mean_shape / centroid_size
+        if self.reference_shape is not None:
+            # keep the consensus from spinning between iterations
+            mean_shape = MdProcrustes.RotateToReference(self, mean_shape[numpy.newaxis], self.reference_shape)[0]
+        self.reference_shape = mean_shape
+        return mean_shape
+
+    def RotateToReference(self, data, reference):
+        ''' fit every object onto the reference shape '''
+        nObservation, nLandmark, dimension = data.shape
+        if nLandmark < 2:
+            return data
+        chunk = max(1, self.chunk_size // (nLandmark * nLandmark))
+        fitted = numpy.empty_like(data)
+        for begin in range(0, nObservation, chunk):
+            fitted[begin:begin+chunk] = self.FitChunk(data[begin:begin+chunk], reference)
+        return fitted
+
+    def FitChunk(self, data, reference):
+        nObservation, nLandmark, dimension = data.shape
+        # pairwise landmark vectors, leaving out i == j: (n, k, k-1, dim)
+        off_diagonal = ~numpy.eye(nLandmark, dtype=bool)
+        data_vector = (data[:, :, numpy.newaxis, :] - data[:, numpy.newaxis, :, :])[:, off_diagonal].reshape(nObservation, nLandmark, nLandmark - 1, dimension)
+        reference_vector = (reference[:, numpy.newaxis, :] - reference[numpy.newaxis, :, :])[off_diagonal].reshape(nLandmark, nLandmark - 1, dimension)
+        data_distance = numpy.linalg.norm(data_vector, axis=3)
+        reference_distance = numpy.linalg.norm(reference_vector, axis=2)
+
+        ''' scale: median over i of the median over j of distance ratios '''
+        ratio = numpy.divide(reference_distance, data_distance, out=numpy.ones_like(data_distance), where=data_distance > 0)
+        scale = numpy.median(numpy.median(ratio, axis=2), axis=1)
+
+        ''' rotation '''
+        if dimension == 2:
+            rotation_matrix = self.GetRotationMatrix2D(data_vector, reference_vector)
+        else:
+            rotation_matrix = self.GetRotationMatrix3D(data_vector, reference_vector)
+        fitted = scale[:, numpy.newaxis, numpy.newaxis] * ( data @ rotation_matrix )
+
+        ''' translation: median of the landmark displacements '''
+        fitted += numpy.median(reference[numpy.newaxis, :, :] - fitted, axis=1)[:, numpy.newaxis, :]
+        return fitted
+
+    def GetRotationMatrix2D(self, data_vector, reference_vector):
+        ''' repeated median of the angles between matching landmark vectors '''
+        cos_val = data_vector[..., 0] * reference_vector[..., 0] + data_vector[..., 1] * reference_vector[..., 1]
+        sin_val = data_vector[..., 0] * reference_vector[..., 1] - data_vector[..., 1] * reference_vector[..., 0]
+        # measure the angles around their circular mean so that values near +-pi do not wrap
+        norm = numpy.sqrt(cos_val ** 2 + sin_val ** 2)
+        norm[norm == 0] = 1
+        center = numpy.arctan2(( sin_val / norm ).sum(axis=(1, 2)), ( cos_val / norm ).sum(axis=(1, 2)))
+        cos_center = numpy.cos(center)[:, numpy.newaxis, numpy.newaxis]
+        sin_center = numpy.sin(center)[:, numpy.newaxis, numpy.newaxis]
+        angle = numpy.arctan2(sin_val * cos_center - cos_val * sin_center, cos_val * cos_center + sin_val * sin_center)
+        theta = center + numpy.median(numpy.median(angle, axis=2), axis=1)
+        cos_theta = numpy.cos(theta)
+        sin_theta = numpy.sin(theta)
+        # landmarks are row vectors: rotated = landmarks x r_mx
+        return numpy.stack([numpy.stack([cos_theta, sin_theta], axis=1), numpy.stack([-1 * sin_theta, cos_theta], axis=1)], axis=1)
+
+    def GetRotationMatrix3D(self, data_vector, reference_vector):
+        ''' one least-squares rotation per landmark from its vectors to all other landmarks,
+            then the element-wise median of those rotations projected back onto a rotation '''
+        correlation_matrix = numpy.einsum('nijk,ijl->nikl', data_vector, reference_vector)
+        v, s, w = numpy.linalg.svd(correlation_matrix)
+        is_reflection = ( numpy.linalg.det(v) * numpy.linalg.det(w) ) < 0.0
+        v[is_reflection, :, -1] = -v[is_reflection, :, -1]
+        # landmarks are row vectors: rotated = landmarks x r_mx
+        rotation_matrix = numpy.median(v @ w, axis=1)
+        v, s, w = numpy.linalg.svd(rotation_matrix)
+        is_reflection = ( numpy.linalg.det(v) * numpy.linalg.det(w) ) < 0.0
+        v[is_reflection, :, -1] = -v[is_reflection, :, -1]
+        return v @ w
 
 class MdPrincipalComponent:
-    def __init__(self):
-        # self.datamatrix = []
+    ''' PCA from a thin SVD of the mean-centered data matrix; the covariance matrix is never formed.
+        with n_components smaller than min(nObservation, nVariable) a randomized truncated SVD is used '''
+    def __init__(self, n_components=None):
+        self.n_components = n_components
+        self.nObservation = 0
+        self.nVariable = 0
         return
 
     def SetData(self, data):
-        self.data = data
-        self.nObservation = len(data)
-        self.nVariable = len(data[0])
+        self.data = numpy.array(data, dtype=numpy.float64)
+        self.nObservation, self.nVariable = self.data.shape
 
     def Analyze(self):
         '''analyze'''
-        # print "analyze"
-        self.raw_eigen_values = []
-        self.eigen_value_percentages = []
-
-        #for d in self.datamatrix :
-        #print d
-
-        sums = [0.0 for x in range(self.nVariable)]
-        avrs = [0.0 for x in range(self.nVariable)]
-        ''' calculate the empirical mean '''
-        for i in range(self.nObservation):
-            for j in range(self.nVariable):
-                sums[j] += float(self.data[i][j])
-
-        for j in range(self.nVariable):
-            avrs[j] = float(sums[j]) / float(self.nObservation)
-
-        #print "sum:", sums
-        #print "avgs:",avrs
-        #return
-
-        for i in range(self.nObservation):
-            for j in range(self.nVariable):
-                self.data[i][j] -= avrs[j]
-
-                #print self.datamatrix
-
-        log_str = ""
-
-        ''' covariance matrix '''
-        np_data = numpy.matrix(self.data)
-        self.covariance_matrix = numpy.dot(numpy.transpose(np_data), np_data) / self.nObservation
-
-        #print "covariance_matrix", self.covariance_matrix
-
-        ''' zz '''
-        v, s, w = numpy.linalg.svd(self.covariance_matrix)
-        #print "v", v
-        #print "w", w
-
-        #print "s[",
-
-        self.raw_eigen_values = s
-        sum = 0
-        for ss in s:
-            sum += ss
-        for ss in s:
-            self.eigen_value_percentages.append(ss / sum)
-        cumul = 0
-        eigen_values = []
-        i = 0
-        nSignificantEigenValue = -1
-        nEigenValues = -1
-        for ss in s:
-            cumul += ss
-            eigen_values.append(ss)
-            #print sum, cumul, ss
-            if cumul / sum > 0.95 and nSignificantEigenValue == -1:
-                nSignificantEigenValue = i + 1
-            if (ss / sum ) < 0.00001 and nEigenValues == -1:
-                nEigenValues = i + 1
-            i += 1
-
-        self.rotated_matrix = numpy.dot(np_data, v)
-        self.rotation_matrix = v
-        #print w
-        #print self.datamatrix[...,2]
-        #print self.rotated_matrix[...,2]
-        #print self.rotated_matrix
-        self.loading = v
+        self.mean = self.data.mean(axis=0)
+        centered = self.data - self.mean
+        rank = min(self.nObservation, self.nVariable)
+
+        if self.n_components is not None and self.n_components < rank:
+            u, s, vt = self.RandomizedSVD(centered, self.n_components)
+        else:
+            u, s, vt = numpy.linalg.svd(centered, full_matrices=False)
+
+        ''' eigenvalues of the covariance matrix ( X^T X / n ) '''
+        self.raw_eigen_values = s ** 2 / self.nObservation
+        total_variance = numpy.einsum('ij,ij->', centered, centered) / self.nObservation
+        if total_variance > 0:
+            self.eigen_value_percentages = ( self.raw_eigen_values / total_variance ).tolist()
+        else:
+            self.eigen_value_percentages = [ 0.0 for x in s ]
+
+        self.rotation_matrix = numpy.transpose(vt)
+        self.rotated_matrix = u * s
+        self.loading = self.rotation_matrix
         return
 
+    def RandomizedSVD(self, data, n_components, n_oversample=10, n_iteration=4, seed=0):
+        ''' Halko, Martinsson and Tropp (2011) range finder with power iterations '''
+        rng = numpy.random.default_rng(seed)
+        n_sample = min(n_components + n_oversample, min(data.shape))
+        q, r = numpy.linalg.qr(data @ rng.standard_normal((data.shape[1], n_sample)))
+        for i in range(n_iteration):
+            q, r = numpy.linalg.qr(numpy.transpose(data) @ q)
+            q, r = numpy.linalg.qr(data @ q)
+        u, s, vt = numpy.linalg.svd(numpy.transpose(q) @ data, full_matrices=False)
+        u = q @ u
+        return u[:, :n_components], s[:n_components], vt[:n_components]
+
+
+class MdIncrementalPrincipalComponent(MdPrincipalComponent):
+    ''' PCA that follows added, removed and changed observations with rank-one SVD updates (Brand 2006)
+        instead of decomposing the whole data matrix again. every refresh_interval updates it re-analyzes
+        from scratch to keep rounding errors from piling up. with n_components only that many components are kept,
+        and the analysis from scratch uses the randomized truncated SVD '''
+    def __init__(self, n_components=None, refresh_interval=100):
+        super().__init__(n_components)
+        self.refresh_interval = refresh_interval
+        self.update_count = 0
+
+    def Analyze(self):
+        '''analyze'''
+        self.mean = self.data.mean(axis=0)
+        centered = self.data - self.mean
+        if self.n_components is not None and self.n_components < min(self.nObservation, self.nVariable):
+            self.u, self.s, vt = self.RandomizedSVD(centered, self.n_components)
+        else:
+            self.u, self.s, vt = numpy.linalg.svd(centered, full_matrices=False)
+        self.v = numpy.transpose(vt)
+        self.Truncate()
+        self.update_count = 0
+        self.SetResult()
+
+    def SetDecomposition(self, u, s, v):
+        ''' restore a decomposition of the data set with SetData, e.g. from a cache '''
+        self.mean = self.data.mean(axis=0)
+        self.u = numpy.array(u, dtype=numpy.float64)
+        self.s = numpy.array(s, dtype=numpy.float64)
+        self.v = numpy.array(v, dtype=numpy.float64)
+        self.update_count = 0
+        self.SetResult()
+
+    def SetResult(self):
+        self.raw_eigen_values = self.s ** 2 / self.nObservation
+        if self.n_components is None:
+            # all min(n, p) components are kept, so the singular values add up to the total variance
+            total_variance = numpy.sum(self.s ** 2)
+        else:
+            centered = self.data - self.mean
+            total_variance = numpy.einsum('ij,ij->', centered, centered)
+        if total_variance > 0:
+            self.eigen_value_percentages = ( self.s ** 2 / total_variance ).tolist()
+        else:
+            self.eigen_value_percentages = [ 0.0 for x in self.s ]
+        self.rotation_matrix = self.v
+        self.rotated_matrix = self.u * self.s
+        self.loading = self.rotation_matrix
+
+    def AddObservation(self, row):
+        row = numpy.asarray(row, dtype=numpy.float64)
+        diff = row - self.mean
+        self.data = numpy.vstack([self.data, row])
+        self.nObservation += 1
+        self.mean = self.mean + diff / self.nObservation
+        # centered data gets a zero row, then every row moves by the change of the mean
+        self.u = numpy.vstack([self.u, numpy.zeros((1, self.u.shape[1]))])
+        a = numpy.full(self.nObservation, -1.0 / self.nObservation)
+        a[-1] += 1.0
+        self.RankOneUpdate(a, diff)
+        self.AfterUpdate()
+
+    def RemoveObservation(self, index):
+        diff = self.data[index] - self.mean
+        # move the other rows to the new mean and zero the removed row, then drop it
+        a = numpy.full(self.nObservation, 1.0 / ( self.nObservation - 1 ))
+        a[index] = -1.0
+        self.RankOneUpdate(a, diff)
+        self.data = numpy.delete(self.data, index, axis=0)
+        self.nObservation -= 1
+        self.mean = self.data.mean(axis=0)
+        u = numpy.delete(self.u, index, axis=0)
+        q, r = numpy.linalg.qr(u)
+        ur, self.s, wt = numpy.linalg.svd(r * self.s, full_matrices=False)
+        self.u = q @ ur
+        self.v = self.v @ numpy.transpose(wt)
+        self.Truncate()
+        self.AfterUpdate()
+
+    def UpdateObservation(self, index, row):
+        row = numpy.asarray(row, dtype=numpy.float64)
+        diff = row - self.data[index]
+        self.data[index] = row
+        self.mean = self.mean + diff / self.nObservation
+        a = numpy.full(self.nObservation, -1.0 / self.nObservation)
+        a[index] += 1.0
+        self.RankOneUpdate(a, diff)
+        self.AfterUpdate()
+
+    def RankOneUpdate(self, a, b):
+        ''' u s v^T + a b^T '''
+        m = numpy.transpose(self.u) @ a
+        p = a - self.u @ m
+        p_norm = numpy.linalg.norm(p)
+        p = p / p_norm if p_norm > 10 ** -12 else numpy.zeros_like(p)
+        n = numpy.transpose(self.v) @ b
+        q = b - self.v @ n
+        q_norm = numpy.linalg.norm(q)
+        q = q / q_norm if q_norm > 10 ** -12 else numpy.zeros_like(q)
+
+        rank = len(self.s)
+        k = numpy.zeros((rank + 1, rank + 1))
+        k[:rank, :rank] = numpy.diag(self.s)
+        k += numpy.outer(numpy.append(m, p_norm), numpy.append(n, q_norm))
+        uk, self.s, vkt = numpy.linalg.svd(k)
+        self.u = numpy.hstack([self.u, p[:, numpy.newaxis]]) @ uk
+        self.v = numpy.hstack([self.v, q[:, numpy.newaxis]]) @ numpy.transpose(vkt)
+        self.Truncate()
+
+    def Truncate(self):
+        # keep the numerical rank only; singular vectors of zero singular values are arbitrary
+        # and would spoil the orthogonality the next update relies on
+        rank = min(self.nObservation, self.nVariable, len(self.s))
+        if self.n_components is not None:
+            rank = min(rank, self.n_components)
+        if rank > 0 and self.s[0] > 0:
+            rank = max(1, min(rank, int(numpy.sum(self.s > self.s[0] * 10 ** -10))))
+        self.u = self.u[:, :rank]
+        self.s = self.s[:rank]
+        self.v = self.v[:, :rank]
+
+    def AfterUpdate(self):
+        self.update_count += 1
+        if self.update_count >= self.refresh_interval:
+            self.Analyze()
+        else:
+            self.SetResult()
 
 class MdCanonicalVariate:
     def __init__(self):
@@ -94,215 +350,65 @@ class MdCanonicalVariate:
         return
 
     def SetData(self, data):
-        self.data = data
-        self.nObservation = len(data)
-        self.nVariable = len(data[0])
+        self.data = numpy.array(data, dtype=numpy.float64)
+        self.nObservation, self.nVariable = self.data.shape
 
     def SetCategory(self, category_list):
         self.category_list = category_list
 
     def Analyze(self):
         '''analyze'''
-        actual_data = self.data
-        # actual_data = [ [] for y in range( self.nVariable ) ]
-        category_data = self.category_list
-        category_set = set(category_data)
+        category_set, category_index = numpy.unique(numpy.array(self.category_list, dtype=object).astype(str), return_inverse=True)
         num_category = len(category_set)
 
-        variances = [0.0 for x in range(self.nVariable)]
-        total_avg = [0.0 for x in range(self.nVariable)]
-        total_sum = [0.0 for x in range(self.nVariable)]
-        total_count = self.nObservation
-
-        #print self.nObservation, self.nVariable
-        #print category_data
-
-        avg_by_category = {}
-        sum_by_category = {}
-        count_by_category = {}
-        #print "analyze"
-        for k in list(category_set):
-            count_by_category[k] = 0
-            sum_by_category[k] = [0.0 for x in range(self.nVariable)]
-            avg_by_category[k] = [0.0 for x in range(self.nVariable)]
-
-        #print "total count:", total_count
-        #print "len category_data", len( category_data )
-        for i in range(total_count):
-            #print i
-            k = category_data[i]
-            count_by_category[k] += 1
-            for j in range(self.nVariable):
-                sum_by_category[k][j] += float(actual_data[i][j])
-                total_sum[j] += float(actual_data[i][j])
-
-        for k in list(category_set):
-            for i in range(self.nVariable):
-                avg_by_category[k][i] = sum_by_category[k][i] / count_by_category[k]
-                #print k, sum_by_category[k], avg_by_category[k]
-
-        for i in range(self.nVariable):
-            total_avg[i] = total_sum[i] * 1.0 / total_count
-        #print total_sum, total_avg
-
-        ''' check zero variance variables '''
-        for p in range(self.nVariable):
-            for idx in range(self.nObservation):
-                variances[p] += ( float(actual_data[idx][p]) - total_avg[p] ) ** 2
-
-        covariance_matrix_size = 0
-        for p in range(self.nVariable):
-            if variances[p] == 0:
-                pass
-                #print "variance = 0 for ", p, "th variable" 
-            else:
-                covariance_matrix_size += 1
-        #print "covariance_matrix_size", covariance_matrix_size
-
-        covariance_matrix = [[0.0 for x in range(covariance_matrix_size)] for y in range(covariance_matrix_size)]
-        p_ = 0
-        for p in range(self.nVariable):
-            if variances[p] == 0: continue
-            q_ = 0
-            for q in range(self.nVariable):
-                if variances[q] == 0: continue
-                for idx in range(self.nObservation):
-                    diff_p = float(actual_data[idx][p]) - total_avg[p]
-                    diff_q = float(actual_data[idx][q]) - total_avg[q]
-                    #print p_, q_
-                    covariance_matrix[p_][q_] += diff_p * diff_q / ( total_count - 1 )
-                q_ += 1
-            p_ += 1
-
-        within_cov = [[0.0 for x in range(covariance_matrix_size)] for y in range(covariance_matrix_size)]
-        between_cov = [[0.0 for x in range(covariance_matrix_size)] for y in range(covariance_matrix_size)]
-
-        within_by_category = {}
-        between_by_category = {}
-        for key in list(category_set):
-            within_by_category[key] = [0.0 for x in range(covariance_matrix_size)]
-            between_by_category[key] = [0.0 for x in range(covariance_matrix_size)]
-
-        p_ = 0
-        for p in range(self.nVariable):
-            if variances[p] == 0: continue
-            q_ = 0
-            for q in range(self.nVariable):
-                if variances[q] == 0: continue
-                for idx in range(self.nObservation):
-                    key = category_data[idx]
-                    diff_p = float(actual_data[idx][p]) - avg_by_category[key][p]
-                    diff_q = float(actual_data[idx][q]) - avg_by_category[key][q]
-                    within_cov[p_][q_] += diff_p * diff_q / ( total_count - len(category_set) )
-                q_ += 1
-            p_ += 1
-
-        '''
-        log_str = ""
-        log_str += "within:\n"
-        for line in within_cov:
-            log_str += "\t".join( [ str( x ) for x in line ] )
-            log_str += "\n"
-        '''
-        #print "within", numpy.matrix( within_cov )
-
-        p_ = 0
-        for p in range(self.nVariable):
-            if variances[p] == 0: continue
-            q_ = 0
-            for q in range(self.nVariable):
-                if variances[q] == 0: continue
-                for key in list(category_set):
-                    diff_p = avg_by_category[key][p] - total_avg[p]
-                    diff_q = avg_by_category[key][q] - total_avg[q]
-                    between_cov[p_][q_] += diff_p * diff_q * count_by_category[key] / len(category_set)
-                q_ += 1
-            p_ += 1
-
-        #set_printoptions(threshold='nan')
-        '''
-        log_str += "between:\n"
-        for line in between_cov:
-            log_str += "\t".join( [ str( x ) for x in line ] )
-            log_str += "\n"
-        print "between", numpy.matrix( between_cov )
-        '''
-
-        w = numpy.matrix(within_cov)
-        b = numpy.matrix(between_cov)
-
-        wi = w.getI()
-        #print "wi", wi
-        x = numpy.dot(wi, b)
-
-        '''
-        log_str += "WiB:\n"
-        for p in range( covariance_matrix_size ):
-            for q in range( covariance_matrix_size ):
-                log_str += str( x[p,q] ) 
-                log_str += "\t"
-            log_str += "\n"
-        '''
-
-        #print "x", x
-
-        u, s, v = numpy.linalg.svd(x)
-
-        '''
-        log_str += "rotation:\n"
-        for p in range( covariance_matrix_size ):
-            for q in range( covariance_matrix_size ):
-                log_str += str( u[p,q] ) 
-                log_str += "\t"
-            log_str += "\n"
-        '''
-
-        self.raw_eigen_values = s[:]
-        s /= sum(s)
-        self.eigen_value_percentages = s[:]
+        ''' drop zero variance variables '''
+        total_avg = self.data.mean(axis=0)
+        variances = numpy.sum(( self.data - total_avg ) ** 2, axis=0)
+        variable_mask = variances != 0
+        actual_data = self.data[:, variable_mask]
+        total_avg = total_avg[variable_mask]
+
+        ''' group means from a one-hot category matrix '''
+        one_hot = numpy.zeros((self.nObservation, num_category))
+        one_hot[numpy.arange(self.nObservation), category_index] = 1
+        count_by_category = one_hot.sum(axis=0)
+        avg_by_category = ( numpy.transpose(one_hot) @ actual_data ) / count_by_category[:, numpy.newaxis]
+
+        ''' within-group and between-group covariance '''
+        within_diff = actual_data - one_hot @ avg_by_category
+        within_cov = ( numpy.transpose(within_diff) @ within_diff ) / ( self.nObservation - num_category )
+        between_diff = avg_by_category - total_avg
+        between_cov = ( numpy.transpose(between_diff) * count_by_category ) @ between_diff / num_category
+
+        ''' generalized eigenproblem B a = lambda W a '''
+        whitening = self.GetWhiteningMatrix(within_cov)
+        eigen_values, eigen_vectors = numpy.linalg.eigh(numpy.transpose(whitening) @ between_cov @ whitening)
+        order = numpy.argsort(eigen_values)[::-1]
+        eigen_values = numpy.clip(eigen_values[order], 0, None)
+        eigen_vectors = whitening @ eigen_vectors[:, order]
+
+        self.raw_eigen_values = eigen_values
+        if eigen_values.sum() > 0:
+            self.eigen_value_percentages = eigen_values / eigen_values.sum()
+        else:
+            self.eigen_value_percentages = eigen_values
 
         rotation_matrix = numpy.zeros(( self.nVariable, self.nVariable ))
+        rotation_matrix[variable_mask, :eigen_vectors.shape[1]] = eigen_vectors
 
-        p_ = 0
-        for p in range(self.nVariable):
-            q_ = 0
-            for q in range(self.nVariable):
-                if variances[p] == 0 or variances[q] == 0:
-                    rotation_matrix[p, q] = 0.0
-                else:
-                    rotation_matrix[p, q] = u[p_, q_]
-                if variances[q] != 0:
-                    q_ += 1
-            if variances[p] != 0: p_ += 1
-
-        '''
-        log_str += "actual_rotation:\n"
-        for p in range( self.nVariable ):
-            for q in range( self.nVariable ):
-                log_str += str( rotation_matrix[p,q] ) 
-                log_str += "\t"
-            log_str += "\n"
-        '''
-
-        np_data = numpy.zeros(( self.nObservation, self.nVariable ))
-        for p in range(self.nObservation):
-            for q in range(self.nVariable):
-                np_data[p, q] = float(actual_data[p][q])
-
-        '''
-        log_str += "data:\n"
-        for p in range( self.nObservation ):
-            for q in range( self.nVariable ):
-                log_str += str( np_data[p,q] ) 
-                log_str += "\t"
-            log_str += "\n"
-        '''
         self.rotation_matrix = rotation_matrix
-        #print np_data.shape, rotation_matrix.shape
-        #fh = file( "cva_log.txt", 'w' )
-        #fh.write( log_str )
-        #fh.close()
-        self.rotated_matrix = numpy.dot(np_data, rotation_matrix)
+        self.rotated_matrix = numpy.dot(self.data, rotation_matrix)
         self.loading = rotation_matrix
         return
-        #if( i == 2 ) : print object.coords
+
+    def GetWhiteningMatrix(self, within_cov):
+        ''' matrix M with M^T W M = I, from the Cholesky factor of W.
+            a singular W (more variables than residual degrees of freedom) falls back to eigh,
+            keeping only the directions with non-zero within-group variance '''
+        try:
+            lower = numpy.linalg.cholesky(within_cov)
+            return numpy.transpose(numpy.linalg.solve(lower, numpy.identity(len(within_cov))))
+        except numpy.linalg.LinAlgError:
+            eigen_values, eigen_vectors = numpy.linalg.eigh(within_cov)
+            keep = eigen_values > eigen_values.max() * len(within_cov) * numpy.finfo(numpy.float64).eps
+            return eigen_vectors[:, keep] / numpy.sqrt(eigen_values[keep])
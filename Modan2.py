@@ -17,6 +17,7 @@ from PyQt5.QtCore import Qt, QRect, QSortFilterProxyModel, QSettings, QEvent, QR
 import math
 from PyQt5.QtCore import pyqtSlot
 import re,os,sys
+import multiprocessing
 from pathlib import Path
 from peewee import *
 import hashlib
@@ -30,7 +31,8 @@ import shutil
 
 from MdModel import *
 from ModanDialogs import DatasetAnalysisDialog, ObjectDialog, ImportDatasetDialog, DatasetDialog, PreferencesDialog, \
-    IMAGE_EXTENSION_LIST, MODE, MyGLWidget, ExportDatasetDialog, ObjectViewer2D, ProgressDialog
+    IMAGE_EXTENSION_LIST, MODE, MyGLWidget, ExportDatasetDialog, ObjectViewer2D, ProgressDialog, MdObjectTableModel, \
+    LandmarkBackfillThread, BatchImportDialog, ImageIngestThread, ImagePyramidThread
 
 #import matplotlib
 #matplotlib.use('Qt5Agg')
@@ -91,6 +93,9 @@ class ModanMainWindow(QMainWindow):
         self.actionImport = QAction(QIcon(resource_path(ICON['import'])), "Import\tCtrl+I", self)
         self.actionImport.triggered.connect(self.on_action_import_dataset_triggered)
         self.actionImport.setShortcut(QKeySequence("Ctrl+I"))
+        self.actionBatchImport = QAction(QIcon(resource_path(ICON['import'])), "Batch Import\tCtrl+Shift+I", self)
+        self.actionBatchImport.triggered.connect(self.on_action_batch_import_triggered)
+        self.actionBatchImport.setShortcut(QKeySequence("Ctrl+Shift+I"))
         self.actionExport = QAction(QIcon(resource_path(ICON['export'])), "Export\tCtrl+E", self)
         self.actionExport.triggered.connect(self.on_action_export_dataset_triggered)
         self.actionExport.setShortcut(QKeySequence("Ctrl+E"))
@@ -130,12 +135,14 @@ class ModanMainWindow(QMainWindow):
         self.data_menu.addAction(self.actionAnalyze)
         self.data_menu.addSeparator()
         self.data_menu.addAction(self.actionImport)
+        self.data_menu.addAction(self.actionBatchImport)
         self.data_menu.addAction(self.actionExport)
         self.help_menu = self.main_menu.addMenu("Help")
         self.help_menu.addAction(self.actionAbout)
 
         self.initUI()
         
+        self.child_dataset_list_by_id = {}
         self.selected_dataset = None
         self.selected_object = None
         self.check_db()
@@ -143,9 +150,53 @@ class ModanMainWindow(QMainWindow):
         self.load_dataset()
         self.m_app = QApplication.instance()
         self.read_settings()
+        if needs_image_storage_migration(self.m_app.storage_directory):
+            migrate_image_storage(self.m_app.storage_directory)
         self.statusBar = QStatusBar()
         self.setStatusBar(self.statusBar)
         self.analysis_dialog = None
+        self.backfill_thread = None
+        self.image_ingest_thread = None
+        self.garbage_image_hash_list = []
+        if needs_landmark_backfill():
+            self.backfill_thread = LandmarkBackfillThread()
+            self.backfill_thread.progress.connect(self.on_backfill_progress)
+            self.backfill_thread.finished.connect(self.on_backfill_finished)
+            self.backfill_thread.start()
+        self.pyramid_thread = None
+        self.pyramid_requested = False
+        self.request_image_pyramids()
+
+    def request_image_pyramids(self):
+        ''' starts ImagePyramidThread for stored images without a pyramid, or has it run again once it has finished '''
+        if self.pyramid_thread is not None:
+            self.pyramid_requested = True
+            return
+        self.pyramid_requested = False
+        if len(get_missing_image_pyramid_hash_list(self.m_app.storage_directory)) == 0:
+            return
+        self.pyramid_thread = ImagePyramidThread(self.m_app.storage_directory)
+        self.pyramid_thread.progress.connect(self.on_pyramid_progress)
+        self.pyramid_thread.made.connect(self.object_view_2d.on_image_pyramid_made)
+        self.pyramid_thread.finished.connect(self.on_pyramid_finished)
+        self.pyramid_thread.start()
+
+    def on_pyramid_progress(self, done, total):
+        self.statusBar.showMessage("Preparing image previews: {}/{}".format(done, total))
+
+    def on_pyramid_finished(self):
+        self.statusBar.showMessage("Image previews prepared", 2000)
+        self.pyramid_thread.wait()
+        self.pyramid_thread = None
+        if self.pyramid_requested:
+            self.request_image_pyramids()
+
+    def on_backfill_progress(self, done, total):
+        self.statusBar.showMessage("Updating landmark counts and centroid sizes: {}/{}".format(done, total))
+
+    def on_backfill_finished(self):
+        self.statusBar.showMessage("Landmark counts and centroid sizes updated", 2000)
+        self.object_model.refresh()
 
     def on_action_open_db_triggered(self):
         pass
@@ -166,10 +217,11 @@ class ModanMainWindow(QMainWindow):
         gDatabase.connect()
         tables = gDatabase.get_tables()
         if tables:
+            migrate_database()
             return
             print(tables)
         else:
-            gDatabase.create_tables([MdDataset, MdObject, MdImage, ])
+            gDatabase.create_tables([MdDataset, MdObject, MdImage, MdAnalysisCache, ])
 
     '''
     def read_settings(self):
@@ -192,6 +244,15 @@ class ModanMainWindow(QMainWindow):
     def closeEvent(self, event):
         if self.analysis_dialog is not None:
             self.analysis_dialog.close()
+        if self.backfill_thread is not None and self.backfill_thread.isRunning():
+            self.backfill_thread.requestInterruption()
+            self.backfill_thread.wait()
+        if self.pyramid_thread is not None and self.pyramid_thread.isRunning():
+            self.pyramid_thread.requestInterruption()
+            self.pyramid_thread.wait()
+        if self.image_ingest_thread is not None and self.image_ingest_thread.isRunning():
+            self.image_ingest_thread.requestInterruption()
+            self.image_ingest_thread.wait()
         event.accept()
 
     @pyqtSlot()
@@ -227,20 +288,20 @@ THE SOFTWARE IS PROVIDED "AS IS," WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLI
         if self.selected_dataset is None:
             QMessageBox.warning(self, "Warning", "No dataset selected")
             return
-        prev_lm_count = -1
-        for obj in self.selected_dataset.object_list:
-            obj.unpack_landmark()
-            lm_count = len(obj.landmark_list)
-            #print("prev_lm_count:", prev_lm_count, "lm_count:", lm_count)
-            if prev_lm_count != lm_count and prev_lm_count != -1:
-                # show messagebox and close the window
-                msg = QMessageBox()
-                msg.setIcon(QMessageBox.Critical)
-                msg.setText("Error: landmark count is not consistent")
-                msg.setWindowTitle("Error")
-                msg.exec_()
-                return
-            prev_lm_count = lm_count
+        # landmark counts are stored per object; rows not backfilled yet are counted directly
+        lm_count_set = set([ row[0] for row in MdObject.select(MdObject.landmark_count).where(MdObject.dataset == self.selected_dataset.id).distinct().tuples() ])
+        if None in lm_count_set:
+            lm_count_set.discard(None)
+            for obj in MdObject.select().where(( MdObject.dataset == self.selected_dataset.id ) & MdObject.landmark_count.is_null()):
+                lm_count_set.add(obj.count_landmarks())
+        if len(lm_count_set) > 1:
+            # show messagebox and close the window
+            msg = QMessageBox()
+            msg.setIcon(QMessageBox.Critical)
+            msg.setText("Error: landmark count is not consistent")
+            msg.setWindowTitle("Error")
+            msg.exec_()
+            return
         
         self.analysis_dialog = DatasetAnalysisDialog(self,self.selected_dataset)
         self.analysis_dialog.show()
@@ -257,7 +318,16 @@ THE SOFTWARE IS PROVIDED "AS IS," WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLI
         self.hsplitter = QSplitter(Qt.Horizontal)
         self.vsplitter = QSplitter(Qt.Vertical)
 
-        self.vsplitter.addWidget(self.tableView)
+        self.edtObjectFilter = QLineEdit()
+        self.edtObjectFilter.setPlaceholderText("Filter by name or property")
+        self.edtObjectFilter.textChanged.connect(self.on_edtObjectFilter_textChanged)
+        self.object_layout = QVBoxLayout()
+        self.object_layout.setContentsMargins(0, 0, 0, 0)
+        self.object_layout.addWidget(self.edtObjectFilter)
+        self.object_layout.addWidget(self.tableView)
+        self.object_widget = QWidget()
+        self.object_widget.setLayout(self.object_layout)
+        self.vsplitter.addWidget(self.object_widget)
         self.vsplitter.addWidget(self.object_view_2d)
         self.vsplitter.addWidget(self.object_view_3d)
 
@@ -358,13 +428,17 @@ THE SOFTWARE IS PROVIDED "AS IS," WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLI
         
         selected_object_list = self.get_selected_object_list()
         if selected_object_list:
+            md5hash_list = []
             for object in selected_object_list:
+                md5hash_list.extend([ image.md5hash for image in object.image ])
                 object.delete_instance()
+            self.release_image_hash_list(md5hash_list)
             dataset = self.selected_dataset
             self.reset_treeView()
             self.load_dataset()
             self.reset_tableView()
             self.select_dataset(dataset)
+            self.refresh_analysis_dialog(dataset)
 
     def open_dataset_menu(self, position):
         indexes = self.treeView.selectedIndexes()
@@ -394,6 +468,17 @@ THE SOFTWARE IS PROVIDED "AS IS," WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLI
         self.dlg.exec_()
         self.load_dataset()        
 
+    @pyqtSlot()
+    def on_action_batch_import_triggered(self):
+        self.open_batch_import_dialog()
+
+    def open_batch_import_dialog(self, path=''):
+        self.dlg = BatchImportDialog(self, path)
+        self.dlg.setModal(True)
+        self.dlg.setWindowModality(Qt.ApplicationModal)
+        self.dlg.exec_()
+        self.load_dataset()
+
     @pyqtSlot()
     def on_action_export_dataset_triggered(self):
         if self.selected_dataset is None:
@@ -469,6 +554,7 @@ THE SOFTWARE IS PROVIDED "AS IS," WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLI
         self.reset_tableView()
         self.select_dataset(dataset)
         self.load_object()
+        self.refresh_analysis_dialog(dataset)
 
     @pyqtSlot()
     def on_tableView_doubleClicked(self):
@@ -484,6 +570,15 @@ THE SOFTWARE IS PROVIDED "AS IS," WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLI
         self.select_dataset(dataset)
         self.load_object()
         self.object_view.clear_object()
+        self.refresh_analysis_dialog(dataset)
+
+    def refresh_analysis_dialog(self, dataset):
+        # keep an open analysis window of the same dataset in step with the edited objects
+        if self.analysis_dialog is None or not self.analysis_dialog.isVisible():
+            return
+        if dataset is None or self.analysis_dialog.dataset.id != dataset.id:
+            return
+        self.analysis_dialog.refresh_analysis()
 
     def reset_treeView(self):
         self.dataset_model = QStandardItemModel()
@@ -555,21 +650,10 @@ THE SOFTWARE IS PROVIDED "AS IS," WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLI
                 if source_object.dataset.dimension == target_dataset.dimension:
                     # if shift is pressed, move instead of copy
                     if shift_clicked:
-                        if source_object.image.count() > 0:
-                            source_image_path = source_object.image[0].get_image_path(self.m_app.storage_directory)
+                        # images are stored by md5hash, not by dataset: nothing to move on disk
                         source_dataset = source_object.dataset
                         source_object.dataset = target_dataset
                         source_object.save()
-                        if source_object.image.count() > 0:
-                            target_image = source_object.image[0]
-                            target_image_path = target_image.get_image_path(self.m_app.storage_directory)
-                            if os.path.exists(source_image_path):
-                                if not os.path.exists(os.path.dirname(target_image_path)):
-                                    os.makedirs(os.path.dirname(target_image_path))
-
-                                if os.path.exists(target_image_path):
-                                    os.remove(target_image_path)
-                                os.rename(source_image_path, target_image_path)
                     else:
                         # copy object
                         source_dataset = source_object.dataset
@@ -582,8 +666,8 @@ THE SOFTWARE IS PROVIDED "AS IS," WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLI
                         new_object.dataset = target_dataset
                         new_object.save()
                         if source_object.image.count() > 0:
+                            # the copy refers to the same stored blob
                             old_image = source_object.image[0]
-                            source_image_path = old_image.get_image_path(self.m_app.storage_directory)
                             new_image = MdImage()
                             new_image.original_path = old_image.original_path
                             new_image.original_filename = old_image.original_filename
@@ -595,14 +679,6 @@ THE SOFTWARE IS PROVIDED "AS IS," WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLI
                             new_image.file_modified = old_image.file_modified
                             new_image.object = new_object
                             new_image.save()
-                            new_image_path = new_image.get_image_path(self.m_app.storage_directory)
-                            #print(source_image_path, new_image_path)
-                            if os.path.exists(source_image_path):
-                                if not os.path.exists(os.path.dirname(new_image_path)):
-                                    os.makedirs(os.path.dirname(new_image_path))
-                                if os.path.exists(new_image_path):
-                                    os.remove(new_image_path)
-                                shutil.copyfile(source_image_path, new_image_path)
 
                 else:
                     QMessageBox.warning(self, "Warning", "Dimension mismatch")
@@ -629,21 +705,20 @@ THE SOFTWARE IS PROVIDED "AS IS," WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLI
         
         selected_object_list = []
         for index in selected_indexes:
-            item = self.object_model.itemFromIndex(index)
-            object_id = item.text()
-            object_id = int(object_id)
+            object_id = self.object_model.get_object_id(index.row())
+            if object_id is None:
+                continue
             object = MdObject.get_by_id(object_id)
             selected_object_list.append(object)
 
         return selected_object_list
 
     def reset_tableView(self):
-        self.object_model = QStandardItemModel()
-        header_labels = ["ID", "Name", "Count", "CSize"]
+        # rows are paged in from the database by the model itself
+        self.object_model = MdObjectTableModel(parent=self)
+        self.object_model.filter_text = self.edtObjectFilter.text().strip()
         if self.selected_dataset is not None:
             self.selected_dataset.unpack_propertyname_str()
-            if self.selected_dataset.propertyname_list is not None and len( self.selected_dataset.propertyname_list ) > 0:
-                header_labels.extend( self.selected_dataset.propertyname_list )
             if self.selected_dataset.dimension == 2:
                 self.object_view = self.object_view_2d
                 self.object_view_2d.show()
@@ -655,11 +730,7 @@ THE SOFTWARE IS PROVIDED "AS IS," WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLI
                 #self.vsplitter.addWidget(self.object_view_3d)
                 self.object_view_2d.hide()
                 self.object_view_3d.show()
-        self.object_model.setColumnCount(len(header_labels))
-        self.object_model.setHorizontalHeaderLabels( header_labels )
-        self.proxy_model = QSortFilterProxyModel()
-        self.proxy_model.setSourceModel(self.object_model)
-        self.tableView.setModel(self.proxy_model)
+        self.tableView.setModel(self.object_model)
         self.tableView.setColumnWidth(0, 50)
         self.tableView.setColumnWidth(1, 200)
         self.tableView.setColumnWidth(2, 50)
@@ -682,7 +753,6 @@ THE SOFTWARE IS PROVIDED "AS IS," WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLI
 
         self.tableView.setSortingEnabled(True)
         self.tableView.sortByColumn(0, Qt.AscendingOrder)
-        self.object_model.setSortRole(Qt.UserRole)
         self.clear_object_view()
 
     def tableView_drop_event(self, event):
@@ -692,7 +762,8 @@ THE SOFTWARE IS PROVIDED "AS IS," WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLI
         if len(file_name_list) == 0:
             return
 
-        QApplication.setOverrideCursor(Qt.WaitCursor)
+        directory_list = []
+        image_file_name_list = []
         for file_name in file_name_list:
             file_name = re.sub('file:///', '', file_name)
             ext = file_name.split('.')[-1].lower()
@@ -700,33 +771,60 @@ THE SOFTWARE IS PROVIDED "AS IS," WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLI
                 if self.selected_dataset.dimension != 2:
                     QMessageBox.warning(self, "Warning", "Dimension mismatch.")
                     break
-                object = MdObject()
-                object.dataset = self.selected_dataset
-                object.object_name = Path(file_name).stem
-                object.save()
-                img = MdImage()
-                img.object = object
-                img.load_file_info(file_name)
-                new_filepath = img.get_image_path( self.m_app.storage_directory)
-                if not os.path.exists(os.path.dirname(new_filepath)):
-                    os.makedirs(os.path.dirname(new_filepath))
-                shutil.copyfile(file_name, new_filepath)
-                img.save()
+                image_file_name_list.append(file_name)
 
             elif os.path.isdir(file_name):
-                self.statusBar.showMessage("Cannot process directory...",2000)
+                directory_list.append(file_name)
 
             else:
                 self.statusBar.showMessage("Nothing to import.",2000)
 
+        if len(image_file_name_list) > 0:
+            self.ingest_image_file_list(image_file_name_list)
+
+        if len(directory_list) > 0:
+            # TPS, NTS and Morphologika files in a dropped directory
+            dataset = self.selected_dataset
+            self.open_batch_import_dialog(directory_list[0])
+            self.select_dataset(dataset)
             self.load_object()
 
-        dataset = self.selected_dataset
+    def ingest_image_file_list(self, file_name_list):
+        if self.image_ingest_thread is not None:
+            self.statusBar.showMessage("Still adding the previous images...",2000)
+            return
+        self.image_ingest_dataset = self.selected_dataset
+        self.image_ingest_thread = ImageIngestThread(self.selected_dataset, file_name_list, self.m_app.storage_directory)
+        self.image_ingest_thread.progress.connect(self.on_image_ingest_progress)
+        self.image_ingest_thread.ingested.connect(self.on_image_ingest_finished)
+        self.image_ingest_thread.start()
+
+    def on_image_ingest_progress(self, done, total):
+        self.statusBar.showMessage("Adding images: {}/{}".format(done, total))
+
+    def on_image_ingest_finished(self, object_count, error_list):
+        self.image_ingest_thread.wait()
+        self.image_ingest_thread = None
+        self.release_image_hash_list([])
+        self.request_image_pyramids()
+        self.statusBar.showMessage("Added {} images".format(object_count), 2000)
+        # the table is refreshed once for the whole drop
+        dataset = self.image_ingest_dataset
         self.load_dataset()
         self.reset_tableView()
         self.select_dataset(dataset)
         self.load_object()
-        QApplication.restoreOverrideCursor()
+        if len(error_list) > 0:
+            QMessageBox.warning(self, "Warning", "Some images could not be added.\n" + "\n".join(error_list[:20]))
+
+    def release_image_hash_list(self, md5hash_list):
+        ''' collects the stored images of deleted objects. blobs of a drop that is still being ingested
+            have no rows yet, so garbage is collected only after the drop has been committed '''
+        self.garbage_image_hash_list.extend(md5hash_list)
+        if self.image_ingest_thread is not None:
+            return
+        collect_image_garbage(self.m_app.storage_directory, self.garbage_image_hash_list)
+        self.garbage_image_hash_list = []
 
     def tableView_drag_enter_event(self, event):
         event.accept()
@@ -779,10 +877,11 @@ THE SOFTWARE IS PROVIDED "AS IS," WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLI
     def load_dataset(self):
         self.dataset_model.clear()
         self.selected_dataset = None
-        all_record = MdDataset.filter(parent=None)
+        # the whole tree and the object counts come from one query
+        all_record, self.child_dataset_list_by_id = load_dataset_tree()
         for rec in all_record:
             rec.unpack_wireframe()
-            item1 = QStandardItem(rec.dataset_name + " (" + str(rec.object_list.count()) + ")")
+            item1 = QStandardItem(rec.dataset_name + " (" + str(rec.object_count) + ")")
             if rec.dimension == 2:
                 item1.setIcon(QIcon(resource_path(ICON['dataset_2d'])))
             else:
@@ -791,17 +890,17 @@ THE SOFTWARE IS PROVIDED "AS IS," WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLI
             item1.setData(rec)
             
             self.dataset_model.appendRow([item1,item2])#,item2,item3] )
-            if rec.children.count() > 0:
+            if rec.id in self.child_dataset_list_by_id:
                 self.load_subdataset(item1,item1.data())
         self.treeView.expandAll()
         self.treeView.hideColumn(1)
         #self.treeView.setIconSize(QSize(16,16))
 
     def load_subdataset(self, parent_item, dataset):
-        all_record = MdDataset.filter(parent=dataset)
+        all_record = self.child_dataset_list_by_id.get(dataset.id, [])
         for rec in all_record:
             rec.unpack_wireframe()
-            item1 = QStandardItem(rec.dataset_name + " (" + str(rec.object_list.count()) + ")")
+            item1 = QStandardItem(rec.dataset_name + " (" + str(rec.object_count) + ")")
             if rec.dimension == 2:
                 item1.setIcon(QIcon(resource_path(ICON['dataset_2d']))) 
             else:
@@ -809,49 +908,28 @@ THE SOFTWARE IS PROVIDED "AS IS," WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLI
             item2 = QStandardItem(str(rec.id))
             item1.setData(rec)
             parent_item.appendRow([item1,item2])#,item3] )
-            if rec.children.count() > 0:
+            if rec.id in self.child_dataset_list_by_id:
                 self.load_subdataset(item1,item1.data())
 
     def on_dataset_selection_changed(self, selected, deselected):
         indexes = selected.indexes()
         #print(indexes)
         if indexes:
-            self.object_model.clear()
             item1 =self.dataset_model.itemFromIndex(indexes[0])
             ds = item1.data()
             self.selected_dataset = ds
             self.load_object()
 
     def load_object(self):
-        self.object_model.clear()
         self.reset_tableView()
         #print("load_object")
         self.clear_object_view()
         if self.selected_dataset is None:
             return
+        self.object_model.set_dataset(self.selected_dataset)
 
-        for obj in self.selected_dataset.object_list:
-            item1 = QStandardItem()
-            item1.setData(obj.id,Qt.DisplayRole)
-            item2 = QStandardItem(obj.object_name)
-            lm_count = obj.count_landmarks()
-            item3 = QStandardItem()
-            item3.setData(lm_count,Qt.DisplayRole)
-            item4 = QStandardItem()
-            item4.setData('',Qt.DisplayRole)
-            item_list = [item1,item2,item3,item4]
-            if len(self.selected_dataset.propertyname_list) > 0:
-                property_list = obj.unpack_property()
-
-                for idx,prop in enumerate(self.selected_dataset.propertyname_list):
-                    item = QStandardItem()
-                    if idx < len(property_list):
-                        item.setData(property_list[idx],Qt.DisplayRole)
-                    else:
-                        item.setData('',Qt.DisplayRole)
-                    item_list.append(item)
-
-            self.object_model.appendRow(item_list)
+    def on_edtObjectFilter_textChanged(self, text):
+        self.object_model.set_filter_text(text)
 
     def on_object_selection_changed(self, selected, deselected):
         selected_object_list = self.get_selected_object_list()
@@ -874,6 +952,8 @@ THE SOFTWARE IS PROVIDED "AS IS," WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLI
         self.object_view.clear_object()
 
 if __name__ == "__main__":
+    # batch import parses files in worker processes; a frozen executable must start them instead of another main window
+    multiprocessing.freeze_support()
     #QApplication : 프로그램을 실행시켜주는 클래스
     app = QApplication(sys.argv)
     app.setWindowIcon(QIcon(resource_path('icons/Modan2_2.png')))
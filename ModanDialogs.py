@@ -8,9 +8,9 @@ from PyQt5.QtWidgets import QTableWidgetItem, QMainWindow, QHeaderView, QFileDia
 
 from PyQt5 import QtGui, uic
 from PyQt5.QtGui import QIcon, QColor, QPainter, QPen, QPixmap, QStandardItemModel, QStandardItem,\
-                        QPainterPath, QFont, QImageReader, QPainter, QBrush, QMouseEvent, QWheelEvent, QDrag, QDoubleValidator
-from PyQt5.QtCore import Qt, QRect, QSortFilterProxyModel, QSettings, QEvent, QRegExp, QSize, QPoint,\
-                         pyqtSignal, QThread, QMimeData, pyqtSlot, QItemSelectionModel, QTimer
+                        QPainterPath, QFont, QImageReader, QImageIOHandler, QImage, QPainter, QBrush, QMouseEvent, QWheelEvent, QDrag, QDoubleValidator
+from PyQt5.QtCore import Qt, QRect, QRectF, QSortFilterProxyModel, QSettings, QEvent, QRegExp, QSize, QPoint,\
+                         pyqtSignal, QThread, QThreadPool, QRunnable, QObject, QMimeData, pyqtSlot, QItemSelectionModel, QTimer, QAbstractTableModel, QModelIndex
 
 import pyqtgraph as pg
 #import pyqtgraph.opengl as gl
@@ -26,18 +26,20 @@ import random
 import struct
 import xlsxwriter
 
-import math, re, os
+import math, re, os, glob, time
+import concurrent.futures
+import multiprocessing
 from pathlib import Path
 from PIL import Image
 from PIL.ExifTags import TAGS
 import shutil
+from collections import OrderedDict
 #import matplotlib.pyplot as plt
 from matplotlib.backends.backend_qt5agg import FigureCanvas as FigureCanvas
 from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
 from matplotlib.figure import Figure
 
 from MdModel import *
-from MdStatistics import MdPrincipalComponent
 import numpy as np
 from OpenGL.arrays import vbo
 
@@ -88,6 +90,10 @@ COLOR['WIREFRAME'] = COLOR['YELLOW']
 COLOR['SELECTED_EDGE'] = COLOR['RED']
 COLOR['BACKGROUND'] = COLOR['DARK_GRAY']
 
+''' the analysis dialog keeps at most this many principal components; larger data sets
+    get them from a randomized truncated SVD instead of a full one '''
+PCA_COMPONENT_COUNT = 50
+
 ICON = {}
 ICON['landmark'] = resource_path('icons/M2Landmark_2.png')
 ICON['landmark_hover'] = resource_path('icons/M2Landmark_2_hover.png')
@@ -138,14 +144,87 @@ class ProgressDialog(QDialog):
         self.update()
         QApplication.processEvents()
 
+class MdPixmapCache:
+    ''' decoded pixmaps by key, least recently used first out once max_cost bytes are exceeded.
+        the key is a file path unless a loader makes the pixmap '''
+    def __init__(self, max_cost=256 * 1024 * 1024):
+        self.max_cost = max_cost
+        self.cost = 0
+        self.pixmap_by_key = OrderedDict()
+
+    def contains(self, key):
+        return key in self.pixmap_by_key
+
+    def get(self, key, loader=None):
+        if key in self.pixmap_by_key:
+            self.pixmap_by_key.move_to_end(key)
+            return self.pixmap_by_key[key]
+        if loader is None:
+            pixmap = QPixmap(key)
+        else:
+            pixmap = loader()
+        self.pixmap_by_key[key] = pixmap
+        self.cost += self.get_pixmap_cost(pixmap)
+        # the pixmap just loaded is always kept
+        while self.cost > self.max_cost and len(self.pixmap_by_key) > 1:
+            old_key, old_pixmap = self.pixmap_by_key.popitem(last=False)
+            self.cost -= self.get_pixmap_cost(old_pixmap)
+        return pixmap
+
+    def get_pixmap_cost(self, pixmap):
+        return pixmap.width() * pixmap.height() * 4
+
+gPixmapCache = MdPixmapCache()
+
+IMAGE_TILE_SIZE = 256
+gTileCache = MdPixmapCache(max_cost=64 * 1024 * 1024)
+
+class MdImageDecodeTask(QRunnable):
+    def __init__(self, loader, path):
+        super().__init__()
+        self.loader = loader
+        self.path = path
+
+    def run(self):
+        # QImage, unlike QPixmap, can be made outside the GUI thread
+        self.loader.decoded.emit(self.path, QImage(self.path))
+
+class MdImageLevelLoader(QObject):
+    ''' decodes image files in the global thread pool and puts them in gPixmapCache on the GUI thread.
+        loaded(path) is emitted once the pixmap is in the cache '''
+    decoded = pyqtSignal(str, QImage)
+    loaded = pyqtSignal(str)
+
+    def __init__(self):
+        super().__init__()
+        self.pending_path_set = set()
+        self.decoded.connect(self.on_decoded)
+
+    def load(self, path):
+        if path in self.pending_path_set or gPixmapCache.contains(path):
+            return
+        self.pending_path_set.add(path)
+        QThreadPool.globalInstance().start(MdImageDecodeTask(self, path))
+
+    def on_decoded(self, path, image):
+        self.pending_path_set.discard(path)
+        gPixmapCache.get(path, lambda: QPixmap.fromImage(image))
+        self.loaded.emit(path)
+
+gImageLevelLoader = MdImageLevelLoader()
+
 class ObjectViewer2D(QLabel):
     def __init__(self, widget):
         super(ObjectViewer2D, self).__init__(widget)
         self.setMinimumSize(400,300)
         self.object_dialog = None
         self.object = None
-        self.orig_pixmap = None
-        self.curr_pixmap = None
+        self.image_level_list = []
+        self.image_level_path = None
+        self.preview_pixmap = None
+        self.md5hash = None
+        # connected only while an image is shown, see clear_object
+        self.level_loader_connected = False
         self.scale = 1.0
         self.fullpath = None
         self.pan_mode = MODE['NONE']
@@ -329,7 +408,7 @@ class ObjectViewer2D(QLabel):
             if self.edit_mode == MODE['EDIT_LANDMARK']:
                 img_x = self._2imgx(self.mouse_curr_x)
                 img_y = self._2imgy(self.mouse_curr_y)
-                if img_x < 0 or img_x > self.orig_pixmap.width() or img_y < 0 or img_y > self.orig_pixmap.height():
+                if img_x < 0 or img_x > self.orig_width or img_y < 0 or img_y > self.orig_height:
                     return
                 self.object_dialog.add_landmark(img_x, img_y)
             elif self.edit_mode == MODE['READY_MOVE_LANDMARK']:
@@ -413,8 +492,7 @@ class ObjectViewer2D(QLabel):
         self.scale += scale_delta
         self.scale = round(self.scale * 10) / 10
         scale_proportion = self.scale / prev_scale
-        if self.orig_pixmap is not None:
-            self.curr_pixmap = self.orig_pixmap.scaled(int(self.orig_pixmap.width() * self.scale / self.image_canvas_ratio), int(self.orig_pixmap.height() * self.scale / self.image_canvas_ratio))
+        self.update_curr_pixmap()
 
         self.pan_x = int( we.pos().x() - (we.pos().x() - self.pan_x) * scale_proportion )
         self.pan_y = int( we.pos().y() - (we.pos().y() - self.pan_y) * scale_proportion )
@@ -450,11 +528,8 @@ class ObjectViewer2D(QLabel):
         painter.fillRect(self.rect(), QBrush(as_qt_color(COLOR['BACKGROUND'])))
         if self.object is None:
             return
-        if self.curr_pixmap is not None:
-            #print("paintEvent", self.curr_pixmap.width(), self.curr_pixmap.height())
-            painter.drawPixmap(self.pan_x+self.temp_pan_x, self.pan_y+self.temp_pan_y,self.curr_pixmap)
-            #print("paintEvent", self.pan_x+self.temp_pan_x, self.pan_y+self.temp_pan_y,self.curr_pixmap.width(), self.curr_pixmap.height())
-            #print("pan_x", self.pan_x, "pan_y", self.pan_y, "temp_pan_x", self.temp_pan_x, "temp_pan_y", self.temp_pan_y)
+        if self.image_level_path is not None:
+            self.draw_image(painter)
 
         if self.show_wireframe == True:
             painter.setPen(QPen(as_qt_color(COLOR['WIREFRAME']), 2))
@@ -560,16 +635,14 @@ class ObjectViewer2D(QLabel):
 
     def calculate_resize(self):
         #print("objectviewer calculate resize", self, self.object, self.object.landmark_list, self.landmark_list)
-        if self.orig_pixmap is not None:
-            self.orig_width = self.orig_pixmap.width()
-            self.orig_height = self.orig_pixmap.height()
+        if len(self.image_level_list) > 0:
             image_wh_ratio = self.orig_width / self.orig_height
             label_wh_ratio = self.width() / self.height()
             if image_wh_ratio > label_wh_ratio:
                 self.image_canvas_ratio = self.orig_width / self.width()
             else:
                 self.image_canvas_ratio = self.orig_height / self.height()
-            self.curr_pixmap = self.orig_pixmap.scaled(int(self.orig_width*self.scale/self.image_canvas_ratio),int(self.orig_width*self.scale/self.image_canvas_ratio), Qt.KeepAspectRatio)
+            self.update_curr_pixmap()
         else:
             if len(self.landmark_list) < 2:
                 return
@@ -610,23 +683,148 @@ class ObjectViewer2D(QLabel):
         if self.object.pixels_per_mm is not None and self.object.pixels_per_mm > 0:
             self.pixels_per_mm = self.object.pixels_per_mm
         if object.image.count() > 0:
-            self.set_image(object.image[0].get_file_path(m_app.storage_directory))
+            self.set_image(object.image[0].get_file_path(m_app.storage_directory), object.image[0].md5hash)
         object.unpack_landmark()
         object.dataset.unpack_wireframe()
         self.landmark_list = object.landmark_list
         self.edge_list = object.dataset.edge_list
         self.calculate_resize()
 
-    def set_image(self,file_path):
+    def set_image(self,file_path,md5hash=None):
+        ''' images in the blob store are shown from the pyramid level that covers the current zoom;
+            other files, e.g. one dropped on the viewer, from the file itself '''
         self.fullpath = file_path
-        self.curr_pixmap = self.orig_pixmap = QPixmap(file_path)
-        self.setPixmap(self.curr_pixmap)
+        self.md5hash = md5hash
+        self.image_level_path = None
+        # the size is read from the header; nothing is decoded yet
+        image_size = QImageReader(file_path).size()
+        self.orig_width = image_size.width()
+        self.orig_height = image_size.height()
+        self.image_level_list = [ (1, file_path) ]
+        self.preview_pixmap = None
+        if self.orig_width <= 0 or self.orig_height <= 0:
+            self.image_level_list = []
+            return
+        if md5hash is not None:
+            storage_directory = QApplication.instance().storage_directory
+            if file_path == get_image_blob_path(storage_directory, md5hash):
+                # pyramids of images stored before they existed are made by ImagePyramidThread
+                self.image_level_list = get_image_pyramid(storage_directory, md5hash)
+                thumbnail_path = get_image_thumbnail_path(storage_directory, md5hash)
+                if os.path.exists(thumbnail_path):
+                    self.preview_pixmap = gPixmapCache.get(thumbnail_path)
+        if self.preview_pixmap is None:
+            self.preview_pixmap = self.read_preview_pixmap(file_path)
+
+    def read_preview_pixmap(self, file_path):
+        ''' a thumbnail sized preview of a JPEG, which can be decoded at a reduced size '''
+        reader = QImageReader(file_path)
+        # other handlers, e.g. PNG, report ScaledSize but scale after decoding the whole image
+        if reader.format() not in (b'jpeg', b'jpg') or not reader.supportsOption(QImageIOHandler.ScaledSize):
+            return None
+        reader.setScaledSize(reader.size().scaled(IMAGE_THUMBNAIL_SIZE, IMAGE_THUMBNAIL_SIZE, Qt.KeepAspectRatio))
+        image = reader.read()
+        if image.isNull():
+            return None
+        return QPixmap.fromImage(image)
+
+    def on_image_pyramid_made(self, md5hash):
+        if self.object is None or md5hash != self.md5hash:
+            return
+        self.set_image(self.fullpath, md5hash)
+        self.update_curr_pixmap()
+        self.repaint()
+
+    def get_image_level_path(self, display_width):
+        ''' the smallest level that is at least display_width wide '''
+        level_path = self.image_level_list[0][1]
+        for factor, path in self.image_level_list:
+            if self.orig_width / factor < display_width:
+                break
+            level_path = path
+        return level_path
+
+    def get_display_size(self):
+        display_width = max(1, int(self.orig_width * self.scale / self.image_canvas_ratio))
+        display_height = max(1, int(self.orig_height * self.scale / self.image_canvas_ratio))
+        return display_width, display_height
+
+    def update_curr_pixmap(self):
+        ''' pick the pyramid level for the current zoom; paintEvent draws it tile by tile once it has been decoded '''
+        if len(self.image_level_list) == 0:
+            return
+        display_width, display_height = self.get_display_size()
+        self.image_level_path = self.get_image_level_path(display_width)
+        if not self.level_loader_connected:
+            gImageLevelLoader.loaded.connect(self.on_image_level_loaded)
+            self.level_loader_connected = True
+        gImageLevelLoader.load(self.image_level_path)
+
+    def on_image_level_loaded(self, path):
+        if path in [ level_path for factor, level_path in self.image_level_list ]:
+            self.repaint()
+
+    def get_drawable_level_path(self):
+        ''' the level for the current zoom, or while it is being decoded the next coarser level that is already decoded '''
+        level_path_list = [ level_path for factor, level_path in self.image_level_list ]
+        for level_path in level_path_list[level_path_list.index(self.image_level_path):]:
+            if gPixmapCache.contains(level_path):
+                return level_path
+        return None
+
+    def draw_image(self, painter):
+        ''' only the tiles of the zoomed image that intersect the widget are drawn '''
+        display_width, display_height = self.get_display_size()
+        offset_x = self.pan_x + self.temp_pan_x
+        offset_y = self.pan_y + self.temp_pan_y
+        level_path = self.get_drawable_level_path()
+        if level_path is None:
+            if self.preview_pixmap is not None:
+                painter.drawPixmap(QRect(offset_x, offset_y, display_width, display_height), self.preview_pixmap, self.preview_pixmap.rect())
+            return
+        left = max(0, -offset_x)
+        top = max(0, -offset_y)
+        right = min(display_width, self.width() - offset_x)
+        bottom = min(display_height, self.height() - offset_y)
+        if left >= right or top >= bottom:
+            return
+        for tile_y in range(top // IMAGE_TILE_SIZE, (bottom - 1) // IMAGE_TILE_SIZE + 1):
+            for tile_x in range(left // IMAGE_TILE_SIZE, (right - 1) // IMAGE_TILE_SIZE + 1):
+                tile = self.get_image_tile(level_path, display_width, display_height, tile_x, tile_y)
+                painter.drawPixmap(offset_x + tile_x * IMAGE_TILE_SIZE, offset_y + tile_y * IMAGE_TILE_SIZE, tile)
+
+    def get_image_tile(self, level_path, display_width, display_height, tile_x, tile_y):
+        ''' a tile of a decoded level scaled to the display size, cut once per zoom '''
+        def make_tile():
+            level_pixmap = gPixmapCache.get(level_path)
+            ratio_x = level_pixmap.width() / display_width
+            ratio_y = level_pixmap.height() / display_height
+            x = tile_x * IMAGE_TILE_SIZE
+            y = tile_y * IMAGE_TILE_SIZE
+            width = min(IMAGE_TILE_SIZE, display_width - x)
+            height = min(IMAGE_TILE_SIZE, display_height - y)
+            tile = QPixmap(width, height)
+            tile.fill(Qt.transparent)
+            tile_painter = QPainter(tile)
+            # pixels stay sharp when zoomed past the full resolution image
+            tile_painter.setRenderHint(QPainter.SmoothPixmapTransform, ratio_x > 1)
+            tile_painter.drawPixmap(QRectF(0, 0, width, height), level_pixmap, QRectF(x * ratio_x, y * ratio_y, width * ratio_x, height * ratio_y))
+            tile_painter.end()
+            return tile
+        return gTileCache.get((level_path, display_width, display_height, tile_x, tile_y), make_tile)
 
     def clear_object(self):
         self.landmark_list = []
         self.edge_list = []
-        self.orig_pixmap = None
-        self.curr_pixmap = None
+        self.image_level_path = None
+        self.image_level_list = []
+        self.preview_pixmap = None
+        self.md5hash = None
+        self.orig_width = -1
+        self.orig_height = -1
+        if self.level_loader_connected:
+            gImageLevelLoader.loaded.disconnect(self.on_image_level_loaded)
+            self.level_loader_connected = False
         self.object = None
         self.pan_x = 0
         self.pan_y = 0
@@ -1068,7 +1266,7 @@ class ObjectDialog(QDialog):
                     image_path = img.get_file_path(self.m_app.storage_directory)
                     #check if image_path exists
                     if os.path.exists(image_path):
-                        self.object_view.set_image(image_path)
+                        self.object_view.set_image(image_path, img.md5hash)
                     self.object_view.set_mode(MODE['EDIT_LANDMARK'])
                     self.btnCalibration.setEnabled(True)
                     self.btnLandmark.setEnabled(True)
@@ -1186,13 +1384,9 @@ class ObjectDialog(QDialog):
         if self.object_view_2d.fullpath is not None and self.object.image.count() == 0:
             md_image = MdImage()
             md_image.object_id = self.object.id
-            md_image.load_file_info(self.object_view_2d.fullpath)
-            new_filepath = md_image.get_file_path( self.m_app.storage_directory)
-            if not os.path.exists(os.path.dirname(new_filepath)):
-                os.makedirs(os.path.dirname(new_filepath))
-            #print("save object new filepath:", new_filepath)
-            shutil.copyfile(self.object_view_2d.fullpath, new_filepath)
+            md_image.ingest_file(self.object_view_2d.fullpath, self.m_app.storage_directory)
             md_image.save()
+            self.parent.request_image_pyramids()
 
     def make_landmark_str(self):
         # from table, make landmark_str
@@ -1209,11 +1403,10 @@ class ObjectDialog(QDialog):
     def Delete(self):
         ret = QMessageBox.question(self, "", "Are you sure to delete this object?", QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
         if ret == QMessageBox.Yes:
-            if self.object.image.count() > 0:
-                image_path = self.object.image[0].get_file_path(self.m_app.storage_directory)
-                if os.path.exists(image_path):
-                    os.remove(image_path)
+            # the stored image may be shared with copies of this object
+            md5hash_list = [ image.md5hash for image in self.object.image ]
             self.object.delete_instance()
+            self.parent.release_image_hash_list(md5hash_list)
         #self.delete_dataset()
         self.accept()
 
@@ -1224,6 +1417,11 @@ class ObjectDialog(QDialog):
     def Cancel(self):
         self.reject()
 
+    def done(self, result):
+        # the dialog is dropped once closed; its viewer must not stay connected to gImageLevelLoader
+        self.object_view_2d.clear_object()
+        super().done(result)
+
     def resizeEvent(self, event):
         #print("Window has been resized",self.image_label.width(), self.image_label.height())
         #self.pixmap.scaled(self.image_label.width(), self.image_label.height(), Qt.KeepAspectRatio)
@@ -2085,6 +2283,246 @@ class MyGLWidget(QGLWidget):
 
         return distance
 
+class MdObjectTableModel(QAbstractTableModel):
+    ''' objects of a dataset for the main window table. the ordered list of object ids is queried once per sort or filter;
+        rows are fetched by id a page at a time as the view scrolls and only max_page_count pages are kept.
+        landmark count and centroid size come from the stored MdObject columns '''
+    def __init__(self, dataset=None, parent=None, page_size=256, max_page_count=16):
+        super().__init__(parent)
+        self.page_size = page_size
+        self.max_page_count = max_page_count
+        self.sort_column = 0
+        self.sort_order = Qt.AscendingOrder
+        self.filter_text = ''
+        self.page_cache = OrderedDict()
+        self.object_id_list = []
+        self.row_count = 0
+        self.set_dataset(dataset)
+
+    def set_dataset(self, dataset):
+        self.beginResetModel()
+        self.dataset = dataset
+        self.header_labels = ["ID", "Name", "Count", "CSize"]
+        self.propertyname_list = []
+        if dataset is not None:
+            self.propertyname_list = dataset.unpack_propertyname_str()
+            self.header_labels.extend(self.propertyname_list)
+        self.reset_cache()
+        self.endResetModel()
+
+    def refresh(self):
+        self.beginResetModel()
+        self.reset_cache()
+        self.endResetModel()
+
+    def reset_cache(self):
+        self.page_cache.clear()
+        self.object_id_list = []
+        if self.dataset is not None:
+            # sorting by a property runs md_property on every row, so it is done once here and not per page
+            query = self.get_query().select(MdObject.id).order_by(*self.get_order_by()).tuples()
+            self.object_id_list = [ object_id for object_id, in query ]
+        self.row_count = len(self.object_id_list)
+
+    def set_filter_text(self, filter_text):
+        self.filter_text = filter_text.strip()
+        self.refresh()
+
+    def get_query(self):
+        query = MdObject.select(MdObject.id, MdObject.object_name, MdObject.landmark_count, MdObject.centroid_size, MdObject.property_str).where(MdObject.dataset == self.dataset.id)
+        if self.filter_text != '':
+            query = query.where(MdObject.object_name.contains(self.filter_text) | MdObject.property_str.contains(self.filter_text))
+        return query
+
+    def get_order_by(self):
+        if self.sort_column == 1:
+            order_field = MdObject.object_name
+        elif self.sort_column == 2:
+            order_field = MdObject.landmark_count
+        elif self.sort_column == 3:
+            order_field = MdObject.centroid_size
+        elif self.sort_column >= 4:
+            order_field = fn.md_property(MdObject.property_str, self.sort_column - 4)
+        else:
+            order_field = MdObject.id
+        if self.sort_order == Qt.DescendingOrder:
+            return [ order_field.desc(), MdObject.id.desc() ]
+        return [ order_field.asc(), MdObject.id.asc() ]
+
+    def get_page(self, page_index):
+        if page_index in self.page_cache:
+            self.page_cache.move_to_end(page_index)
+            return self.page_cache[page_index]
+        page_id_list = self.object_id_list[page_index * self.page_size:(page_index + 1) * self.page_size]
+        object_by_id = { obj.id: obj for obj in self.get_query().where(MdObject.id.in_(page_id_list)) }
+        row_list = []
+        for object_id in page_id_list:
+            obj = object_by_id.get(object_id)
+            if obj is None:
+                # deleted since the id list was queried
+                row_list.append([ object_id, '', None, None ] + [ '' ] * len(self.propertyname_list))
+                continue
+            property_list = obj.unpack_property()
+            row_list.append([ obj.id, obj.object_name, obj.landmark_count, obj.centroid_size ] + [ property_list[i] if i < len(property_list) else '' for i in range(len(self.propertyname_list)) ])
+        self.page_cache[page_index] = row_list
+        while len(self.page_cache) > self.max_page_count:
+            self.page_cache.popitem(last=False)
+        return row_list
+
+    def get_row(self, row):
+        row_list = self.get_page(row // self.page_size)
+        if row % self.page_size < len(row_list):
+            return row_list[row % self.page_size]
+        return None
+
+    def get_object_id(self, row):
+        if row < 0 or row >= len(self.object_id_list):
+            return None
+        return self.object_id_list[row]
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return self.row_count
+
+    def columnCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.header_labels)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal and section < len(self.header_labels):
+            return self.header_labels[section]
+        return None
+
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.NoItemFlags
+        return Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsDragEnabled
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or role != Qt.DisplayRole:
+            return None
+        row_data = self.get_row(index.row())
+        if row_data is None or index.column() >= len(row_data):
+            return None
+        value = row_data[index.column()]
+        if index.column() in [2, 3] and value is None:
+            # not backfilled yet
+            return ''
+        if index.column() == 3:
+            return round(value, 4)
+        return value
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        self.layoutAboutToBeChanged.emit()
+        # the selection and current index follow their objects to the new rows
+        old_index_list = self.persistentIndexList()
+        old_id_list = [ self.get_object_id(index.row()) for index in old_index_list ]
+        self.sort_column = column
+        self.sort_order = order
+        self.reset_cache()
+        row_by_id = { object_id: row for row, object_id in enumerate(self.object_id_list) }
+        new_index_list = []
+        for index, object_id in zip(old_index_list, old_id_list):
+            if object_id in row_by_id:
+                new_index_list.append(self.index(row_by_id[object_id], index.column()))
+            else:
+                new_index_list.append(QModelIndex())
+        self.changePersistentIndexList(old_index_list, new_index_list)
+        self.layoutChanged.emit()
+
+class LandmarkBackfillThread(QThread):
+    ''' fills the landmark_count and centroid_size columns of objects saved by older versions '''
+    progress = pyqtSignal(int, int)
+
+    def run(self):
+        try:
+            backfill_landmark_columns(callback=self.on_progress)
+        finally:
+            # connections are per thread
+            gDatabase.close()
+
+    def on_progress(self, done, total):
+        self.progress.emit(done, total)
+        return not self.isInterruptionRequested()
+
+class ImagePyramidThread(QThread):
+    ''' makes the pyramids of stored images that have none yet, one image at a time, so neither the viewer
+        nor the image ingest has to '''
+    progress = pyqtSignal(int, int)
+    made = pyqtSignal(str)
+
+    def __init__(self, storage_directory, parent=None):
+        super().__init__(parent)
+        self.storage_directory = storage_directory
+
+    def run(self):
+        make_missing_image_pyramids(self.storage_directory, callback=self.on_progress)
+
+    def on_progress(self, done, total, md5hash):
+        self.made.emit(md5hash)
+        self.progress.emit(done, total)
+        return not self.isInterruptionRequested()
+
+class ImageIngestThread(QThread):
+    ''' hashes, reads EXIF from and stores dropped image files in a thread pool, then adds one object per image
+        to the dataset in a single transaction '''
+    progress = pyqtSignal(int, int)
+    ingested = pyqtSignal(int, list)
+
+    def __init__(self, dataset, file_name_list, storage_directory, max_workers=None, parent=None):
+        super().__init__(parent)
+        self.dataset = dataset
+        self.file_name_list = file_name_list
+        self.storage_directory = storage_directory
+        self.max_workers = max_workers if max_workers is not None else min(8, os.cpu_count() or 1)
+
+    def run(self):
+        image_list = []
+        error_list = []
+        object_count = 0
+        try:
+            # file I/O and hashing release the GIL; the workers do not touch the database
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                future_by_file_name = { executor.submit(self.ingest_file, file_name): file_name for file_name in self.file_name_list }
+                for future in concurrent.futures.as_completed(future_by_file_name):
+                    file_name = future_by_file_name[future]
+                    try:
+                        image_list.append((file_name, future.result()))
+                    except Exception as e:
+                        error_list.append(Path(file_name).name + ": " + str(e))
+                    self.progress.emit(len(image_list) + len(error_list), len(self.file_name_list))
+            image_list.sort(key=lambda x: self.file_name_list.index(x[0]))
+            try:
+                if self.isInterruptionRequested():
+                    raise Exception("Cancelled.")
+                with gDatabase.atomic():
+                    for file_name, image in image_list:
+                        object = MdObject()
+                        object.dataset = self.dataset
+                        object.object_name = Path(file_name).stem
+                        object.save()
+                        image.object = object
+                        image.save()
+                object_count = len(image_list)
+            except Exception as e:
+                error_list.append(str(e))
+            if object_count == 0:
+                # blobs stored for rows that were never committed
+                collect_image_garbage(self.storage_directory, [ image.md5hash for file_name, image in image_list ])
+        finally:
+            # connections are per thread
+            gDatabase.close()
+        self.ingested.emit(object_count, error_list)
+
+    def ingest_file(self, file_name):
+        if self.isInterruptionRequested():
+            raise Exception("Cancelled.")
+        image = MdImage()
+        image.ingest_file(file_name, self.storage_directory)
+        return image
+
 class DatasetAnalysisDialog(QDialog):
     def __init__(self,parent,dataset):
         super().__init__()
@@ -2488,7 +2926,7 @@ class DatasetAnalysisDialog(QDialog):
         #print("dataset:", dataset)
         self.dataset = dataset
         prev_lm_count = -1
-        for obj in dataset.object_list:
+        for obj in dataset.object_list.order_by(MdObject.id):
             obj.unpack_landmark()
             obj.unpack_property()
             #print("property:", obj.property_list)
@@ -2651,21 +3089,27 @@ class DatasetAnalysisDialog(QDialog):
         QApplication.setOverrideCursor(Qt.WaitCursor)
         QApplication.processEvents()
 
-        self.ds_ops = MdDatasetOps(self.dataset)
-
-        if not self.ds_ops.procrustes_superimposition():
+        # superimposition and PCA are kept per dataset and only updated for objects changed since the last run
+        analysis = MdIncrementalAnalysis.get_analysis(self.dataset, n_components=PCA_COMPONENT_COUNT)
+        superimposition_result = analysis.refresh(callback=self.show_superimposition_progress)
+        if not superimposition_result or analysis.ds_ops is None:
             print("procrustes superimposition failed")
+            QApplication.restoreOverrideCursor()
             return
+        self.ds_ops = analysis.get_dataset_ops()
+        self.status_bar.showMessage(str(superimposition_result))
         self.show_object_shape()
 
-        if self.dataset.object_list is None or len(self.dataset.object_list) < 5:
-            print("too small number of objects for PCA analysis")            
+        if len(self.ds_ops.object_list) < 5:
+            print("too small number of objects for PCA analysis")
+            QApplication.restoreOverrideCursor()
             return
 
-        self.pca_result = self.PerformPCA(self.ds_ops)
+        self.pca_result = analysis.pca
         new_coords = self.pca_result.rotated_matrix.tolist()
         for i, obj in enumerate(self.ds_ops.object_list):
-            obj.pca_result = new_coords[i]
+            # there are only min(objects, variables) components; pad for the PC1-PC10 axis combos
+            obj.pca_result = new_coords[i] + [0.0] * max(0, 11 - len(new_coords[i]))
 
         self.show_pca_result()
 
@@ -2677,6 +3121,24 @@ class DatasetAnalysisDialog(QDialog):
         #    for obj in ds_ops.object_list:
         #        f.write(obj.object_name + "\t" + "\t".join([str(x) for x in obj.pca_result]) + "\n")
 
+    def closeEvent(self, event):
+        # keep the results for the next time this dataset is analyzed
+        if self.dataset is not None:
+            MdIncrementalAnalysis.get_analysis(self.dataset, n_components=PCA_COMPONENT_COUNT).save_cache()
+        super().closeEvent(event)
+
+    def refresh_analysis(self):
+        ''' called by the main window after objects of the dataset were edited '''
+        self.load_object()
+        self.on_btnPCA_clicked()
+
+    def show_superimposition_progress(self, iteration, residual):
+        if residual is None:
+            self.status_bar.showMessage("Procrustes superimposition: iteration {}".format(iteration))
+        else:
+            self.status_bar.showMessage("Procrustes superimposition: iteration {}, residual {:.3e}".format(iteration, residual))
+        QApplication.processEvents()
+
     def show_pca_result(self):
         #self.plot_widget.clear()
 
@@ -2993,24 +3455,6 @@ class DatasetAnalysisDialog(QDialog):
                     #break
             
 
-    def PerformPCA(self,dataset_ops):
-
-        pca = MdPrincipalComponent()
-        datamatrix = []
-        for obj in dataset_ops.object_list:
-            datum = []
-            for lm in obj.landmark_list:
-                datum.extend( lm )
-            datamatrix.append(datum)
-
-        pca.SetData(datamatrix)
-        pca.Analyze()
-
-        number_of_axes = min(pca.nObservation, pca.nVariable)
-        pca_done = True
-
-        return pca
-
     def load_object(self):
         # load objects into tableView
         #for object in self.dataset.object_list:
@@ -3026,7 +3470,7 @@ class DatasetAnalysisDialog(QDialog):
         self.propertyname = self.comboPropertyName.currentText()
 
         self.property_list = []
-        for obj in self.dataset.object_list:
+        for obj in self.dataset.object_list.order_by(MdObject.id):
             item0 = QStandardItem()
             item0.setCheckable(True)
             item0.setCheckState(Qt.Checked)
@@ -3206,11 +3650,11 @@ class ExportDatasetDialog(QDialog):
         self.rbProcrustes.setChecked(True)
         self.rbBookstein = QRadioButton("Bookstein")
         self.rbBookstein.clicked.connect(self.on_rbBookstein_clicked)
-        self.rbBookstein.setEnabled(False)
+        self.rbBookstein.setEnabled(True)
         self.rbBookstein.setChecked(False)
         self.rbRFTRA = QRadioButton("RFTRA")
         self.rbRFTRA.clicked.connect(self.on_rbRFTRA_clicked)
-        self.rbRFTRA.setEnabled(False)
+        self.rbRFTRA.setEnabled(True)
         self.rbRFTRA.setChecked(False)
         self.rbNone = QRadioButton("None")
         self.rbNone.clicked.connect(self.on_rbNone_clicked)
@@ -3268,8 +3712,10 @@ class ExportDatasetDialog(QDialog):
         self.dataset = dataset
         self.ds_ops = MdDatasetOps(dataset)
         self.edtDatasetName.setText(self.dataset.dataset_name)
-        for object in self.dataset.object_list:
+        for object in self.dataset.object_list.order_by(MdObject.id):
             self.lstExportList.addItem(object.object_name)
+        # Bookstein registration needs a baseline
+        self.rbBookstein.setEnabled(len(self.ds_ops.baseline_point_list) >= 2)
         
     def on_rbProcrustes_clicked(self):
         pass
@@ -3306,6 +3752,12 @@ class ExportDatasetDialog(QDialog):
         #    export_list.append(item.text())
         if self.rbProcrustes.isChecked():
             self.ds_ops.procrustes_superimposition()
+        elif self.rbRFTRA.isChecked():
+            self.ds_ops.resistant_fit_superimposition()
+        elif self.rbBookstein.isChecked():
+            if not self.ds_ops.bookstein_registration(self.dataset.unpack_baseline()):
+                QMessageBox.warning(self, "Export", "Bookstein registration failed. Check the dataset baseline.")
+                return
         object_list = self.ds_ops.object_list
 
         if self.rbTPS.isChecked():
@@ -3327,6 +3779,83 @@ class ExportDatasetDialog(QDialog):
                         #pass#
         self.close()
 
+class ImportDatasetThread(QThread):
+    ''' reads specimens from a TPS/NTS/Morphologika reader and writes them to a new dataset,
+        committing every batch_size objects so the write lock is never held while the file is being read.
+        a cancelled or failed import deletes the dataset again '''
+    progress = pyqtSignal(int, int)
+    imported = pyqtSignal(int, int)
+    failed = pyqtSignal(str)
+    cancelled = pyqtSignal()
+
+    def __init__(self, import_data, dataset_name, batch_size=500, parent=None):
+        super().__init__(parent)
+        self.import_data = import_data
+        self.dataset_name = dataset_name
+        self.batch_size = batch_size
+
+    def run(self):
+        dataset = None
+        try:
+            object_iter = self.import_data.iter_objects()
+            first_specimen = next(object_iter, None)
+            if first_specimen is None:
+                self.failed.emit("No object found in the file.")
+                return
+            # dimension and property names are known once the first specimen has been read
+            dataset = MdDataset()
+            dataset.dataset_name = self.dataset_name
+            dataset.dimension = self.import_data.dimension
+            if len(self.import_data.propertyname_list) > 0:
+                dataset.propertyname_list = self.import_data.propertyname_list
+                dataset.pack_propertyname_str()
+            dataset.save()
+            object_count = 0
+            for object_data_list in self.iter_object_data_batch(first_specimen, object_iter):
+                object_count += MdObject.insert_object_list(dataset, object_data_list, chunk_size=self.batch_size)
+                self.on_progress(object_count)
+            if self.isInterruptionRequested():
+                dataset.delete_instance()
+                self.cancelled.emit()
+                return
+            if 'property_list' not in first_specimen and len(self.import_data.property_list_list) > 0:
+                self.update_property_list(dataset)
+            self.imported.emit(dataset.id, object_count)
+        except Exception as e:
+            if dataset is not None and dataset.id is not None:
+                dataset.delete_instance()
+            self.failed.emit(str(e))
+        finally:
+            # connections are per thread
+            gDatabase.close()
+
+    def iter_object_data_batch(self, first_specimen, object_iter):
+        object_data_list = [ ImportDatasetDialog.make_object_data(first_specimen) ]
+        for specimen in object_iter:
+            if self.isInterruptionRequested():
+                return
+            object_data_list.append(ImportDatasetDialog.make_object_data(specimen))
+            if len(object_data_list) >= self.batch_size:
+                yield object_data_list
+                object_data_list = []
+        if len(object_data_list) > 0:
+            yield object_data_list
+
+    def update_property_list(self, dataset):
+        ''' property values that come after the coordinates in the file, e.g. a Morphologika [labelvalues]
+            section after [rawpoints], are known only once the whole file has been read '''
+        dataset.propertyname_list = self.import_data.propertyname_list
+        dataset.pack_propertyname_str()
+        object_id_list = [ mo.id for mo in MdObject.select(MdObject.id).where(MdObject.dataset == dataset).order_by(MdObject.id) ]
+        with gDatabase.atomic():
+            dataset.save()
+            for object_id, property_list in zip(object_id_list, self.import_data.property_list_list):
+                MdObject.update(property_str=PROPERTY_SEPARATOR.join(property_list)).where(MdObject.id == object_id).execute()
+
+    def on_progress(self, done):
+        percent = int( float(self.import_data.read_size) * 100.0 / float(max(self.import_data.file_size, 1)) )
+        self.progress.emit(done, min(percent, 100))
+
 class ImportDatasetDialog(QDialog):
     # NewDatasetDialog shows new dataset dialog.
     def __init__(self,parent):
@@ -3395,6 +3924,13 @@ class ImportDatasetDialog(QDialog):
         self.btnImport = QPushButton("Excute Import")
         self.btnImport.clicked.connect(self.import_file)
         self.btnImport.setEnabled(False)
+        self.btnCancel = QPushButton("Cancel")
+        self.btnCancel.clicked.connect(self.cancel_import)
+        self.btnCancel.setEnabled(False)
+        self.import_layout = QHBoxLayout()
+        self.import_layout.addWidget(self.btnImport)
+        self.import_layout.addWidget(self.btnCancel)
+        self.import_thread = None
 
         # add progress bar
         self.prgImport = QProgressBar()
@@ -3411,7 +3947,7 @@ class ImportDatasetDialog(QDialog):
         self.main_layout.addRow("File Type", self.gbxFileType)
         self.main_layout.addRow("Dataset Name", self.edtDatasetName)
         self.main_layout.addRow("Object Count", self.edtObjectCount)
-        self.main_layout.addRow("Import", self.btnImport)
+        self.main_layout.addRow("Import", self.import_layout)
         self.main_layout.addRow("Progress", self.prgImport)
 
     def open_file(self):
@@ -3461,88 +3997,132 @@ class ImportDatasetDialog(QDialog):
         filename = self.edtFilename.text()
         filetype = self.chkFileType.checkedButton().text()
         datasetname = self.edtDatasetName.text()
-        objectcount = self.edtObjectCount.text()
         import_data = None
+        # readers are created without reading; the import thread streams the file
         if filetype == "TPS":
-            import_data = TPS(filename, datasetname)
+            import_data = TPS(filename, datasetname, preload=False)
         elif filetype == "NTS":
-            import_data = NTS(filename, datasetname)
+            import_data = NTS(filename, datasetname, preload=False)
         elif filetype == "Morphologika":
-            import_data = Morphologika(filename, datasetname)
+            import_data = Morphologika(filename, datasetname, preload=False)
 
         if import_data is None:
             return
 
         self.btnImport.setEnabled(False)
+        self.btnOpenFile.setEnabled(False)
+        self.btnCancel.setEnabled(True)
         self.prgImport.setValue(0)
         self.prgImport.setFormat("Importing...")
-        self.prgImport.update()
-        self.prgImport.repaint()
 
-        self.edtObjectCount.setText(str(import_data.nobjects))
-        #print("objects:", tps.nobjects,tps.nlandmarks,tps.object_name_list)
-        # create dataset
-        dataset = MdDataset()
-        dataset.dataset_name = datasetname
-        dataset.dimension = import_data.dimension
-        if len(import_data.propertyname_list) > 0:
-            dataset.propertyname_list = import_data.propertyname_list
-            dataset.pack_propertyname_str()
-        dataset.save()
-        # add objects
-        for i in range(import_data.nobjects):
-            object = MdObject()
-            object.object_name = import_data.object_name_list[i]
-            #print("object:", object.object_name)
-            object.dataset = dataset
-            object.landmark_str = ""
-            landmark_list = []
-            #print("object_name", object.object_name, import_data.landmark_data.keys())
-            #if object.object_name in import_data.landmark_data.keys():
-            #    print("key exist")
-            #else:
-            #    print("key not exist")
-            for landmark in import_data.landmark_data[object.object_name]:
-                landmark_list.append("\t".join([ str(x) for x in landmark]))
-            object.landmark_str = "\n".join(landmark_list)
-            if len(import_data.propertyname_list) > 0:
-                object.property_list = import_data.property_list_list[i]
-                object.pack_property()
-            if object.object_name in import_data.object_comment.keys():
-                object.object_desc = import_data.object_comment[import_data.object_name_list[i]]
-
-            object.save()
-            val = int( (float(i+1)*100.0 / float(import_data.nobjects)) )
-            #print("progress:", i+1, tps.nobjects, val)
-            self.update_progress(val)
-            #progress = int( (i / float(tps.nobjects)) * 100)
-
-        #print("tps import done")
+        self.import_filetype = filetype
+        self.import_thread = ImportDatasetThread(import_data, datasetname, parent=self)
+        self.import_thread.progress.connect(self.on_import_progress)
+        self.import_thread.imported.connect(self.on_import_finished)
+        self.import_thread.failed.connect(self.on_import_failed)
+        self.import_thread.cancelled.connect(self.on_import_cancelled)
+        self.import_thread.start()
+
+    def cancel_import(self):
+        if self.import_thread is not None and self.import_thread.isRunning():
+            self.btnCancel.setEnabled(False)
+            self.prgImport.setFormat("Cancelling...")
+            self.import_thread.requestInterruption()
+
+    def on_import_finished(self, dataset_id, object_count):
+        self.import_thread.wait()
+        self.import_thread = None
+        self.edtObjectCount.setText(str(object_count))
+        self.update_progress(100)
+
         msg = QMessageBox()
         msg.setIcon(QMessageBox.Information)
-
-        msg.setText("Finished importing a " + filetype + " file.")
+        msg.setText("Finished importing a " + self.import_filetype + " file.")
         msg.setStandardButtons(QMessageBox.Ok)
-            
         retval = msg.exec_()
         self.close()
-        # add dataset to project
-        #self.parent.parent.project.datasets.append(dataset)
-        #self.parent.parent.project.current_dataset = dataset
+
+    def on_import_failed(self, message):
+        self.import_thread.wait()
+        self.import_thread = None
+        self.reset_import_buttons()
+        QMessageBox.warning(self, "Warning", "Import failed: " + message)
+
+    def on_import_cancelled(self):
+        self.import_thread.wait()
+        self.import_thread = None
+        self.reset_import_buttons()
+        self.edtObjectCount.setText("")
+        self.prgImport.setValue(0)
+        self.prgImport.setFormat("Cancelled")
+
+    def reset_import_buttons(self):
+        self.btnImport.setEnabled(True)
+        self.btnOpenFile.setEnabled(True)
+        self.btnCancel.setEnabled(False)
+
+    def closeEvent(self, event):
+        # an unfinished import is deleted
+        if self.import_thread is not None and self.import_thread.isRunning():
+            self.import_thread.requestInterruption()
+            self.import_thread.wait()
+        event.accept()
+
+    @staticmethod
+    def make_object_data(specimen):
+        ''' one row for MdObject.insert_object_list from a specimen yielded by a reader's iter_objects() '''
+        landmark_list = specimen['landmark_list']
+        landmark_array = None
+        if isinstance(landmark_list, np.ndarray):
+            # readers that parse to float64 arrays: the landmark columns are computed from the array, not from landmark_str
+            landmark_array = landmark_list
+            landmark_list = landmark_list.tolist()
+        landmark_str = LINE_SEPARATOR.join([ LANDMARK_SEPARATOR.join([ str(x) for x in landmark ]) for landmark in landmark_list ])
+        object_data = { 'object_name': specimen['object_name'], 'landmark_str': landmark_str }
+        if landmark_array is not None:
+            object_data['landmark_array'] = landmark_array
+        if 'property_list' in specimen:
+            object_data['property_str'] = PROPERTY_SEPARATOR.join(specimen['property_list'])
+        if specimen.get('object_desc'):
+            object_data['object_desc'] = specimen['object_desc']
+        if 'pixels_per_mm' in specimen:
+            object_data['pixels_per_mm'] = specimen['pixels_per_mm']
+        return object_data
+
+    @staticmethod
+    def make_object_data_list(import_data):
+        ''' rows for MdObject.insert_object_list from a reader that has been read() '''
+        object_data_list = []
+        for i in range(import_data.nobjects):
+            object_name = import_data.object_name_list[i]
+            specimen = { 'object_name': object_name, 'landmark_list': import_data.landmark_data[object_name] }
+            if len(import_data.propertyname_list) > 0:
+                specimen['property_list'] = import_data.property_list_list[i]
+            if object_name in import_data.object_comment.keys():
+                specimen['object_desc'] = import_data.object_comment[object_name]
+            if object_name in import_data.object_scale.keys():
+                specimen['pixels_per_mm'] = import_data.object_scale[object_name]
+            object_data_list.append(ImportDatasetDialog.make_object_data(specimen))
+        return object_data_list
+
+    def on_import_progress(self, done, percent):
+        # emitted a few times per second by the import thread, not per object
+        self.edtObjectCount.setText(str(done))
+        self.update_progress(percent)
 
     def update_progress(self, value):
         self.prgImport.setValue(value)
         self.prgImport.setFormat("Importing...{}%".format(value))
-        self.prgImport.update()
-        self.prgImport.repaint()
-        QApplication.processEvents()
 
 class TPS:
-    def __init__(self, filename, datasetname):
+    ''' streaming TPS reader: lines are dispatched on their first character and each specimen's coordinate block
+        is parsed by one numpy call into a float64 (landmarks, dimension) array '''
+    def __init__(self, filename, datasetname, preload=True):
         self.filename = filename
         self.datasetname = datasetname
         self.dimension = 0
         self.nobjects = 0
+        self.nlandmarks = 0
         self.object_name_list = []
         self.landmark_str_list = []
         self.edge_list = []
@@ -3550,8 +4130,13 @@ class TPS:
         self.propertyname_list = []
         self.property_list_list = []
         self.object_comment = {}
+        self.object_scale = {}
+        self.object_image_path = {}
         self.landmark_data = {}
-        self.read()
+        self.file_size = os.path.getsize(filename)
+        self.read_size = 0
+        if preload:
+            self.read()
 
     def isNumber(self,s):
         try:
@@ -3561,136 +4146,124 @@ class TPS:
             return False
 
     def read(self):
-        with open(self.filename, 'r') as f:
-            tps_lines = f.readlines()
+        objects = {}
+        object_name_list = []
+        object_comment = {}
+        for specimen in self.iter_objects():
+            key = specimen['object_name']
+            objects[key] = specimen['landmark_list']
+            object_name_list.append(key)
+            object_comment[key] = specimen['object_desc']
+            if 'pixels_per_mm' in specimen:
+                self.object_scale[key] = specimen['pixels_per_mm']
+            if 'image_path' in specimen:
+                self.object_image_path[key] = specimen['image_path']
+
+        if self.nobjects == 0:
+            return None
+
+        self.landmark_data = objects
+        self.object_name_list = object_name_list
+        self.object_comment = object_comment
+        return {}
 
-            dataset = {}
+    def iter_objects(self):
+        ''' yields one specimen at a time while reading the file line by line '''
+        self.nobjects = 0
+        self.read_size = 0
+        specimen = None
+        coordinate_line_list = []
+        landmark_count = 0
 
-            object_count = 0
-            landmark_count = 0
-            data = []
-            object_name_list = []
-            threed = 0
-            twod = 0
-            objects = {}
-            object_comment = {}
-            header = ''
-            comment = ''
-            image_count = 0
-            currently_in_data_section = False
-            object_id = ''
-            object_image_path = ''
-            object_comment_1 = ''
-            object_comment_2 = ''
-            
-            for line in tps_lines:
+        with open(self.filename, 'r') as f:
+            for line in f:
+                self.read_size += len(line)
                 line = line.strip()
-                if line == '':
+                if line == '' or line[0] in '#"\'':
                     continue
-                if line.startswith("#"):
+                if not line[0].isalpha():
+                    # coordinates; points of CURVES= sections after the landmarks are not landmarks
+                    if specimen is not None and len(coordinate_line_list) < landmark_count:
+                        coordinate_line_list.append(line)
                     continue
-                if line.startswith('"') or line.startswith("'"):
-                    continue
-
-                # regular expression that finds the line "LM=xx comment", ignore case
-                headerline = re.search('^\s*LM\s*=\s*(\d+)\s*(.*)', line, re.IGNORECASE)
-
-                #headerline = re.search('^\s*[LM]+\s*=\s*(\d+)\s*(.*)', line)
-                if headerline is not None:
-                    #print("headerline:", headerline.group(1), headerline.group(2))
-                    if currently_in_data_section == True:
-                        if len(data) > 0:
-                            if object_id != '':
-                                key = object_id
-                            elif object_comment_1 != '':
-                                key = object_comment_1
-                                object_comment_1 = ''
-                            else:
-                                key = self.datasetname + "_" + str(object_count+1)
-                            objects[key] = data
-                            object_name_list.append(key)
-                            object_comment[key] = " ".join( [ object_comment_1, object_comment_2 ] ).strip()
-                            #print("data:", data)
-                            data = []
-                            object_id = ''
-                            object_comment_1 = ''
-                            object_comment_2 = ''
-                            object_image_path = ''
-                        landmark_count, object_comment_1 = int(headerline.group(1)), headerline.group(2).strip()
-                        #print("landmark_count:", landmark_count, "object_count:", object_count, "comment:", comment)
-                        object_count += 1
-                    else:
-                        currently_in_data_section = True
-                else:
-                    dataline = re.search('^\s*(\w+)\s*=(.+)', line)
-                    #print(line)
-                    if dataline is None:
-                        #print("actual data:", line)
-                        point = [ float(x) for x in re.split('\s+', line)]
-                        if len(point) > 2 and self.isNumber(point[2]):
-                            threed += 1
-                        else:
-                            twod += 1
-                        #print("point:", point)
-                        if len(point)>1:
-                            data.append(point)
-                    elif dataline.group(1).lower() == "image":
-                        #print("image:", dataline.group(2))
-                        object_image_path = dataline.group(2)
-                    elif dataline.group(1).lower() == "comment":
-                        #print("comment:", dataline.group(2))
-                        object_comment_2 = dataline.group(2)
-                    elif dataline.group(1).lower() == "id":
-                        #print("id:", dataline.group(2))
-                        #object_id = dataline.group(2)
-                        pass
-
-            #print("aa")
-
-            if len(data) > 0:
-                if object_id != '':
-                    key = object_id
-                elif object_comment_1 != '':
-                    key = object_comment_1
-                    object_comment_1 = ''
-                else:
-                    key = self.datasetname + "_" + str(object_count+1)
-                objects[key] = data
-                object_name_list.append(key)
-                object_comment[key] = " ".join( [ object_comment_1, object_comment_2 ] ).strip()
-
-            #print("bb", object_count, landmark_count)
-
-            if object_count == 0 and landmark_count == 0:
-                return None
 
-            if threed > twod:
-                self.dimension = 3
-            else:
-                self.dimension = 2
-            
-            #print ("dimension:", self.dimension)
-            #print("object_count:", object_count)
-            #print("landmark_count:", landmark_count)
-            #print("object_name_list:", object_name_list)
-            #print("object_comment:", object_comment)
-            #print("objects:", objects)
-
-            self.nobjects = len(object_name_list)
-            self.nlandmarks = landmark_count
-            self.landmark_data = objects
-            self.object_name_list = object_name_list
-            self.object_comment = object_comment
-            #print(self.landmark_data.keys(), self.object_name_list)
-
-            return dataset
+                keyword, _, value = line.partition('=')
+                keyword = keyword.strip().upper()
+                value = value.strip()
+                if keyword in ( 'LM', 'LM3' ):
+                    if specimen is not None:
+                        yield self.make_specimen(specimen, coordinate_line_list)
+                    value_list = value.split(None, 1)
+                    landmark_count = int(value_list[0])
+                    specimen = { 'lm_comment': value_list[1].strip() if len(value_list) > 1 else '' }
+                    coordinate_line_list = []
+                    self.nlandmarks = landmark_count
+                elif specimen is None:
+                    continue
+                elif keyword == 'IMAGE':
+                    specimen['image_path'] = value
+                elif keyword == 'ID':
+                    specimen['object_id'] = value
+                elif keyword == 'COMMENT':
+                    specimen['comment'] = value
+                elif keyword == 'SCALE':
+                    specimen['scale'] = value
+
+        if specimen is not None:
+            yield self.make_specimen(specimen, coordinate_line_list)
+
+    def make_specimen(self, specimen, coordinate_line_list):
+        self.nobjects += 1
+        column_count = len(coordinate_line_list[0].split()) if len(coordinate_line_list) > 0 else max(self.dimension, 2)
+        value_list = " ".join(coordinate_line_list).split()
+        if len(value_list) == column_count * len(coordinate_line_list):
+            landmark_array = np.array(value_list, dtype=np.float64).reshape(-1, column_count)
+        else:
+            landmark_array = self.read_uneven_coordinates(coordinate_line_list)
+            column_count = landmark_array.shape[1]
+        if self.dimension == 0:
+            # the dataset is created before the whole file is read
+            self.dimension = 3 if column_count > 2 else 2
+
+        lm_comment = specimen['lm_comment']
+        if specimen.get('object_id', '') != '':
+            object_name = specimen['object_id']
+        elif lm_comment != '':
+            object_name = lm_comment
+            lm_comment = ''
+        else:
+            object_name = self.datasetname + "_" + str(self.nobjects)
+
+        ret_specimen = { 'object_name': object_name, 'landmark_list': landmark_array,
+                         'object_desc': " ".join( [ lm_comment, specimen.get('comment', '') ] ).strip() }
+        if 'image_path' in specimen:
+            ret_specimen['image_path'] = specimen['image_path']
+        # SCALE is the length of one pixel in mm
+        if 'scale' in specimen and self.isNumber(specimen['scale']) and float(specimen['scale']) > 0:
+            ret_specimen['pixels_per_mm'] = 1.0 / float(specimen['scale'])
+        return ret_specimen
+
+    def read_uneven_coordinates(self, coordinate_line_list):
+        ''' coordinate lines with different numbers of columns: lines with less than two values are skipped and
+            each point is cut or padded with 0 to the dimension most of the lines have '''
+        point_list = [ [ float(x) for x in line.split() ] for line in coordinate_line_list ]
+        point_list = [ point for point in point_list if len(point) > 1 ]
+        threed = len([ point for point in point_list if len(point) > 2 ])
+        dimension = 3 if threed > len(point_list) - threed else 2
+        landmark_array = np.zeros((len(point_list), dimension), dtype=np.float64)
+        for index, point in enumerate(point_list):
+            landmark_array[index, :min(len(point), dimension)] = point[:dimension]
+        return landmark_array
 
 class NTS:
-    def __init__(self, filename, datasetname):
+    ''' NTS reader: the header is decoded with str methods and the numeric body is parsed line by line
+        with numpy into a one row buffer, so memory does not grow with the number of objects '''
+    def __init__(self, filename, datasetname, preload=True):
         self.filename = filename
         self.datasetname = datasetname
         self.dimension = 0
         self.nobjects = 0
+        self.nlandmarks = 0
         self.object_name_list = []
         self.landmark_str_list = []
         self.edge_list = []
@@ -3698,8 +4271,15 @@ class NTS:
         self.propertyname_list = []
         self.property_list_list = []
         self.object_comment = {}
+        self.object_scale = {}
         self.landmark_data = {}
-        self.read()
+        self.landmark_array = None
+        self.column_name_list = []
+        self.description = ''
+        self.file_size = os.path.getsize(filename)
+        self.read_size = 0
+        if preload:
+            self.read()
 
     def isNumber(self,s):
         try:
@@ -3709,220 +4289,528 @@ class NTS:
             return False
 
     def read(self):
+        objects = {}
+        object_name_list = []
+        landmark_list_list = []
+        for specimen in self.iter_objects():
+            objects[specimen['object_name']] = specimen['landmark_list']
+            object_name_list.append(specimen['object_name'])
+            landmark_list_list.append(specimen['landmark_list'])
+
+        if self.nobjects == 0 and self.nlandmarks == 0:
+            return None
+
+        self.landmark_data = objects
+        self.object_name_list = object_name_list
+        if len(landmark_list_list) > 0:
+            self.landmark_array = np.array(landmark_list_list)
+        return {}
+
+    @staticmethod
+    def split_count_flag(token):
+        ''' "23L" -> (23, "L") '''
+        count_str = token.rstrip("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz")
+        return int(count_str), token[len(count_str):].upper()
+
+    def read_header(self, line):
+        ''' "1 23L 2200 0 dim=2": matrix type, rows with label flag, columns with label flag, missing value flag, options.
+            row flag L: row labels listed after the header, B: a label at the beginning of each row,
+            E: a label at the end of each row.
+            column flag L or C: column labels listed after the row labels '''
+        token_list = line.split()
+        row_count, row_flag = self.split_count_flag(token_list[1])
+        column_count, column_flag = self.split_count_flag(token_list[2])
+        dimension = 2
+        for token in token_list[4:]:
+            key, _, value = token.partition('=')
+            if key.lower() == 'dim' and value.isdigit():
+                dimension = int(value)
+        return row_count, row_flag, column_count, column_flag, dimension
+
+    def iter_objects(self):
+        ''' yields one specimen (one row of the matrix) as soon as its values have been read '''
+        self.nobjects = 0
+        self.read_size = 0
+        self.landmark_array = None
+        comments = ""
+        header = None
+        row_name_list = []
+        column_name_list = []
+        row = None
+        row_position = 0
+        row_index = 0
+        pending_row = None
+
         with open(self.filename, 'r') as f:
-            nts_lines = f.readlines()
-
-            dataset = {}
-
-            total_object_count = 0
-            landmark_count = 0
-            data = []
-            object_name_list = []
-            threed = 0
-            twod = 0
-            objects = {}
-            header = ''
-            comment = ''
-            image_count = 0
-            matrix_type = -1
-            total_object_count = -1
-            variable_count = -1
-            dimension = -1
-            headerline_processed = False
-            column_names_exist = False
-            column_names_read = False
-            row_names_read = False
-            row_names_exist_at_row_beginning = False
-            row_names_exist_at_row_ending = False
-            row_names_exist_in_separate_line = False
-
-            current_object_count = 0
-            comments = ""
-
-            for line in nts_lines:
+            for line in f:
+                self.read_size += len(line)
                 line = line.strip()
                 if line == '':
                     continue
-                if line.startswith('"') or line.startswith("'"):
+                if line[0] in '"\'':
                     comments += line
-                    continue
-                #                          1    2     3   4    5     6    7   8    9    10   11   12   13    14
-                headerline = re.search('^(\d+)(\s+)(\d+)(\w*)(\s+)(\d+)(\w*)(\s+)(\d+)(\s+)(\d*)(\s*)(\w+)=(\d+)(.*)', line)
-                if headerline is not None:
-                    matrix_type = headerline.group(1)
-                    total_object_count = int(headerline.group(3))
-                    variable_count = int(headerline.group(6))
-                    self.dimension = int(headerline.group(14))
-                    if variable_count > 0 and dimension > 0:
-                        landmark_count = int( float(variable_count) / float(dimension) )
-                    if headerline.group(4).lower() == "l":
-                        row_names_exist_in_separate_line = True
-                    elif headerline.group(4).lower() == "b":
-                        row_names_exist_at_row_beginning = True
-                    elif headerline.group(4).lower() == "e":
-                        row_names_exist_at_row_ending = True
-                    if headerline.group(7).lower() == "l":
-                        column_names_exist = True
-                    if headerline.group(13).lower() == "dim":
-                        #print("dim:", headerline.group(14))
-                        self.dimension = int(headerline.group(14))
-                    
-                    headerline_processed = True
-                    #print(headerline_processed, headerline.group(6), headerline.group(7), column_names_exist, column_names_read)
+                    self.description = comments
                     continue
 
-                if headerline_processed == True and row_names_exist_in_separate_line == True and row_names_read == False:
-                    row_names_list = re.split('\s+', line)
-                    row_names_read = True
+                if header is None:
+                    header = self.read_header(line)
+                    row_count, row_flag, column_count, column_flag, self.dimension = header
+                    if column_count % self.dimension != 0:
+                        # not a landmark matrix, e.g. a column of centroid sizes
+                        return
+                    self.nlandmarks = column_count // self.dimension
+                    row = np.empty(column_count, dtype=np.float64)
                     continue
 
-                if headerline_processed == True and column_names_exist == True and column_names_read == False:
-                    column_names_list = re.split('\s+', line)
-                    column_names_read = True
+                if row_flag == 'L' and len(row_name_list) < row_count:
+                    row_name_list.extend(line.split())
+                    continue
+                if column_flag in ('L', 'C') and len(column_name_list) < column_count:
+                    column_name_list.extend(line.split())
+                    self.column_name_list = column_name_list
                     continue
 
-                if headerline_processed == True:
-                    data_list = re.split('\s+', line)
-                    if row_names_exist_at_row_beginning == True:
-                        row_name = data_list.pop(0)
-                    elif row_names_exist_at_row_ending == True:
-                        row_name = data_list.pop(-1)
-                    elif len(row_names_list) > 0:
-                        row_name = row_names_list[current_object_count]
-                    else:
-                        row_name = self.datasetname + "_" + str(current_object_count+1)
-                    # turn data_list into coordinates of landmarks based on dimension
-                    data_list = [ float(x) for x in data_list ]
-                    #print(data_list, len(data_list), self.dimension)
-                    objects[row_name] = []
-                    for idx in range(0,len(data_list),self.dimension):
-                        #print point
-                        #print("idx:", idx, "dimension:", self.dimension, "lm:", data_list[idx:idx+self.dimension])
-                        objects[row_name].append(data_list[idx:idx+self.dimension])
-
-                    #print(objects[row_name])
-                    #objects[row_name] = data_list
-                    object_name_list.append(row_name)
-                    current_object_count += 1
-
-            if total_object_count == 0 and landmark_count == 0:
-                return None
-
-            self.nobjects = len(object_name_list)
-            self.nlandmarks = landmark_count
-            self.landmark_data = objects
-            self.object_name_list = object_name_list
-            self.description = comments
-
-            return dataset
+                if row_flag == 'B' and len(row_name_list) == row_index:
+                    label_and_values = line.split(None, 1)
+                    row_name_list.append(label_and_values[0])
+                    if len(label_and_values) < 2:
+                        continue
+                    line = label_and_values[1]
+                if row_flag == 'E':
+                    token_list = line.split()
+                    if pending_row is not None:
+                        # the label of the previous row was put on the next line
+                        row_name_list.append(token_list.pop(0))
+                        yield self.make_specimen(pending_row, row_index, row_name_list)
+                        row_index += 1
+                        pending_row = None
+                    # take out the label that follows the last value of each row
+                    value_token_list = []
+                    needed = column_count - row_position
+                    while len(token_list) > needed:
+                        value_token_list.extend(token_list[:needed])
+                        row_name_list.append(token_list[needed])
+                        token_list = token_list[needed + 1:]
+                        needed = column_count
+                    value_token_list.extend(token_list)
+                    if len(value_token_list) == 0:
+                        continue
+                    line = " ".join(value_token_list)
+                # rows may be wrapped over several lines, or several rows may share a line
+                values = np.fromstring(line, dtype=np.float64, sep=' ')
+                offset = 0
+                while offset < len(values) and row_index < row_count:
+                    take = min(len(values) - offset, column_count - row_position)
+                    row[row_position:row_position + take] = values[offset:offset + take]
+                    offset += take
+                    row_position += take
+                    if row_position == column_count:
+                        row_position = 0
+                        if row_flag == 'E' and len(row_name_list) <= row_index:
+                            # wait for the label on the next line
+                            pending_row = row.copy()
+                            break
+                        yield self.make_specimen(row.copy(), row_index, row_name_list)
+                        row_index += 1
+
+        if pending_row is not None:
+            yield self.make_specimen(pending_row, row_index, row_name_list)
+
+    def make_specimen(self, row, row_index, row_name_list):
+        if row_index < len(row_name_list):
+            object_name = row_name_list[row_index]
+        else:
+            object_name = self.datasetname + "_" + str(row_index+1)
+        self.nobjects = row_index + 1
+        return { 'object_name': object_name, 'landmark_list': row.reshape(self.nlandmarks, self.dimension) }
 
 
 class Morphologika:
-    def __init__(self, filename, datasetname):
+    ''' Morphologika reader: one pass over the file; [rawpoints] is parsed with numpy a few lines at a time and each
+        individual is yielded as soon as its landmarks are complete. [labelvalues] is kept as one list per label '''
+    def __init__(self, filename, datasetname, preload=True):
         self.filename = filename
         self.datasetname = datasetname
         self.dimension = 0
         self.nobjects = 0
+        self.nlandmarks = 0
         self.object_name_list = []
         self.landmark_str_list = []
         self.edge_list = []
         self.polygon_list = []
         self.propertyname_list = []
         self.property_list_list = []
+        self.property_column_list = []
         self.object_comment = {}
+        self.object_scale = {}
         self.landmark_data = {}
-        self.read()
+        self.landmark_array = None
+        self.file_size = os.path.getsize(filename)
+        self.read_size = 0
+        if preload:
+            self.read()
 
     def read(self):
-        f = open(self.filename, 'r')
-        morphologika_data = f.read()
-        f.close()
+        objects = {}
+        landmark_list_list = []
+        for specimen in self.iter_objects():
+            objects[specimen['object_name']] = specimen['landmark_list']
+            landmark_list_list.append(specimen['landmark_list'])
+        if len(landmark_list_list) == 0:
+            return False
+        self.object_name_list = list(objects.keys())
+        self.landmark_array = np.array(landmark_list_list)
+        self.landmark_data = objects
+        return
 
-        object_count = -1
+    def iter_objects(self):
+        ''' yields one specimen at a time. [names] comes before [rawpoints], so the name is known when it is yielded;
+            property values are attached when [labelvalues] came first, otherwise they are in property_list_list
+            once the iteration is over. edge_list and polygon_list are filled the same way '''
+        self.read_size = 0
+        self.landmark_array = None
+        self.object_name_list = []
+        self.propertyname_list = []
+        self.property_list_list = []
+        self.property_column_list = []
+        self.edge_list = []
+        self.polygon_list = []
+        self.nobjects = 0
         landmark_count = -1
-        data_lines = [l.strip() for l in morphologika_data.split('\n')]
-        found = False
-        dsl = ''
+        # files without a [dimensions] section are 2D
         dimension = 2
-        raw_data = {}
-        for line in data_lines:
-            line = line.strip()
-            if line == "":
-                continue
-            if line[0] == "'":
-                '''comment'''
-                continue
-            elif line[0] == '[':
-                dsl = re.search('(\w+)', line).group(0).lower()
-                raw_data[dsl] = []
-                continue
-            else:
-                raw_data[dsl].append(line)
-                if dsl == 'individuals':
-                    object_count = int(line)
-                if dsl == 'landmarks':
+        self.dimension = dimension
+        dsl = ''
+        rawpoints_line_list = []
+        pending_values = np.empty(0, dtype=np.float64)
+
+        with open(self.filename, 'r') as f:
+            for line in f:
+                self.read_size += len(line)
+                line = line.strip()
+                if line == "" or line[0] == "'":
+                    continue
+                if line[0] == '[':
+                    if len(rawpoints_line_list) > 0:
+                        pending_values = yield from self.parse_rawpoints(rawpoints_line_list, pending_values)
+                        rawpoints_line_list = []
+                    dsl = line[1:].split(']')[0].strip().lower()
+                    continue
+
+                if dsl == 'rawpoints':
+                    if landmark_count > 0:
+                        rawpoints_line_list.append(line)
+                        # usually one landmark per line
+                        if len(rawpoints_line_list) >= landmark_count:
+                            pending_values = yield from self.parse_rawpoints(rawpoints_line_list, pending_values)
+                            rawpoints_line_list = []
+                elif dsl == 'landmarks':
                     landmark_count = int(line)
-                if dsl == 'dimensions':
+                    self.nlandmarks = landmark_count
+                elif dsl == 'dimensions':
                     dimension = int(line)
+                    self.dimension = dimension
+                elif dsl == 'names':
+                    self.object_name_list.append(line)
+                elif dsl == 'labels':
+                    self.propertyname_list.extend(line.split())
+                elif dsl == 'labelvalues':
+                    value_list = line.split()
+                    if len(self.property_column_list) == 0:
+                        self.property_column_list = [ [] for value in value_list ]
+                    for column, value in zip(self.property_column_list, value_list):
+                        column.append(value)
+                elif dsl == 'wireframe':
+                    edge = sorted([ int(v) for v in line.split() ])
+                    self.edge_list.append(edge)
+                elif dsl == 'polygons':
+                    poly = sorted([ int(v) for v in line.split() ])
+                    self.polygon_list.append(poly)
+            if len(rawpoints_line_list) > 0:
+                yield from self.parse_rawpoints(rawpoints_line_list, pending_values)
 
-        if object_count < 0 or landmark_count < 0:
-            return False
+        self.dimension = dimension
+        self.property_list_list = [ list(row) for row in zip(*self.property_column_list) ]
+        self.edge_list.sort()
+        self.polygon_list.sort()
 
-        self.raw_data = raw_data
+    def parse_rawpoints(self, line_list, pending_values):
+        ''' parses rawpoints lines with one numpy call, yields every individual that is complete
+            and returns the values left over for the next individual '''
+        values = np.fromstring(" ".join(line_list), dtype=np.float64, sep=' ')
+        if len(pending_values) > 0:
+            values = np.concatenate([ pending_values, values ])
+        individual_size = self.nlandmarks * self.dimension
+        if individual_size <= 0:
+            return np.empty(0, dtype=np.float64)
+        offset = 0
+        while len(values) - offset >= individual_size:
+            yield self.make_specimen(values[offset:offset + individual_size].reshape(self.nlandmarks, self.dimension))
+            offset += individual_size
+        return values[offset:].copy()
+
+    def make_specimen(self, landmark_array):
+        index = self.nobjects
+        self.nobjects += 1
+        if index < len(self.object_name_list):
+            object_name = self.object_name_list[index]
+        else:
+            object_name = self.datasetname + "_" + str(index+1)
+        specimen = { 'object_name': object_name, 'landmark_list': landmark_array.copy() }
+        if len(self.propertyname_list) > 0 and len(self.property_column_list) > 0 and index < len(self.property_column_list[0]):
+            specimen['property_list'] = [ column[index] for column in self.property_column_list ]
+        return specimen
 
-        self.nlandmarks = landmark_count
-        self.dimension = dimension
 
-        self.object_name_list = self.raw_data['names']
-        self.nobjects = len(self.object_name_list)
-        self.nobjects = object_count
+IMPORT_READER_BY_EXTENSION = { '.tps': TPS, '.nts': NTS, '.txt': Morphologika }
 
-        # abc
-        objects = {}
-        #object_landmark_list = []
-        for i, name in enumerate(self.object_name_list):
-            begin = i * self.nlandmarks
-            count = self.nlandmarks
-            # print begin, begin + count
-            objects[name] = []
-            for point in self.raw_data['rawpoints'][begin:begin + count]:
-                #print point
-                coords = re.split('\s+', point)
-                objects[name].append(coords)
 
-        self.landmark_data = objects
+def get_import_file_list(path):
+    ''' importable files in a directory, or the files matching a glob pattern '''
+    if os.path.isdir(path):
+        file_list = [ os.path.join(path, filename) for filename in os.listdir(path) ]
+    else:
+        file_list = glob.glob(path)
+    return sorted([ filename for filename in file_list if os.path.isfile(filename) and Path(filename).suffix.lower() in IMPORT_READER_BY_EXTENSION ])
 
-        self.edge_list = []
-        self.polygon_list = []
-        self.propertyname_list = []
-        self.property_list_list = []
 
-        if 'labels' in self.raw_data.keys():
-            for line in self.raw_data['labels']:
-                labels = re.split('\s+', line)
-                for label in labels:
-                    self.propertyname_list.append( label )
-                    
-        if 'labelvalues' in self.raw_data.keys():
-            for line in self.raw_data['labelvalues']:
-                property_list = re.split('\s+', line)
-                self.property_list_list.append(property_list)
-
-        if 'wireframe' in self.raw_data.keys():
-            for line in self.raw_data['wireframe']:
-                edge = [int(v) for v in re.split('\s+', line)]
-                edge.sort()
-                self.edge_list.append(edge)
-
-        if 'polygons' in self.raw_data.keys():
-            for line in self.raw_data['polygons']:
-                poly = [int(v) for v in re.split('\s+', line)]
-                poly.sort()
-                self.polygon_list.append(poly)
+def make_import_result(filename):
+    return { 'filename': filename, 'dataset_name': Path(filename).stem, 'dimension': 0, 'propertyname_list': [],
+             'object_data_list': [], 'object_count': 0, 'parse_time': 0, 'write_time': 0, 'error': '' }
+
+
+def read_import_file(filename):
+    ''' runs in a worker process of BatchImportThread: parses one file into rows for MdObject.insert_object_list '''
+    begin = time.perf_counter()
+    result = make_import_result(filename)
+    try:
+        reader = IMPORT_READER_BY_EXTENSION[Path(filename).suffix.lower()]
+        import_data = reader(filename, result['dataset_name'], preload=False)
+        result['object_data_list'] = [ ImportDatasetDialog.make_object_data(specimen) for specimen in import_data.iter_objects() ]
+        # property values that come after the coordinates in the file
+        for object_data, property_list in zip(result['object_data_list'], import_data.property_list_list):
+            object_data.setdefault('property_str', PROPERTY_SEPARATOR.join(property_list))
+        result['dimension'] = import_data.dimension
+        result['propertyname_list'] = import_data.propertyname_list
+        if len(result['object_data_list']) == 0:
+            result['error'] = "No object found."
+    except Exception as e:
+        result['error'] = str(e)
+    result['parse_time'] = time.perf_counter() - begin
+    return result
+
+
+class BatchImportThread(QThread):
+    ''' parses files concurrently in a process pool; this thread is the only one writing to the database.
+        each file goes into its own dataset, or all of them into one dataset when merged_dataset_name is given '''
+    progress = pyqtSignal(int, int, str)
+    imported = pyqtSignal(list)
+
+    def __init__(self, file_list, merged_dataset_name=None, max_workers=None, parent=None):
+        super().__init__(parent)
+        self.file_list = file_list
+        self.merged_dataset_name = merged_dataset_name
+        self.max_workers = max_workers
+        self.merged_dataset = None
+
+    def run(self):
+        result_list = []
+        try:
+            # spawn: forking a process that runs Qt threads is not safe
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+                filename_by_future = { executor.submit(read_import_file, filename): filename for filename in self.file_list }
+                for future in concurrent.futures.as_completed(filename_by_future):
+                    if self.isInterruptionRequested():
+                        for remaining_future in filename_by_future:
+                            remaining_future.cancel()
+                        break
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        # a worker process died, e.g. BrokenProcessPool
+                        result = make_import_result(filename_by_future[future])
+                        result['error'] = str(e) if str(e) != '' else type(e).__name__
+                    if result['error'] == '':
+                        self.write_result(result)
+                    result['object_data_list'] = []
+                    result_list.append(result)
+                    self.progress.emit(len(result_list), len(self.file_list), result['filename'])
+        finally:
+            # connections are per thread
+            gDatabase.close()
+            result_list.sort(key=lambda x: self.file_list.index(x['filename']))
+            self.imported.emit(result_list)
+
+    def write_result(self, result):
+        begin = time.perf_counter()
+        try:
+            with gDatabase.atomic():
+                dataset = self.get_dataset(result)
+                if dataset.dimension != result['dimension']:
+                    result['error'] = "Dimension mismatch with dataset " + dataset.dataset_name + "."
+                    return
+                if len(result['propertyname_list']) > 0 and list(result['propertyname_list']) != list(dataset.propertyname_list):
+                    # property_str values are stored by position in the dataset's propertyname_list
+                    result['error'] = "Property names differ from dataset " + dataset.dataset_name + "."
+                    return
+                result['object_count'] = MdObject.insert_object_list(dataset, result['object_data_list'])
+            if self.merged_dataset_name:
+                # kept only once committed
+                self.merged_dataset = dataset
+        except Exception as e:
+            result['error'] = str(e)
+        finally:
+            result['write_time'] = time.perf_counter() - begin
+
+    def get_dataset(self, result):
+        if self.merged_dataset is not None:
+            return self.merged_dataset
+        dataset = MdDataset()
+        dataset.dataset_name = self.merged_dataset_name if self.merged_dataset_name else result['dataset_name']
+        dataset.dimension = result['dimension']
+        if len(result['propertyname_list']) > 0:
+            dataset.propertyname_list = result['propertyname_list']
+            dataset.pack_propertyname_str()
+        dataset.save()
+        return dataset
+
+
+class BatchImportDialog(QDialog):
+    # BatchImportDialog imports every TPS, NTS and Morphologika file in a directory or matching a glob pattern
+    def __init__(self,parent,path=''):
+        super().__init__()
+        self.setWindowTitle("Modan2 - Batch Import")
+        self.parent = parent
+        self.setGeometry(QRect(100, 100, 800, 500))
+        self.move(self.parent.pos()+QPoint(100,100))
+        self.import_thread = None
+
+        self.edtPath = QLineEdit()
+        self.edtPath.setPlaceholderText("Directory or pattern, e.g. C:/data/*.tps")
+        self.edtPath.setText(path)
+        self.edtPath.textChanged.connect(self.path_changed)
+        self.btnOpenDirectory = QPushButton("Open Directory")
+        self.btnOpenDirectory.clicked.connect(self.open_directory)
+        self.path_layout = QHBoxLayout()
+        self.path_layout.addWidget(self.edtPath)
+        self.path_layout.addWidget(self.btnOpenDirectory)
+
+        self.edtFileCount = QLineEdit()
+        self.edtFileCount.setReadOnly(True)
+        self.edtFileCount.setMaximumWidth(100)
+
+        self.rbnDatasetPerFile = QRadioButton("One dataset per file")
+        self.rbnDatasetPerFile.setChecked(True)
+        self.rbnMergeDataset = QRadioButton("Merge into one dataset")
+        self.rbnDatasetPerFile.toggled.connect(self.mode_changed)
+        self.edtDatasetName = QLineEdit()
+        self.edtDatasetName.setPlaceholderText("Dataset Name")
+        self.edtDatasetName.setEnabled(False)
+        self.mode_layout = QHBoxLayout()
+        self.mode_layout.addWidget(self.rbnDatasetPerFile)
+        self.mode_layout.addWidget(self.rbnMergeDataset)
+        self.mode_layout.addWidget(self.edtDatasetName)
+
+        self.btnImport = QPushButton("Excute Import")
+        self.btnImport.clicked.connect(self.import_files)
+        self.btnCancel = QPushButton("Cancel")
+        self.btnCancel.clicked.connect(self.cancel_import)
+        self.btnCancel.setEnabled(False)
+        self.import_layout = QHBoxLayout()
+        self.import_layout.addWidget(self.btnImport)
+        self.import_layout.addWidget(self.btnCancel)
+
+        self.prgImport = QProgressBar()
+        self.prgImport.setMinimum(0)
+        self.prgImport.setMaximum(100)
+        self.prgImport.setValue(0)
+
+        self.tblSummary = QTableWidget()
+        self.tblSummary.setColumnCount(5)
+        self.tblSummary.setHorizontalHeaderLabels(["File", "Objects", "Parse (s)", "Write (s)", "Error"])
+        self.tblSummary.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
+        self.tblSummary.setEditTriggers(QAbstractItemView.NoEditTriggers)
+
+        self.main_layout = QFormLayout()
+        self.setLayout(self.main_layout)
+        self.main_layout.addRow("Files", self.path_layout)
+        self.main_layout.addRow("File Count", self.edtFileCount)
+        self.main_layout.addRow("Dataset", self.mode_layout)
+        self.main_layout.addRow("Import", self.import_layout)
+        self.main_layout.addRow("Progress", self.prgImport)
+        self.main_layout.addRow("Summary", self.tblSummary)
+        self.path_changed()
+
+    def open_directory(self):
+        directory = QFileDialog.getExistingDirectory(self, "Open Directory", self.edtPath.text())
+        if directory:
+            self.edtPath.setText(directory)
+
+    def path_changed(self):
+        self.file_list = get_import_file_list(self.edtPath.text()) if self.edtPath.text() != '' else []
+        self.edtFileCount.setText(str(len(self.file_list)))
+        self.btnImport.setEnabled(len(self.file_list) > 0 and self.import_thread is None)
+
+    def mode_changed(self):
+        self.edtDatasetName.setEnabled(self.rbnMergeDataset.isChecked())
+        if self.rbnMergeDataset.isChecked() and self.edtDatasetName.text() == '':
+            self.edtDatasetName.setText(Path(self.edtPath.text().rstrip('/\\')).stem)
+
+    def import_files(self):
+        if len(self.file_list) == 0:
+            return
+        merged_dataset_name = None
+        if self.rbnMergeDataset.isChecked():
+            if self.edtDatasetName.text() == '':
+                QMessageBox.warning(self, "Warning", "Dataset name is empty.")
+                return
+            merged_dataset_name = self.edtDatasetName.text()
+
+        self.btnImport.setEnabled(False)
+        self.btnCancel.setEnabled(True)
+        self.tblSummary.setRowCount(0)
+        self.prgImport.setValue(0)
+        self.prgImport.setFormat("Importing...")
+        self.import_begin_time = time.perf_counter()
+        self.import_thread = BatchImportThread(self.file_list, merged_dataset_name, parent=self)
+        self.import_thread.progress.connect(self.on_import_progress)
+        self.import_thread.imported.connect(self.on_import_finished)
+        self.import_thread.start()
+
+    def cancel_import(self):
+        if self.import_thread is not None and self.import_thread.isRunning():
+            self.btnCancel.setEnabled(False)
+            self.prgImport.setFormat("Cancelling...")
+            self.import_thread.requestInterruption()
+
+    def on_import_progress(self, done, total, filename):
+        value = int( float(done) * 100.0 / float(max(total, 1)) )
+        self.prgImport.setValue(value)
+        self.prgImport.setFormat("{}/{} {}".format(done, total, Path(filename).name))
+
+    def on_import_finished(self, result_list):
+        self.import_thread.wait()
+        self.import_thread = None
+        self.btnCancel.setEnabled(False)
+        self.btnImport.setEnabled(True)
+
+        self.tblSummary.setRowCount(len(result_list))
+        for row, result in enumerate(result_list):
+            for column, value in enumerate([ Path(result['filename']).name, str(result['object_count']), "{:.2f}".format(result['parse_time']),
+                                             "{:.2f}".format(result['write_time']), result['error'] ]):
+                self.tblSummary.setItem(row, column, QTableWidgetItem(value))
+        error_count = len([ result for result in result_list if result['error'] != '' ])
+        object_count = sum([ result['object_count'] for result in result_list ])
+        self.prgImport.setValue(100)
+        self.prgImport.setFormat("{} of {} files, {} objects, {} errors in {:.1f} s".format(len(result_list), len(self.file_list),
+                                 object_count, error_count, time.perf_counter() - self.import_begin_time))
+
+    def closeEvent(self, event):
+        if self.import_thread is not None and self.import_thread.isRunning():
+            self.import_thread.requestInterruption()
+            self.import_thread.wait()
+        event.accept()
 
-        self.edge_list.sort()
-        self.polygon_list.sort()
-        return
 
 class DatasetDialog(QDialog):
     # NewDatasetDialog shows new dataset dialog.
@@ -4066,8 +4954,11 @@ class DatasetDialog(QDialog):
         ret = QMessageBox.question(self, "", "Are you sure to delete this dataset?", QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
         #print("ret:", ret)
         if ret == QMessageBox.Yes:
+            # only the images of this dataset can have lost their last reference
+            md5hash_list = [ image.md5hash for image in MdImage.select(MdImage.md5hash).join(MdObject).where(MdObject.dataset == self.dataset) ]
             self.dataset.delete_instance()
             self.parent.selected_dataset = None
+            self.parent.release_image_hash_list(md5hash_list)
             #self.dataset.delete_dataset()
         #self.delete_dataset()
         self.accept()